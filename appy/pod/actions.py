@@ -68,7 +68,8 @@ class BufferAction:
             errorOccurred = False
             if self.expr:
                 try:
-                    self.exprResult = eval(self.expr, self.buffer.env.context)
+                    self.exprResult = eval(compileExpression(self.expr),
+                                           self.buffer.env.context)
                 except:
                     self.exprResult = None
                     self.writeError(EVAL_ERROR % self.expr)
@@ -83,7 +84,8 @@ class BufferAction:
             self.fromExprResult = None
             errorOccurred = False
             try:
-                self.fromExprResult= eval(self.fromExpr,self.buffer.env.context)
+                self.fromExprResult = eval(compileExpression(self.fromExpr),
+                                           self.buffer.env.context)
             except PodError, pe:
                 self.writeError(FROM_EVAL_ERROR % self.fromExpr + ' ' + str(pe),
                                 dumpTb=False)
@@ -18,6 +18,8 @@
 
 # ------------------------------------------------------------------------------
 import re
+from bisect import bisect_left, insort
+from cStringIO import StringIO
 
 from xml.sax.saxutils import quoteattr
 from appy.shared.xml_parser import xmlPrologue, escapeXml
@@ -78,24 +80,66 @@ NULL_ACTION_ERROR = 'There was a problem with this action. Possible causes: ' \
                     'clause on the same line as the action, which is not ' \
                     'allowed (ie "do text from ...").'
 # ------------------------------------------------------------------------------
+class IndexedDict(dict):
+    '''Dict of buffer positions (ints) that also maintains the sorted list of
+       its keys. Elements and sub-buffers are nearly always added at the end of
+       a buffer, so keeping the list sorted is cheap, and buffers can walk their
+       positions in order, or find the last one, without sorting or scanning
+       the whole dict.'''
+    def __init__(self, items=()):
+        dict.__init__(self)
+        self.sortedKeys = []
+        for key, value in items:
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        if not dict.__contains__(self, key):
+            insort(self.sortedKeys, key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        del self.sortedKeys[bisect_left(self.sortedKeys, key)]
+
+    def keys(self):
+        '''Keys in ascending order.'''
+        return self.sortedKeys[:]
+
+    def reversedItems(self):
+        '''(key, value) pairs, last position first.'''
+        for key in reversed(self.sortedKeys[:]):
+            yield key, self[key]
+
+    def split(self, index):
+        '''Returns 2 IndexedDicts: entries before p_index, and entries from
+           p_index on, whose keys are shifted by -p_index.'''
+        pos = bisect_left(self.sortedKeys, index)
+        first = IndexedDict([(key, self[key]) for key in self.sortedKeys[:pos]])
+        second = IndexedDict([(key-index, self[key]) \
+                              for key in self.sortedKeys[pos:]])
+        return first, second
+
+# ------------------------------------------------------------------------------
 class BufferIterator:
     def __init__(self, buffer):
         self.buffer = buffer
-        self.remainingSubBufferIndexes = self.buffer.subBuffers.keys()
-        self.remainingElemIndexes = self.buffer.elements.keys()
-        self.remainingSubBufferIndexes.sort()
-        self.remainingElemIndexes.sort()
+        # Both lists are sorted copies; we walk them with a cursor each
+        self.subBufferIndexes = self.buffer.subBuffers.keys()
+        self.elemIndexes = self.buffer.elements.keys()
+        self.subBufferCursor = 0
+        self.elemCursor = 0
 
     def hasNext(self):
-        return self.remainingSubBufferIndexes or self.remainingElemIndexes
+        return (self.subBufferCursor < len(self.subBufferIndexes)) or \
+               (self.elemCursor < len(self.elemIndexes))
 
     def next(self):
         nextSubBufferIndex = None
-        if self.remainingSubBufferIndexes:
-            nextSubBufferIndex = self.remainingSubBufferIndexes[0]
+        if self.subBufferCursor < len(self.subBufferIndexes):
+            nextSubBufferIndex = self.subBufferIndexes[self.subBufferCursor]
         nextExprIndex = None
-        if self.remainingElemIndexes:
-            nextExprIndex = self.remainingElemIndexes[0]
+        if self.elemCursor < len(self.elemIndexes):
+            nextExprIndex = self.elemIndexes[self.elemCursor]
         # Compute min between nextSubBufferIndex and nextExprIndex
         if (nextSubBufferIndex != None) and (nextExprIndex != None):
             res = min(nextSubBufferIndex, nextExprIndex)
@@ -105,21 +149,21 @@ class BufferIterator:
             res = nextSubBufferIndex
         # Update "remaining" lists
         if res == nextSubBufferIndex:
-            self.remainingSubBufferIndexes = self.remainingSubBufferIndexes[1:]
+            self.subBufferCursor += 1
             resDict = self.buffer.subBuffers
         elif res == nextExprIndex:
-            self.remainingElemIndexes = self.remainingElemIndexes[1:]
+            self.elemCursor += 1
             resDict = self.buffer.elements
         return res, resDict[res]
 
 # ------------------------------------------------------------------------------
-class Buffer:
+class Buffer(object):
     '''Abstract class representing any buffer used during rendering.'''
     elementRex = re.compile('([\w-]+:[\w-]+)\s*(.*?)>', re.S)
 
     def __init__(self, env, parent):
         self.parent = parent
-        self.subBuffers = {} # ~{i_bufferIndex: Buffer}~
+        self.subBuffers = IndexedDict() # ~{i_bufferIndex: Buffer}~
         self.env = env
 
     def addSubBuffer(self, subBuffer=None):
@@ -130,10 +174,7 @@ class Buffer:
         return subBuffer
 
     def removeLastSubBuffer(self):
-        subBufferIndexes = self.subBuffers.keys()
-        subBufferIndexes.sort()
-        lastIndex = subBufferIndexes.pop()
-        del self.subBuffers[lastIndex]
+        del self.subBuffers[self.subBuffers.sortedKeys[-1]]
 
     def write(self, something): pass # To be overridden
 
@@ -162,11 +203,22 @@ class Buffer:
 # ------------------------------------------------------------------------------
 class FileBuffer(Buffer):
     def __init__(self, env, result):
+        '''p_result is the name of the file to write. If it is None, the result
+           is kept in memory, and is available in self.value once closed.'''
         Buffer.__init__(self, env, None)
         self.result = result
-        self.content = file(result, 'w')
+        self.value = None
+        if result is None:
+            self.content = StringIO()
+        else:
+            self.content = file(result, 'w')
         self.content.write(xmlPrologue)
 
+    def close(self):
+        if self.result is None:
+            self.value = self.content.getvalue()
+        self.content.close()
+
     # getLength is used to manage insertions into sub-buffers. But in the case
     # of a FileBuffer, we will only have 1 sub-buffer at a time, and we don't
     # care about where it will be inserted into the FileBuffer.
@@ -195,13 +247,30 @@ class MemoryBuffer(Buffer):
 
     def __init__(self, env, parent):
         Buffer.__init__(self, env, parent)
-        self.content = u''
-        self.elements = {}
+        # The content is kept as a list of chunks and only joined when it is
+        # read, so that appending to a big buffer does not copy it each time.
+        self.chunks = []
+        self.length = 0
+        self.elements = IndexedDict()
         self.action = None
 
+    def getContent(self):
+        if len(self.chunks) > 1:
+            self.chunks = [u''.join(self.chunks)]
+        if self.chunks:
+            return self.chunks[0]
+        return u''
+
+    def setContent(self, content):
+        self.chunks = []
+        self.length = 0
+        self.write(content)
+
+    content = property(getContent, setContent)
+
     def addSubBuffer(self, subBuffer=None):
         sb = Buffer.addSubBuffer(self, subBuffer)
-        self.content += ' ' # To avoid having several subbuffers referenced at
+        self.write(u' ') # To avoid having several subbuffers referenced at
                             # the same place within this buffer.
         return sb
 
@@ -212,16 +281,22 @@ class MemoryBuffer(Buffer):
             res = self.parent.getFileBuffer()
         return res
 
-    def getLength(self): return len(self.content)
+    def getLength(self): return self.length
 
-    def write(self, thing): self.content += thing
+    def write(self, thing):
+        if isinstance(thing, str):
+            # Decode now, like unicode concatenation did, rather than failing
+            # later when chunks are joined.
+            thing = unicode(thing)
+        self.chunks.append(thing)
+        self.length += len(thing)
 
     def getIndex(self, podElemName):
         res = -1
-        for index, podElem in self.elements.iteritems():
+        for index, podElem in self.elements.reversedItems():
             if podElem.__class__.__name__.lower() == podElemName:
-                if index > res:
-                    res = index
+                res = index
+                break
         return res
 
     def getMainElement(self):
@@ -246,16 +321,16 @@ class MemoryBuffer(Buffer):
     def unreferenceElement(self, elem):
         # Find last occurrence of this element
         elemIndex = -1
-        for index, podElem in self.elements.iteritems():
-            if podElem.OD:
-                if (podElem.OD.elem == elem) and (index > elemIndex):
-                    elemIndex = index
+        for index, podElem in self.elements.reversedItems():
+            if podElem.OD and (podElem.OD.elem == elem):
+                elemIndex = index
+                break
         del self.elements[elemIndex]
 
     def pushSubBuffer(self, subBuffer):
         '''Sets p_subBuffer at the very end of the buffer.'''
         subIndex = None
-        for index, aSubBuffer in self.subBuffers.iteritems():
+        for index, aSubBuffer in self.subBuffers.reversedItems():
             if aSubBuffer == subBuffer:
                 subIndex = index
                 break
@@ -264,7 +339,7 @@ class MemoryBuffer(Buffer):
             # in the parent (if it is a temp buffer generated from a cut)
             del self.subBuffers[subIndex]
             self.subBuffers[self.getLength()] = subBuffer
-            self.content += u' '
+            self.write(u' ')
 
     def transferAllContent(self):
         '''Transfer all content to parent.'''
@@ -278,11 +353,14 @@ class MemoryBuffer(Buffer):
             oldParentLength = self.parent.getLength()
             self.parent.write(self.content)
             # Transfer elements
-            for index, podElem in self.elements.iteritems():
-                self.parent.elements[oldParentLength + index] = podElem
+            # (in ascending order, so that they are appended to the parent's)
+            for index in self.elements.sortedKeys:
+                self.parent.elements[oldParentLength+index] = \
+                    self.elements[index]
             # Transfer subBuffers
-            for index, buf in self.subBuffers.iteritems():
-                self.parent.subBuffers[oldParentLength + index] = buf
+            for index in self.subBuffers.sortedKeys:
+                self.parent.subBuffers[oldParentLength+index] = \
+                    self.subBuffers[index]
         # Empty the buffer
         MemoryBuffer.__init__(self, self.env, self.parent)
         # Change buffer position wrt parent
@@ -302,7 +380,7 @@ class MemoryBuffer(Buffer):
         expr = Expression(expression)
         expr.expr = expression
         self.elements[self.getLength()] = expr
-        self.content += u' '# To be sure that an expr and an elem can't be found
+        self.write(u' ') # To be sure that an expr and an elem can't be found
                             # at the same index in the buffer.
 
     def createAction(self, statementGroup):
@@ -401,53 +479,24 @@ class MemoryBuffer(Buffer):
         part is self.'''
         res = MemoryBuffer(self.env, None)
         # Manage buffer meta-info (elements, expressions, subbuffers)
-        iter = BufferIterator(self)
-        subBuffersToDelete = []
-        elementsToDelete = []
-        mustShift = False
-        while iter.hasNext():
-            itemIndex, item = iter.next()
-            if keepFirstPart:
-                if itemIndex >= index:
-                    newIndex = itemIndex-index
-                    if isinstance(item, MemoryBuffer):
-                        res.subBuffers[newIndex] = item
-                        subBuffersToDelete.append(itemIndex)
-                    else:
-                        res.elements[newIndex] = item
-                        elementsToDelete.append(itemIndex)
-            else:
-                if itemIndex < index:
-                    if isinstance(item, MemoryBuffer):
-                        res.subBuffers[itemIndex] = item
-                        subBuffersToDelete.append(itemIndex)
-                    else:
-                        res.elements[itemIndex] = item
-                        elementsToDelete.append(itemIndex)
-                else:
-                    mustShift = True
-        if elementsToDelete:
-            for elemIndex in elementsToDelete:
-                del self.elements[elemIndex]
-        if subBuffersToDelete:
-            for subIndex in subBuffersToDelete:
-                del self.subBuffers[subIndex]
-        if mustShift:
-            elements = {}
-            for elemIndex, elem in self.elements.iteritems():
-                elements[elemIndex-index] = elem
-            self.elements = elements
-            subBuffers = {}
-            for subIndex, buf in self.subBuffers.iteritems():
-                subBuffers[subIndex-index] = buf
-            self.subBuffers = subBuffers
+        firstElements, lastElements = self.elements.split(index)
+        firstSubBuffers, lastSubBuffers = self.subBuffers.split(index)
         # Manage content
+        content = self.content
         if keepFirstPart:
-            res.write(self.content[index:])
-            self.content = self.content[:index]
+            self.elements = firstElements
+            self.subBuffers = firstSubBuffers
+            res.elements = lastElements
+            res.subBuffers = lastSubBuffers
+            res.write(content[index:])
+            self.content = content[:index]
         else:
-            res.write(self.content[:index])
-            self.content = self.content[index:]
+            self.elements = lastElements
+            self.subBuffers = lastSubBuffers
+            res.elements = firstElements
+            res.subBuffers = firstSubBuffers
+            res.write(content[:index])
+            self.content = content[index:]
         return res
 
     def getElementIndexes(self, expressions=True):
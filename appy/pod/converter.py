@@ -65,7 +65,7 @@ class Converter:
                         'openoffice.org 1': 'openof~1',
                         'openoffice.org 2': 'openof~1',
                         }
-    def __init__(self, docPath, resultType, port=DEFAULT_PORT):
+    def __init__(self, docPath, resultType, port=DEFAULT_PORT, oo=None):
         self.port = port
         self.docUrl, self.docPath = self.getInputUrls(docPath)
         self.inputType = os.path.splitext(docPath)[1][1:].lower()
@@ -73,7 +73,9 @@ class Converter:
         self.resultFilter = self.getResultFilter()
         self.resultUrl = self.getResultUrl()
         self.ooContext = None
-        self.oo = None # The OpenOffice application object
+        # The OpenOffice application object. An already connected desktop may
+        # be given so that one connection is reused for several conversions.
+        self.oo = oo
         self.doc = None # The OpenOffice loaded document
 
     def getInputUrls(self, docPath):
@@ -239,7 +241,8 @@ class Converter:
 
     def run(self):
         '''Connects to OO, does the job and disconnects.'''
-        self.connect()
+        if self.oo is None:
+            self.connect()
         self.loadDocument()
         self.convertDocument()
         self.doc.close(True)
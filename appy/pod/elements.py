@@ -32,7 +32,7 @@ class PodElement:
     def create(elem):
         '''Used to create any POD elem that has a equivalent OD element. Not
            for creating expressions, for example.'''
-        return eval(PodElement.OD_TO_POD[elem])()
+        return globals()[PodElement.OD_TO_POD[elem]]()
     create = staticmethod(create)
 
 class Text(PodElement):
@@ -70,12 +70,30 @@ class Table(PodElement):
     def __init__(self):
         self.tableInfo = None # ~OdTable~
 
+# Code objects for the Python expressions found in templates, keyed by their
+# source. The same expressions are evaluated at every iteration of "for"
+# actions and at every rendering of a template.
+compiledExpressions = {}
+MAX_COMPILED_EXPRESSIONS = 10000
+
+def compileExpression(expr):
+    '''Returns the code object for p_expr, to give to eval instead of p_expr.
+       It is compiled only once.'''
+    code = compiledExpressions.get(expr)
+    if code is None:
+        if len(compiledExpressions) >= MAX_COMPILED_EXPRESSIONS:
+            compiledExpressions.clear()
+        # Like eval, ignore leading blanks
+        code = compile(expr.lstrip(' \t'), '<string>', 'eval')
+        compiledExpressions[expr] = code
+    return code
+
 class Expression(PodElement):
     OD = None
     def __init__(self, pyExpr):
         self.expr = pyExpr
     def evaluate(self, context):
-        res = eval(self.expr, context)
+        res = eval(compileExpression(self.expr), context)
         if res == None:
             res = u''
         elif isinstance(res, str):
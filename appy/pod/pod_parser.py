@@ -201,7 +201,7 @@ class PodParser(OdfParser):
         OdfParser.__init__(self, env, caller)
 
     def endDocument(self):
-        self.env.currentBuffer.content.close()
+        self.env.currentBuffer.close()
 
     def startElement(self, elem, attrs):
         e = OdfParser.startElement(self, elem, attrs)
@@ -17,7 +17,9 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,USA.
 
 # ------------------------------------------------------------------------------
-import zipfile, shutil, xml.sax, os, os.path, re, mimetypes, time
+import zipfile, shutil, xml.sax, os, os.path, re, mimetypes, time, copy
+import tempfile, threading
+from collections import OrderedDict
 
 from UserDict import UserDict
 
@@ -90,6 +92,55 @@ f.close()
 STYLES_POD_FONTS = '<@style@:font-face @style@:name="PodStarSymbol" ' \
                    '@svg@:font-family="StarSymbol"/>'
 
+# ------------------------------------------------------------------------------
+# Templates already read, so that rendering the same template again does not
+# unzip it and parse its styles.xml again. Only the templateCacheSize most
+# recently used ones are kept: callers may render from a new temporary path
+# every time.
+# ~{s_templatePath: ((f_mtime, i_size), [(s_zippedFile, s_content)],
+#                    StylesManager)}~
+templateCache = OrderedDict()
+templateCacheSize = 20
+templateCacheLock = threading.Lock()
+
+def readTemplate(template):
+    '''Returns the list of (name, content) of the files zipped in p_template,
+       and the StylesManager for its styles.xml. If p_template is a path, both
+       are cached until the file changes.'''
+    key = version = None
+    if isinstance(template, basestring):
+        key = os.path.abspath(template)
+        stat = os.stat(key)
+        version = (stat.st_mtime, stat.st_size)
+        templateCacheLock.acquire()
+        try:
+            cached = templateCache.pop(key, None)
+            if cached and (cached[0] == version):
+                # Most recently used ones last
+                templateCache[key] = cached
+                return cached[1], copy.copy(cached[2])
+        finally:
+            templateCacheLock.release()
+    templateZip = zipfile.ZipFile(template)
+    files = [(name, templateZip.read(name)) for name in templateZip.namelist()]
+    templateZip.close()
+    stylesManager = None
+    for name, content in files:
+        if name == 'styles.xml':
+            stylesManager = StylesManager(content)
+    if key:
+        templateCacheLock.acquire()
+        try:
+            templateCache.pop(key, None)
+            templateCache[key] = (version, files, stylesManager)
+            while len(templateCache) > templateCacheSize:
+                templateCache.popitem(last=False)
+        finally:
+            templateCacheLock.release()
+        # Each renderer sets its own styles mapping on its StylesManager
+        stylesManager = copy.copy(stylesManager)
+    return files, stylesManager
+
 # ------------------------------------------------------------------------------
 class Renderer:
     def __init__(self, template, context, result, pythonWithUnoPath=None,
@@ -111,6 +162,11 @@ class Renderer:
            external files (which is the case, for example, if you use the
            default function "document").
 
+         - p_result may also be a file-like object (with methods "write" and
+           "tell", like a StringIO) instead of a file name. The ODT result is
+           then written into it, without creating the result as a file. As
+           there is no extension to look at, the result is always ODT.
+
          - If the Python interpreter which runs the current script is not
            UNO-enabled, this script will run, in another process, a UNO-enabled
            Python interpreter (whose path is p_pythonWithUnoPath) which will
@@ -137,7 +193,7 @@ class Renderer:
            resolver can only be a Zope application object.
         '''
         self.template = template
-        self.templateZip = zipfile.ZipFile(template)
+        templateFiles, stylesManager = readTemplate(template)
         self.result = result
         self.contentXml = None # Content (string) of content.xml
         self.stylesXml = None # Content (string) of styles.xml
@@ -160,40 +216,22 @@ class Renderer:
         # imported file).
         self.fileNames = {}
         self.prepareFolders()
-        # Unzip template
+        # Files of the template, as (name, content). Only the files that pod
+        # modifies are parsed, the others are zipped again as is by finalize.
+        # Files added while rendering (images...) go in self.unzipFolder.
+        self.templateFiles = templateFiles
         self.unzipFolder = os.path.join(self.tempFolder, 'unzip')
         os.mkdir(self.unzipFolder)
-        for zippedFile in self.templateZip.namelist():
-            # Before writing the zippedFile into self.unzipFolder, create the
-            # intermediary subfolder(s) if needed.
-            fileName = None
-            if zippedFile.endswith('/') or zippedFile.endswith(os.sep):
-                # This is an empty folder. Create it nevertheless.
-                os.makedirs(os.path.join(self.unzipFolder, zippedFile))
-            else:
-                fileName = os.path.basename(zippedFile)
-                folderName = os.path.dirname(zippedFile)
-                fullFolderName = self.unzipFolder
-                if folderName:
-                    fullFolderName = os.path.join(fullFolderName, folderName)
-                    if not os.path.exists(fullFolderName):
-                        os.makedirs(fullFolderName)
-            # Unzip the file in self.unzipFolder
-            if fileName:
-                fullFileName = os.path.join(fullFolderName, fileName)
-                f = open(fullFileName, 'wb')
-                fileContent = self.templateZip.read(zippedFile)
-                if (fileName == 'content.xml') and not folderName:
-                    # content.xml files may reside in subfolders.
-                    # We modify only the one in the root folder.
-                    self.contentXml = fileContent
-                elif (fileName == 'styles.xml') and not folderName:
-                    # Same remark as above.
-                    self.stylesManager = StylesManager(fileContent)
-                    self.stylesXml = fileContent
-                f.write(fileContent)
-                f.close()
-        self.templateZip.close()
+        for zippedFile, fileContent in templateFiles:
+            # content.xml and styles.xml files may reside in subfolders. We
+            # modify only the ones in the root folder.
+            if zippedFile == 'content.xml':
+                self.contentXml = fileContent
+            elif zippedFile == 'styles.xml':
+                self.stylesManager = stylesManager
+                self.stylesXml = fileContent
+        # FileBuffers receiving the result of content.xml and styles.xml
+        self.resultBuffers = {}
         # Create the content.xml parser
         pe = PodEnvironment
         contentInserts = (
@@ -239,7 +277,8 @@ class Renderer:
         else:
             raise PodError(BAD_CONTEXT)
         env = PodEnvironment(evalContext, inserts)
-        fileBuffer = FileBuffer(env, os.path.join(self.tempFolder,odtFile))
+        fileBuffer = FileBuffer(env, None)
+        self.resultBuffers[odtFile] = fileBuffer
         env.currentBuffer = fileBuffer
         return PodParser(env, self)
 
@@ -332,7 +371,15 @@ class Renderer:
         res = imp.run()
         return res
 
+    def resultIsFile(self):
+        '''Is p_result a file-like object instead of a file name?'''
+        return hasattr(self.result, 'write')
+
     def prepareFolders(self):
+        if self.resultIsFile():
+            # Nothing to check, just create a temp folder for imports
+            self.tempFolder = tempfile.mkdtemp(prefix='pod')
+            return
         # Check if I can write the result
         if not self.overwriteExisting and os.path.exists(self.result):
             raise PodError(RESULT_FILE_EXISTS % self.result)
@@ -354,11 +401,11 @@ class Renderer:
         except OSError, oe:
             raise PodError(CANT_WRITE_TEMP_FOLDER % (self.result, oe))
 
-    def patchManifest(self):
-        '''Declares, in META-INF/manifest.xml, images or files included via the
-           "do... from document" statements if any.'''
+    def patchManifest(self, manifestContent):
+        '''Declares, in META-INF/manifest.xml (whose content is
+           p_manifestContent), images or files included via the
+           "do... from document" statements if any. Returns the new content.'''
         if self.fileNames:
-            j = os.path.join
             toInsert = ''
             for fileName in self.fileNames.iterkeys():
                 if fileName.endswith('.svg'):
@@ -366,16 +413,9 @@ class Renderer:
                 mimeType = mimetypes.guess_type(fileName)[0]
                 toInsert += ' <manifest:file-entry manifest:media-type="%s" ' \
                             'manifest:full-path="%s"/>\n' % (mimeType, fileName)
-            manifestName = j(self.unzipFolder, j('META-INF', 'manifest.xml'))
-            f = file(manifestName)
-            manifestContent = f.read()
             hook = '</manifest:manifest>'
             manifestContent = manifestContent.replace(hook, toInsert+hook)
-            f.close()
-            # Write the new manifest content
-            f = file(manifestName, 'w')
-            f.write(manifestContent)
-            f.close()
+        return manifestContent
 
     # Public interface
     def run(self):
@@ -387,9 +427,7 @@ class Renderer:
         self.currentParser = self.stylesParser
         # Create the resulting styles.xml
         self.currentParser.parse(self.stylesXml)
-        # Patch META-INF/manifest.xml
-        self.patchManifest()
-        # Re-zip the result
+        # Zip the result
         self.finalize()
 
     def getStyles(self):
@@ -473,72 +511,121 @@ class Renderer:
                 raise pe
         return ooOutput
 
+    def getFolderFiles(self):
+        '''Returns the list of (name, content) of the files in
+           self.unzipFolder. Empty leaf folders are given as (name + '/', '').'''
+        res = []
+        for dir, dirnames, filenames in os.walk(self.unzipFolder):
+            folderName = dir[len(self.unzipFolder)+1:]
+            for fileName in filenames:
+                f = file(os.path.join(dir, fileName), 'rb')
+                res.append((os.path.join(folderName, fileName), f.read()))
+                f.close()
+            if folderName and not dirnames and not filenames:
+                res.append(('%s/' % folderName, ''))
+        return res
+
+    def getResultFiles(self):
+        '''Returns the list of (name, content) of the files making the ODT
+           result: files from the template, content.xml, styles.xml and
+           META-INF/manifest.xml being replaced with their rendered version,
+           then files added while rendering (images...).'''
+        content = self.resultBuffers['content.xml'].value
+        # Insert dynamic styles
+        content = content.replace('<!DYNAMIC_STYLES!>',
+                                  ''.join(self.dynamicStyles))
+        rendered = {'content.xml': content,
+                    'styles.xml': self.resultBuffers['styles.xml'].value}
+        res = []
+        for name, fileContent in self.templateFiles:
+            if name in rendered:
+                fileContent = rendered[name]
+            elif name == 'META-INF/manifest.xml':
+                fileContent = self.patchManifest(fileContent)
+            res.append((name, fileContent))
+        return res + self.getFolderFiles()
+
+    def zipResult(self, result, files):
+        '''Writes the ODT made of p_files (as returned by getResultFiles) into
+           p_result, a file name or a file-like object.'''
+        try:
+            resultOdt = zipfile.ZipFile(result, 'w', zipfile.ZIP_DEFLATED)
+        except RuntimeError:
+            resultOdt = zipfile.ZipFile(result, 'w')
+        for name, content in files:
+            zInfo = zipfile.ZipInfo(name, time.localtime()[:6])
+            if name.endswith('/'):
+                # This is an empty folder. We must create an entry in the zip
+                # for him.
+                zInfo.external_attr = 48
+            else:
+                zInfo.external_attr = 0644 << 16L
+                if name != 'mimetype':
+                    # mimetype must stay uncompressed
+                    zInfo.compress_type = resultOdt.compression
+            resultOdt.writestr(zInfo, content)
+        resultOdt.close()
+
     def finalize(self):
-        '''Re-zip the result and potentially call OpenOffice if target format is
+        '''Zip the result and potentially call OpenOffice if target format is
            not ODT or if forceOoCall is True.'''
-        for odtFile in ('content.xml', 'styles.xml'):
-            shutil.copy(os.path.join(self.tempFolder, odtFile),
-                        os.path.join(self.unzipFolder, odtFile))
-        # Insert dynamic styles
-        contentXml = os.path.join(self.unzipFolder, 'content.xml')
-        f = file(contentXml)
-        dynamicStyles = ''.join(self.dynamicStyles)
-        content = f.read().replace('<!DYNAMIC_STYLES!>', dynamicStyles)
-        f.close()
-        f = file(contentXml, 'w')
-        f.write(content)
-        f.close()
-        # Call the user-defined "finalize" function when present.
+        files = self.getResultFiles()
+        # Call the user-defined "finalize" function when present. It works on
+        # the un-zipped result, so we need to write it into a folder first.
         if self.finalizeFunction:
+            for name, content in files:
+                path = os.path.join(self.unzipFolder, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                if not name.endswith('/'):
+                    f = file(path, 'wb')
+                    f.write(content)
+                    f.close()
             try:
                 self.finalizeFunction(self.unzipFolder)
             except Exception, e:
                 print WARNING_FINALIZE_ERROR % str(e)
-        # Re-zip the result.
+            files = self.getFolderFiles()
+        if self.resultIsFile():
+            resultType = '.odt'
+        else:
+            resultType = os.path.splitext(self.result)[1]
+        if (resultType == '.odt') and not self.forceOoCall:
+            # Zip the result straight to where it must be
+            try:
+                self.zipResult(self.result, files)
+            finally:
+                FolderDeleter.delete(self.tempFolder)
+            return
+        # OpenOffice will need an ODT file to work on
         resultOdtName = os.path.join(self.tempFolder, 'result.odt')
+        self.zipResult(resultOdtName, files)
         try:
-            resultOdt = zipfile.ZipFile(resultOdtName,'w', zipfile.ZIP_DEFLATED)
-        except RuntimeError:
-            resultOdt = zipfile.ZipFile(resultOdtName,'w')
-        for dir, dirnames, filenames in os.walk(self.unzipFolder):
-            for f in filenames:
-                folderName = dir[len(self.unzipFolder)+1:]
-                resultOdt.write(os.path.join(dir, f),
-                                os.path.join(folderName, f))
-            if not dirnames and not filenames:
-                # This is an empty leaf folder. We must create an entry in the
-                # zip for him
-                folderName = dir[len(self.unzipFolder):]
-                zInfo = zipfile.ZipInfo("%s/" % folderName,time.localtime()[:6])
-                zInfo.external_attr = 48
-                resultOdt.writestr(zInfo, '')
-        resultOdt.close()
-        resultType = os.path.splitext(self.result)[1]
-        try:
-            if (resultType == '.odt') and not self.forceOoCall:
-                # Simply move the ODT result to the result
-                os.rename(resultOdtName, self.result)
-            else:
-                if resultType.startswith('.'): resultType = resultType[1:]
-                if not resultType in FILE_TYPES.keys():
-                    raise PodError(BAD_RESULT_TYPE % (
-                        self.result, FILE_TYPES.keys()))
-                # Call OpenOffice to perform the conversion or document update
-                output = self.callOpenOffice(resultOdtName, resultType)
-                # I (should) have the result. Move it to the correct name
-                resPrefix = os.path.splitext(resultOdtName)[0] + '.'
-                if resultType == 'odt':
-                    # converter.py has (normally!) created a second file
-                    # suffixed .res.odt
-                    resultName = resPrefix + 'res.odt'
-                    if not os.path.exists(resultName):
-                        resultName = resultOdtName
-                        # In this case OO in server mode could not be called to
-                        # update indexes, sections, etc.
-                else:
-                    resultName = resPrefix + resultType
+            if resultType.startswith('.'): resultType = resultType[1:]
+            if not resultType in FILE_TYPES.keys():
+                raise PodError(BAD_RESULT_TYPE % (
+                    self.result, FILE_TYPES.keys()))
+            # Call OpenOffice to perform the conversion or document update
+            output = self.callOpenOffice(resultOdtName, resultType)
+            # I (should) have the result. Move it to the correct name
+            resPrefix = os.path.splitext(resultOdtName)[0] + '.'
+            if resultType == 'odt':
+                # converter.py has (normally!) created a second file
+                # suffixed .res.odt
+                resultName = resPrefix + 'res.odt'
                 if not os.path.exists(resultName):
-                    raise PodError(CONVERT_ERROR % output)
+                    resultName = resultOdtName
+                    # In this case OO in server mode could not be called to
+                    # update indexes, sections, etc.
+            else:
+                resultName = resPrefix + resultType
+            if not os.path.exists(resultName):
+                raise PodError(CONVERT_ERROR % output)
+            if self.resultIsFile():
+                f = file(resultName, 'rb')
+                shutil.copyfileobj(f, self.result)
+                f.close()
+            else:
                 os.rename(resultName, self.result)
         finally:
             FolderDeleter.delete(self.tempFolder)
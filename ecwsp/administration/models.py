@@ -19,14 +19,17 @@
 #       MA 02110-1301, USA.
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.contrib import messages
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.files import File
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from hashlib import md5
 import httpagentparser
+import time
 import urllib
-import os
 
 from ecwsp.sis.helper_functions import Callable
 
@@ -59,15 +62,99 @@ class Configuration(models.Model):
         return self.name
     
     def get_or_default(name, default=None, help_text=""):
-        """ Get the config object or create it with a default. Always use this when gettings configs"""
-        object, created = Configuration.objects.get_or_create(name=name)
-        if created:
-            object.value = default
-            object.help_text = help_text
-            object.save()
+        """ Get the config object or create it with a default. Always use this when gettings configs
+        Results are cached, see get_cached_configuration """
+        object = get_cached_configuration(name)
+        if object is None:
+            object, created = Configuration.objects.get_or_create(name=name)
+            if created:
+                object.value = default
+                object.help_text = help_text
+                object.save()
+            set_cached_configuration(object)
         return object
     get_or_default = Callable(get_or_default)
     
+    def get_bool(name, default=False, help_text=""):
+        """ Configuration value as a boolean. True, true and T are considered true """
+        value = Configuration.get_or_default(name, unicode(default), help_text).value
+        return unicode(value).strip().lower() in ("true", "t")
+    get_bool = Callable(get_bool)
+    
+    def get_int(name, default=0, help_text=""):
+        """ Configuration value as an int, default if it isn't a number """
+        value = Configuration.get_or_default(name, unicode(default), help_text).value
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return int(default)
+    get_int = Callable(get_int)
+    
+    def get_decimal(name, default="0", help_text=""):
+        """ Configuration value as a Decimal, default if it isn't a number """
+        value = Configuration.get_or_default(name, unicode(default), help_text).value
+        try:
+            return Decimal(value)
+        except (TypeError, ValueError, InvalidOperation):
+            return Decimal(default)
+    get_decimal = Callable(get_decimal)
+
+
+# Configuration objects by name: (time cached, object)
+# Kept per process for CONFIGURATION_CACHE_TIMEOUT seconds and dropped as soon as
+# a Configuration is saved or deleted in this process. Deployments with several
+# worker processes can set CONFIGURATION_CACHE to the name of a Django cache so
+# changes made in one worker are seen by the others right away.
+_configuration_cache = {}
+
+def _shared_configuration_cache():
+    cache_name = getattr(settings, 'CONFIGURATION_CACHE', None)
+    if cache_name:
+        from django.core.cache import get_cache
+        return get_cache(cache_name)
+    return None
+
+def _configuration_cache_key(name):
+    return 'configuration:%s' % (md5(name.encode('utf-8')).hexdigest(),)
+
+def get_cached_configuration(name):
+    """ Cached Configuration object or None """
+    shared_cache = _shared_configuration_cache()
+    if shared_cache is not None:
+        return shared_cache.get(_configuration_cache_key(name))
+    cached = _configuration_cache.get(name)
+    if cached is not None:
+        cached_at, object = cached
+        if time.time() - cached_at < getattr(settings, 'CONFIGURATION_CACHE_TIMEOUT', 60):
+            return object
+        del _configuration_cache[name]
+    return None
+
+def set_cached_configuration(object):
+    shared_cache = _shared_configuration_cache()
+    if shared_cache is not None:
+        shared_cache.set(_configuration_cache_key(object.name), object)
+    else:
+        _configuration_cache[object.name] = (time.time(), object)
+
+def clear_cached_configuration(name=None):
+    """ Forget one cached configuration, or all of them when name is None """
+    shared_cache = _shared_configuration_cache()
+    if name is None:
+        if shared_cache is not None:
+            shared_cache.delete_many([_configuration_cache_key(object.name) for object in Configuration.objects.all()])
+        _configuration_cache.clear()
+        return
+    if shared_cache is not None:
+        shared_cache.delete(_configuration_cache_key(name))
+    _configuration_cache.pop(name, None)
+
+def configuration_changed_handler(sender, instance, **kwargs):
+    clear_cached_configuration(instance.name)
+
+post_save.connect(configuration_changed_handler, sender=Configuration)
+post_delete.connect(configuration_changed_handler, sender=Configuration)
+    
         
 class Template(models.Model):
     name = models.CharField(max_length=100, unique=True)
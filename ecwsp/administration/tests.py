@@ -7,6 +7,8 @@ Replace these with more appropriate tests for your application.
 
 from django.test import TestCase
 
+from ecwsp.administration.models import Configuration, clear_cached_configuration
+
 class SimpleTest(TestCase):
     def test_basic_addition(self):
         """
@@ -14,6 +16,25 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class ConfigurationTest(TestCase):
+    def setUp(self):
+        clear_cached_configuration()
+    
+    def test_typed_configuration(self):
+        self.assertEqual(Configuration.get_bool("Test flag"), False)
+        config = Configuration.get_or_default("Test flag")
+        config.value = "T"
+        config.save()
+        # Saving drops the cached copy
+        self.assertEqual(Configuration.get_bool("Test flag"), True)
+        self.assertEqual(Configuration.get_int("Test number", 5), 5)
+        Configuration.objects.filter(name="Test number").update(value="7")
+        # update() sends no signal so the cached value is still used
+        self.assertEqual(Configuration.get_int("Test number", 5), 5)
+        clear_cached_configuration("Test number")
+        self.assertEqual(Configuration.get_int("Test number", 5), 7)
+        self.assertEqual(str(Configuration.get_decimal("Test decimal", "70.5")), "70.5")
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
@@ -0,0 +1,174 @@
+""" Counting StudentAttendance per student, status and period.
+
+Reports used to run a filtered count() for every student, status and marking
+period. AttendanceMatrix gets all of those numbers from a single GROUP BY
+query: each record is put in a date segment with a CASE expression and the
+segments are added up into the requested periods, which may overlap (a school
+year and its marking periods for instance).
+"""
+from django.db import connection
+from django.db.models import Count
+
+from ecwsp.attendance.models import StudentAttendance
+from ecwsp.sis.helper_functions import Struct
+
+from datetime import timedelta
+
+
+def period_dates(period):
+    """ (start_date, end_date) of a MarkingPeriod, SchoolYear or date tuple """
+    if isinstance(period, tuple):
+        return period
+    return (period.start_date, period.end_date)
+
+
+class AttendanceCounts(object):
+    """ Attendance records of a student (or of every student) in a period,
+    counted by status """
+    def __init__(self, statuses):
+        # {status_id: Struct with absent, tardy, excused, half and code}
+        self.statuses = statuses
+        # {status_id: number of records}
+        self.by_status = {}
+
+    def add(self, status_id, number):
+        self.by_status[status_id] = self.by_status.get(status_id, 0) + number
+
+    def count(self, code=None, **flags):
+        """ Number of records whose status has every flag given
+        ex: count(absent=True, half=False) or count(code="D") """
+        total = 0
+        for status_id, number in self.by_status.items():
+            status = self.statuses[status_id]
+            if code is not None and status.code != code:
+                continue
+            if [flag for flag, value in flags.items() if getattr(status, flag) != value]:
+                continue
+            total += number
+        return total
+
+    @property
+    def absent(self):
+        return self.count(absent=True)
+
+    @property
+    def absent_unexcused(self):
+        return self.count(absent=True, excused=False)
+
+    @property
+    def tardy(self):
+        return self.count(tardy=True)
+
+    @property
+    def tardy_unexcused(self):
+        return self.count(tardy=True, excused=False)
+
+    @property
+    def excused(self):
+        return self.count(excused=True)
+
+    @property
+    def half(self):
+        return self.count(half=True)
+
+    @property
+    def dismissed(self):
+        return self.count(code="D")
+
+    @property
+    def nonmemb(self):
+        return self.count(code="nonmemb")
+
+
+class AttendanceMatrix(object):
+    """ Student x status x period attendance counts from one query """
+    def __init__(self, periods, students=None, attendance=None):
+        """ periods: MarkingPeriods, SchoolYears or (start_date, end_date) tuples,
+        they are also the keys to use with get() and total()
+        students: Student queryset or list of students or ids, all students when None
+        attendance: StudentAttendance queryset to count, defaults to every record """
+        self.periods = dict([(period, period_dates(period)) for period in periods])
+        # {status_id: Struct}
+        self.statuses = {}
+        # {(student_id, segment): {status_id: number}}
+        self.counts = {}
+
+        # Split the dates at every period start and end so each period is
+        # made of whole segments
+        boundaries = set()
+        for start, end in self.periods.values():
+            boundaries.add(start)
+            boundaries.add(end + timedelta(days=1))
+        boundaries = sorted(boundaries)
+        self.segments = []
+        for start, next_start in zip(boundaries, boundaries[1:]):
+            end = next_start - timedelta(days=1)
+            if [period for period in self.periods.values() if period[0] <= start and end <= period[1]]:
+                self.segments.append((start, end))
+        # {period: [segment index, ...]}
+        self.period_segments = {}
+        for period, (start, end) in self.periods.items():
+            self.period_segments[period] = [i for i, segment in enumerate(self.segments)
+                                            if start <= segment[0] and segment[1] <= end]
+        if not self.segments:
+            return
+
+        if attendance is None:
+            attendance = StudentAttendance.objects.all()
+        attendance = attendance.filter(date__range=(self.segments[0][0], self.segments[-1][1]))
+        if students is not None:
+            attendance = attendance.filter(student__in=students)
+        date_column = '%s.%s' % (
+            connection.ops.quote_name(StudentAttendance._meta.db_table),
+            connection.ops.quote_name('date'))
+        cases = []
+        params = []
+        for i, (start, end) in enumerate(self.segments):
+            cases.append('WHEN %s BETWEEN %%s AND %%s THEN %d' % (date_column, i))
+            params += [start, end]
+        rows = attendance.extra(
+            select={'segment': 'CASE %s END' % (' '.join(cases),)},
+            select_params=params,
+        ).values(
+            'segment',
+            'student',
+            'status',
+            'status__absent',
+            'status__tardy',
+            'status__excused',
+            'status__half',
+            'status__code',
+        ).annotate(number=Count('id')).order_by()
+        for row in rows:
+            if row['segment'] is None:
+                # Between two periods
+                continue
+            if row['status'] not in self.statuses:
+                status = Struct()
+                status.absent = row['status__absent']
+                status.tardy = row['status__tardy']
+                status.excused = row['status__excused']
+                status.half = row['status__half']
+                status.code = row['status__code']
+                self.statuses[row['status']] = status
+            by_status = self.counts.setdefault((row['student'], int(row['segment'])), {})
+            by_status[row['status']] = by_status.get(row['status'], 0) + row['number']
+
+    def get(self, student, period):
+        """ AttendanceCounts of a student (or student id) in one of the periods """
+        student_id = getattr(student, 'id', student)
+        counts = AttendanceCounts(self.statuses)
+        for segment in self.period_segments[period]:
+            for status_id, number in self.counts.get((student_id, segment), {}).items():
+                counts.add(status_id, number)
+        return counts
+
+    def total(self, period):
+        """ AttendanceCounts of every student together in one of the periods """
+        segments = set(self.period_segments[period])
+        counts = AttendanceCounts(self.statuses)
+        for (student_id, segment), by_status in self.counts.items():
+            if segment in segments:
+                for status_id, number in by_status.items():
+                    counts.add(status_id, number)
+        return counts
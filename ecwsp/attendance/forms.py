@@ -17,6 +17,9 @@
 #       MA 02110-1301, USA.
 
 from django import forms
+from django.core.exceptions import ValidationError
+from django.core.validators import EMPTY_VALUES
+from django.forms.models import BaseModelFormSet
 from django.contrib.admin import widgets as adminwidgets
 
 from models import *
@@ -24,15 +27,70 @@ from ecwsp.sis.forms import TimeBasedForm
 from ajax_select.fields import AutoCompleteSelectMultipleField, AutoCompleteSelectField
 import datetime
 
+class PreloadedModelChoiceField(forms.ModelChoiceField):
+    """ ModelChoiceField that finds the chosen object in objects, a {pk: object}
+    dict shared by a formset, instead of running a query in every form """
+    objects = None
+    
+    def to_python(self, value):
+        if self.objects is None:
+            return super(PreloadedModelChoiceField, self).to_python(value)
+        if value in EMPTY_VALUES:
+            return None
+        try:
+            return self.objects[int(value)]
+        except (KeyError, ValueError, TypeError):
+            raise ValidationError(self.error_messages['invalid_choice'])
+
+
 class StudentAttendanceForm(forms.ModelForm):
     class Meta:
         model = StudentAttendance
         widgets = {
-            'student': forms.HiddenInput(attrs={'tabindex':"-1", 'class':'student_select', 'onfocus':"this.defaultIndex=this.selectedIndex;", 'onchange':"this.selectedIndex=this.defaultIndex;"}),
             'date': forms.HiddenInput(),
             'notes': forms.TextInput(attrs={'tabindex':"-1",}),
         }
-    status = forms.ModelChoiceField(widget=forms.Select(attrs={'class':'status',}), queryset=AttendanceStatus.objects.filter(teacher_selectable=True))
+    student = PreloadedModelChoiceField(queryset=Student.objects.all(), widget=forms.HiddenInput(attrs={'tabindex':"-1", 'class':'student_select', 'onfocus':"this.defaultIndex=this.selectedIndex;", 'onchange':"this.selectedIndex=this.defaultIndex;"}))
+    status = PreloadedModelChoiceField(widget=forms.Select(attrs={'class':'status',}), queryset=AttendanceStatus.objects.filter(teacher_selectable=True))
+    
+    def validate_unique(self):
+        """ Checked once for the whole roster by BaseStudentAttendanceFormSet """
+        pass
+
+
+class BaseStudentAttendanceFormSet(BaseModelFormSet):
+    """ A roster of StudentAttendanceForms validated with a fixed number of
+    queries. Students and statuses are found in memory and existing attendance
+    is checked for every form at once.
+    students: the students on the roster """
+    def __init__(self, *args, **kwargs):
+        self.students = dict([(student.id, student) for student in kwargs.pop('students', [])])
+        statuses = list(AttendanceStatus.objects.filter(teacher_selectable=True))
+        self.statuses = dict([(status.id, status) for status in statuses])
+        self.status_choices = [(status.id, unicode(status)) for status in statuses]
+        super(BaseStudentAttendanceFormSet, self).__init__(*args, **kwargs)
+    
+    def _construct_form(self, i, **kwargs):
+        form = super(BaseStudentAttendanceFormSet, self)._construct_form(i, **kwargs)
+        form.fields['student'].objects = self.students
+        form.fields['status'].objects = self.statuses
+        form.fields['status'].choices = [(u"", form.fields['status'].empty_label)] + self.status_choices
+        return form
+    
+    def clean(self):
+        super(BaseStudentAttendanceFormSet, self).clean()
+        keys = set()
+        for form in self.forms:
+            data = getattr(form, 'cleaned_data', {})
+            if data.get('student') and data.get('date') and data.get('status'):
+                keys.add((data['student'].id, data['date'], data['status'].id))
+        if keys:
+            existing = StudentAttendance.objects.filter(
+                student__in=set([key[0] for key in keys]),
+                date__in=set([key[1] for key in keys]),
+            ).values_list('student', 'date', 'status')
+            if [key for key in existing if key in keys]:
+                raise ValidationError('Student attendance with this Student, Date and Status already exists.')
     
     
 class CourseAttendanceForm(forms.Form):
@@ -0,0 +1,31 @@
+from ecwsp.attendance.rollup import rebuild_attendance_days
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from datetime import datetime
+
+class Command(BaseCommand):
+    help = """
+    Recount the per student and day attendance rollup (StudentAttendanceDay
+    and CourseAttendanceDay) from the attendance records. Migrations fill them
+    once, run it after changing attendance with queryset update() or delete().
+    options
+    -s only recount from this date, YYYY-MM-DD
+    -e only recount up to this date, YYYY-MM-DD
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--start', '-s', dest='start',),
+        make_option('--end', '-e', dest='end',),
+    )
+
+    def handle(self, *args, **options):
+        dates = []
+        for option in ('start', 'end'):
+            if options[option]:
+                try:
+                    dates.append(datetime.strptime(options[option], '%Y-%m-%d').date())
+                except ValueError:
+                    raise CommandError('%s must be a date as YYYY-MM-DD' % (option,))
+            else:
+                dates.append(None)
+        daily, course = rebuild_attendance_days(*dates)
+        print 'Wrote %s daily and %s course attendance days' % (daily, course)
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+from django.db.models import Count
+
+# Rows per insert
+CHUNK = 500
+
+# Rollup columns of the values() keys
+ATTNAMES = {'student': 'student_id', 'course': 'course_id', 'date': 'date'}
+
+
+class Migration(DataMigration):
+
+    def count_days(self, orm, source, rollup, key_fields):
+        """ Fill a rollup table from its attendance records, counting like
+        ecwsp.attendance.rollup as of this migration """
+        statuses = dict([(status.id, status) for status in orm['attendance.AttendanceStatus'].objects.all()])
+        # {key: {status_id: number of records}}
+        counts = {}
+        rows = orm[source].objects.values(*(key_fields + ('status',))).annotate(number=Count('id')).order_by()
+        for row in rows:
+            key = tuple([row[field] for field in key_fields])
+            counts.setdefault(key, {})[row['status']] = row['number']
+        days = []
+        for key, by_status in counts.items():
+            day = orm[rollup](**dict([(ATTNAMES[field], value) for field, value in zip(key_fields, key)]))
+            day.records = sum(by_status.values())
+            for status_id, number in by_status.items():
+                status = statuses[status_id]
+                if status.absent:
+                    day.absent += number
+                    if not status.excused:
+                        day.absent_unexcused += number
+                if status.tardy:
+                    day.tardy += number
+                    if not status.excused:
+                        day.tardy_unexcused += number
+                if status.excused:
+                    day.excused += number
+                if status.half:
+                    day.half += number
+                if status.code == "D":
+                    day.dismissed += number
+            days.append(day)
+        orm[rollup].objects.all().delete()
+        for i in range(0, len(days), CHUNK):
+            orm[rollup].objects.bulk_create(days[i:i + CHUNK])
+
+    def forwards(self, orm):
+        if not db.dry_run:
+            self.count_days(orm, 'attendance.StudentAttendance', 'attendance.StudentAttendanceDay', ('student', 'date'))
+            self.count_days(orm, 'attendance.CourseAttendance', 'attendance.CourseAttendanceDay', ('student', 'course', 'date'))
+
+    def backwards(self, orm):
+        if not db.dry_run:
+            orm['attendance.StudentAttendanceDay'].objects.all().delete()
+            orm['attendance.CourseAttendanceDay'].objects.all().delete()
+
+    models = {
+        'attendance.attendancedailystat': {
+            'Meta': {'object_name': 'AttendanceDailyStat'},
+            'absent': ('django.db.models.fields.IntegerField', [], {}),
+            'date': ('django.db.models.fields.DateField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'present': ('django.db.models.fields.IntegerField', [], {}),
+            'tardy': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'attendance.attendancelog': {
+            'Meta': {'object_name': 'AttendanceLog'},
+            'asp': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'course': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['schedule.Course']"}),
+            'date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date.today'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'attendance.attendancestatus': {
+            'Meta': {'object_name': 'AttendanceStatus'},
+            'absent': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'code': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '10'}),
+            'excused': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'half': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'tardy': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'teacher_selectable': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'attendance.courseattendance': {
+            'Meta': {'object_name': 'CourseAttendance'},
+            'course': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['schedule.Course']"}),
+            'date': ('django.db.models.fields.DateField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'notes': ('django.db.models.fields.CharField', [], {'max_length': '500', 'blank': 'True'}),
+            'status': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['attendance.AttendanceStatus']"}),
+            'student': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.Student']"})
+        },
+        'attendance.courseattendanceday': {
+            'Meta': {'unique_together': "(('student', 'course', 'date'),)", 'object_name': 'CourseAttendanceDay'},
+            'absent': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'absent_unexcused': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'course': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['schedule.Course']"}),
+            'date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'dismissed': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'excused': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'half': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'records': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'student': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'course_attendance_days'", 'to': "orm['sis.Student']"}),
+            'tardy': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'tardy_unexcused': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        'attendance.studentattendance': {
+            'Meta': {'ordering': "('-date', 'student')", 'unique_together': "(('student', 'date', 'status'),)", 'object_name': 'StudentAttendance'},
+            'date': ('django.db.models.fields.DateField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'notes': ('django.db.models.fields.CharField', [], {'max_length': '500', 'blank': 'True'}),
+            'private_notes': ('django.db.models.fields.CharField', [], {'max_length': '500', 'blank': 'True'}),
+            'status': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['attendance.AttendanceStatus']"}),
+            'student': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'student_attn'", 'to': "orm['sis.Student']"}),
+            'time': ('django.db.models.fields.TimeField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'attendance.studentattendanceday': {
+            'Meta': {'unique_together': "(('student', 'date'),)", 'object_name': 'StudentAttendanceDay'},
+            'absent': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'absent_unexcused': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'dismissed': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'excused': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'half': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'records': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'student': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'attendance_days'", 'to': "orm['sis.Student']"}),
+            'tardy': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'tardy_unexcused': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'schedule.course': {
+            'Meta': {'object_name': 'Course'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'credits': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '5', 'decimal_places': '2', 'blank': 'True'}),
+            'department': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['schedule.Department']", 'null': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'enrollments': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'to': "orm['sis.MdlUser']", 'null': 'True', 'through': "orm['schedule.CourseEnrollment']", 'blank': 'True'}),
+            'fullname': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'graded': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'homeroom': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_grade_submission': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'level': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.GradeLevel']", 'null': 'True', 'blank': 'True'}),
+            'marking_period': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['schedule.MarkingPeriod']", 'symmetrical': 'False', 'blank': 'True'}),
+            'periods': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['schedule.Period']", 'symmetrical': 'False', 'through': "orm['schedule.CourseMeet']", 'blank': 'True'}),
+            'secondary_teachers': ('django.db.models.fields.related.ManyToManyField', [], {'blank': 'True', 'related_name': "'secondary_teachers'", 'null': 'True', 'symmetrical': 'False', 'to': "orm['sis.Faculty']"}),
+            'shortname': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'teacher': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'ateacher'", 'null': 'True', 'to': "orm['sis.Faculty']"})
+        },
+        'schedule.courseenrollment': {
+            'Meta': {'unique_together': "(('course', 'user', 'role'),)", 'object_name': 'CourseEnrollment'},
+            'attendance_note': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'course': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['schedule.Course']"}),
+            'exclude_days': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['schedule.Day']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'role': ('django.db.models.fields.CharField', [], {'default': "'Student'", 'max_length': '255', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.MdlUser']"}),
+            'year': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.GradeLevel']", 'null': 'True', 'blank': 'True'})
+        },
+        'schedule.coursemeet': {
+            'Meta': {'object_name': 'CourseMeet'},
+            'course': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['schedule.Course']"}),
+            'day': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['schedule.Location']", 'null': 'True', 'blank': 'True'}),
+            'period': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['schedule.Period']"})
+        },
+        'schedule.day': {
+            'Meta': {'ordering': "('day',)", 'object_name': 'Day'},
+            'day': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'schedule.department': {
+            'Meta': {'ordering': "('order_rank', 'name')", 'object_name': 'Department'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'order_rank': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'schedule.location': {
+            'Meta': {'object_name': 'Location'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'schedule.markingperiod': {
+            'Meta': {'ordering': "('-start_date',)", 'object_name': 'MarkingPeriod'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'end_date': ('django.db.models.fields.DateField', [], {}),
+            'friday': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'monday': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'saturday': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'school_days': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'school_year': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.SchoolYear']"}),
+            'shortname': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'show_reports': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'start_date': ('django.db.models.fields.DateField', [], {}),
+            'sunday': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'thursday': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'tuesday': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'wednesday': ('django.db.models.fields.BooleanField', [], {'default': 'True'})
+        },
+        'schedule.period': {
+            'Meta': {'ordering': "('start_time',)", 'object_name': 'Period'},
+            'end_time': ('django.db.models.fields.TimeField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'start_time': ('django.db.models.fields.TimeField', [], {})
+        },
+        'sis.classyear': {
+            'Meta': {'object_name': 'ClassYear'},
+            'full_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'year': ('ecwsp.sis.models.IntegerRangeField', [], {'unique': 'True'})
+        },
+        'sis.cohort': {
+            'Meta': {'object_name': 'Cohort'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'primary': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'students': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'to': "orm['sis.Student']", 'null': 'True', 'db_table': "'sis_studentcohort'", 'blank': 'True'})
+        },
+        'sis.emergencycontact': {
+            'Meta': {'ordering': "('primary_contact', 'emergency_only', 'lname')", 'object_name': 'EmergencyContact'},
+            'city': ('django.db.models.fields.CharField', [], {'default': "u''", 'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'null': 'True', 'blank': 'True'}),
+            'emergency_only': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'fname': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lname': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'mname': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'primary_contact': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'relationship_to_student': ('django.db.models.fields.CharField', [], {'max_length': '500', 'blank': 'True'}),
+            'state': ('django.contrib.localflavor.us.models.USStateField', [], {'max_length': '2', 'null': 'True', 'blank': 'True'}),
+            'street': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'sync_schoolreach': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'zip': ('django.db.models.fields.CharField', [], {'max_length': '10', 'null': 'True', 'blank': 'True'})
+        },
+        'sis.faculty': {
+            'Meta': {'ordering': "('lname', 'fname')", 'object_name': 'Faculty', '_ormbases': ['sis.MdlUser']},
+            'alt_email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'ext': ('django.db.models.fields.CharField', [], {'max_length': '10', 'null': 'True', 'blank': 'True'}),
+            'mdluser_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['sis.MdlUser']", 'unique': 'True', 'primary_key': 'True'}),
+            'number': ('django.contrib.localflavor.us.models.PhoneNumberField', [], {'max_length': '20', 'blank': 'True'}),
+            'teacher': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'sis.gradelevel': {
+            'Meta': {'ordering': "('id',)", 'object_name': 'GradeLevel'},
+            'id': ('django.db.models.fields.IntegerField', [], {'unique': 'True', 'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '150'})
+        },
+        'sis.languagechoice': {
+            'Meta': {'object_name': 'LanguageChoice'},
+            'default': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'iso_code': ('django.db.models.fields.CharField', [], {'max_length': '2', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'})
+        },
+        'sis.mdluser': {
+            'Meta': {'ordering': "('lname', 'fname')", 'object_name': 'MdlUser'},
+            'city': ('django.db.models.fields.CharField', [], {'max_length': '360', 'blank': 'True'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'null': 'True', 'blank': 'True'}),
+            'fname': ('django.db.models.fields.CharField', [], {'max_length': '300'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'inactive': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'lname': ('django.db.models.fields.CharField', [], {'max_length': '300'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'})
+        },
+        'sis.reasonleft': {
+            'Meta': {'object_name': 'ReasonLeft'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'reason': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'})
+        },
+        'sis.schoolyear': {
+            'Meta': {'ordering': "('-start_date',)", 'object_name': 'SchoolYear'},
+            'active_year': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'benchmark_grade': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'end_date': ('django.db.models.fields.DateField', [], {}),
+            'grad_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'start_date': ('django.db.models.fields.DateField', [], {})
+        },
+        'sis.student': {
+            'Meta': {'ordering': "('lname', 'fname')", 'object_name': 'Student', '_ormbases': ['sis.MdlUser']},
+            'alert': ('django.db.models.fields.CharField', [], {'max_length': '500', 'blank': 'True'}),
+            'alt_email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'bday': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'cache_cohort': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'cache_cohorts'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': "orm['sis.Cohort']"}),
+            'cache_gpa': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '5', 'decimal_places': '2', 'blank': 'True'}),
+            'class_of_year': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.ClassYear']", 'null': 'True', 'blank': 'True'}),
+            'cohorts': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['sis.Cohort']", 'symmetrical': 'False', 'through': "orm['sis.StudentCohort']", 'blank': 'True'}),
+            'date_dismissed': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'emergency_contacts': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['sis.EmergencyContact']", 'symmetrical': 'False', 'blank': 'True'}),
+            'family_access_users': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.User']", 'symmetrical': 'False', 'blank': 'True'}),
+            'family_preferred_language': ('django.db.models.fields.related.ForeignKey', [], {'default': 'None', 'to': "orm['sis.LanguageChoice']", 'null': 'True', 'blank': 'True'}),
+            'grad_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'individual_education_program': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'mdluser_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['sis.MdlUser']", 'unique': 'True', 'primary_key': 'True'}),
+            'mname': ('django.db.models.fields.CharField', [], {'max_length': '150', 'null': 'True', 'blank': 'True'}),
+            'notes': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'parent_email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'parent_guardian': ('django.db.models.fields.CharField', [], {'max_length': '150', 'blank': 'True'}),
+            'pic': ('ecwsp.sis.thumbs.ImageWithThumbsField', [], {'blank': 'True', 'max_length': '100', 'null': 'True', 'sizes': '((70, 65), (530, 400))'}),
+            'reason_left': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.ReasonLeft']", 'null': 'True', 'blank': 'True'}),
+            'sex': ('django.db.models.fields.CharField', [], {'max_length': '1', 'null': 'True', 'blank': 'True'}),
+            'siblings': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['sis.Student']", 'symmetrical': 'False', 'blank': 'True'}),
+            'ssn': ('django.db.models.fields.CharField', [], {'max_length': '11', 'null': 'True', 'blank': 'True'}),
+            'state': ('django.contrib.localflavor.us.models.USStateField', [], {'max_length': '2', 'null': 'True', 'blank': 'True'}),
+            'street': ('django.db.models.fields.CharField', [], {'max_length': '150', 'blank': 'True'}),
+            'unique_id': ('django.db.models.fields.IntegerField', [], {'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'year': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.GradeLevel']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'}),
+            'zip': ('django.db.models.fields.CharField', [], {'max_length': '10', 'blank': 'True'})
+        },
+        'sis.studentcohort': {
+            'Meta': {'object_name': 'StudentCohort'},
+            'cohort': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.Cohort']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'primary': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'student': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['sis.Student']"})
+        }
+    }
+
+    complete_apps = ['attendance']
\ No newline at end of file
@@ -17,12 +17,17 @@
 #   MA 02110-1301, USA.
 
 from django.contrib.auth.models import User
+from django.contrib.admin.models import LogEntry, ADDITION
+from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import Sum
+from django.utils.encoding import smart_unicode
+from django.db.models.signals import pre_save, post_save, post_delete
 
 from ecwsp.sis.models import Student, SchoolYear
 from ecwsp.administration.models import Configuration
+from ecwsp.attendance.rollup import attendance_pre_save, attendance_changed, attendance_status_changed, refresh_student_days
 
 import datetime
 import sys
@@ -93,31 +98,128 @@ class StudentAttendance(models.Model):
             try: self.delete()
             except: pass
 
+def create_work_study_attendance(attendances):
+    """ Create work study attendance for absent students whose workday is today.
+    Runs once for a whole list of StudentAttendance """
+    if not ('ecwsp.work_study' in settings.INSTALLED_APPS and
+            Configuration.get_bool("attendance_create_work_attendance")):
+        return
+    today = datetime.date.today()
+    absent = [attendance for attendance in attendances
+              if attendance.date == today and attendance.status.absent]
+    if not absent:
+        return
+    from ecwsp.work_study.models import Attendance, StudentWorker
+    workers = StudentWorker.objects.in_bulk([attendance.student_id for attendance in absent])
+    for attendance in absent:
+        worker = workers.get(attendance.student_id)
+        if worker and today.isoweekday() == worker.get_day_as_iso_date():
+            attn, created = Attendance.objects.get_or_create(
+                student=worker,
+                absence_date = today,
+            )
+            if created:
+                attn.sis_attendance = attendance
+                attn.save()
+
 def post_save_attendance_handler(sender, instance, **kwargs):
     """ Check for any triggers we should run """
-    if True:
-        try:
-            # Create work study attendance if student's workday is today
-            if ('ecwsp.work_study' in settings.INSTALLED_APPS and
-                Configuration.get_or_default("attendance_create_work_attendance", "False").value == "True" and
-                instance.date == datetime.date.today() and
-                instance.status.absent and
-                hasattr(instance.student, 'studentworker') and
-                instance.student.studentworker and
-                datetime.date.today().isoweekday() == instance.student.studentworker.get_day_as_iso_date()
-               ):
-                from ecwsp.work_study.models import Attendance
-                attn, created = Attendance.objects.get_or_create(
-                    student=instance.student.studentworker,
-                    absence_date = datetime.date.today(),
-                )
-                if created:
-                    attn.sis_attendance = instance
-                    attn.save()
-        except:
-            logging.error('Attendance trigger error', exc_info=True)
+    try:
+        create_work_study_attendance([instance])
+    except:
+        logging.error('Attendance trigger error', exc_info=True)
+
+def save_student_attendance(attendances, user=None):
+    """ Save new StudentAttendance for a whole roster at once. Same result as
+    saving each one, Present is not saved, but with one insert. The attendance
+    rollup is recounted and the work study trigger is run once for the batch.
+    user: log the additions in the admin log for this user
+    Returns the saved attendances """
+    present, created = AttendanceStatus.objects.get_or_create(name="Present")
+    attendances = [attendance for attendance in attendances if attendance.status_id != present.id]
+    if not attendances:
+        return []
+    for attendance in attendances:
+        if isinstance(attendance.date, datetime.datetime):
+            attendance.date = attendance.date.date()
+    with transaction.commit_on_success():
+        StudentAttendance.objects.bulk_create(attendances)
+    
+    # bulk_create doesn't set primary keys
+    ids = {}
+    for id, student_id, date, status_id in StudentAttendance.objects.filter(
+            student__in=set([attendance.student_id for attendance in attendances]),
+            date__in=set([attendance.date for attendance in attendances]),
+            ).values_list('id', 'student_id', 'date', 'status_id'):
+        ids[(student_id, date, status_id)] = id
+    for attendance in attendances:
+        attendance.id = ids.get((attendance.student_id, attendance.date, attendance.status_id))
+    refresh_student_days([(attendance.student_id, attendance.date) for attendance in attendances])
+    
+    if user is not None:
+        content_type_id = ContentType.objects.get_for_model(StudentAttendance).pk
+        LogEntry.objects.bulk_create([LogEntry(
+            user_id         = user.pk,
+            content_type_id = content_type_id,
+            object_id       = smart_unicode(attendance.pk),
+            object_repr     = unicode(attendance)[:200],
+            action_flag     = ADDITION,
+        ) for attendance in attendances])
+    try:
+        create_work_study_attendance(attendances)
+    except:
+        logging.error('Attendance trigger error', exc_info=True)
+    return attendances
         
 post_save.connect(post_save_attendance_handler, sender=StudentAttendance)
+pre_save.connect(attendance_pre_save, sender=StudentAttendance)
+post_save.connect(attendance_changed, sender=StudentAttendance)
+post_delete.connect(attendance_changed, sender=StudentAttendance)
+pre_save.connect(attendance_pre_save, sender=CourseAttendance)
+post_save.connect(attendance_changed, sender=CourseAttendance)
+post_delete.connect(attendance_changed, sender=CourseAttendance)
+post_save.connect(attendance_status_changed, sender=AttendanceStatus)
+
+
+class AttendanceDayCounts(models.Model):
+    """ Attendance records of one day counted by kind of status.
+    Kept up to date by ecwsp.attendance.rollup, never edit these by hand.
+    """
+    date = models.DateField(db_index=True)
+    records = models.IntegerField(default=0)
+    absent = models.IntegerField(default=0)
+    absent_unexcused = models.IntegerField(default=0)
+    tardy = models.IntegerField(default=0)
+    tardy_unexcused = models.IntegerField(default=0)
+    excused = models.IntegerField(default=0)
+    half = models.IntegerField(default=0)
+    dismissed = models.IntegerField(default=0)
+    
+    class Meta:
+        abstract = True
+
+
+class StudentAttendanceDay(AttendanceDayCounts):
+    """ Daily attendance of a student on a date """
+    student = models.ForeignKey(Student, related_name="attendance_days")
+    
+    class Meta:
+        unique_together = (("student", "date"),)
+    
+    def __unicode__(self):
+        return unicode(self.student) + " " + unicode(self.date)
+
+
+class CourseAttendanceDay(AttendanceDayCounts):
+    """ Course attendance of a student in a course on a date """
+    student = models.ForeignKey(Student, related_name="course_attendance_days")
+    course = models.ForeignKey('schedule.Course')
+    
+    class Meta:
+        unique_together = (("student", "course", "date"),)
+    
+    def __unicode__(self):
+        return unicode(self.student) + " " + unicode(self.course) + " " + unicode(self.date)
 
 
 class AttendanceLog(models.Model):
@@ -137,11 +239,12 @@ class AttendanceDailyStat(models.Model):
     
     def set_all(self):
         """ Records fields and saves """
+        today = datetime.date.today()
         all_students = Student.objects.filter(inactive=False).count()
-        absents = StudentAttendance.objects.filter(date=date.today(), status__absent=True).count()
-        tardies = StudentAttendance.objects.filter(date=date.today(), status__tardy=True).count()
+        totals = StudentAttendanceDay.objects.filter(date=today).aggregate(
+            absent=Sum('absent'), tardy=Sum('tardy'))
         
-        self.present = all_students - absents
-        self.absent = absents
-        self.tardy = tardies
+        self.absent = totals['absent'] or 0
+        self.tardy = totals['tardy'] or 0
+        self.present = all_students - self.absent
         self.save()
\ No newline at end of file
@@ -0,0 +1,152 @@
+""" Per student and day attendance counters maintained from signals.
+
+StudentAttendanceDay holds, for each student and date with daily attendance,
+how many records had an absent, tardy, excused... status. CourseAttendanceDay
+does the same for each course's attendance. The counters of a day are
+recounted whenever one of its records is saved or deleted, and every day using
+a status is recounted when that status changes.
+
+Queryset update(), delete() and bulk_create() don't send signals, code using
+them must call refresh_student_days or refresh_course_days itself. The
+rebuild_attendance_days management command recounts everything (or a date
+range) from the attendance records.
+"""
+from django.db.models import Count
+
+import datetime
+
+# Counters copied from ecwsp.attendance.aggregation.AttendanceCounts
+COUNTERS = ('absent', 'absent_unexcused', 'tardy', 'tardy_unexcused', 'excused', 'half', 'dismissed')
+
+# Column names of the rollup models for the values() keys
+ATTNAMES = {'student': 'student_id', 'course': 'course_id', 'date': 'date'}
+
+REFRESH_CHUNK = 500
+
+
+def _tables():
+    """ (attendance model, rollup model, key fields) for daily and course attendance """
+    from ecwsp.attendance.models import StudentAttendance, CourseAttendance, StudentAttendanceDay, CourseAttendanceDay
+    return (
+        (StudentAttendance, StudentAttendanceDay, ('student', 'date')),
+        (CourseAttendance, CourseAttendanceDay, ('student', 'course', 'date')),
+    )
+
+
+def _table_for(sender):
+    for table in _tables():
+        if table[0] == sender:
+            return table
+
+
+def _statuses():
+    from ecwsp.attendance.models import AttendanceStatus
+    return dict([(status.id, status) for status in AttendanceStatus.objects.all()])
+
+
+def _count_days(rollup, key_fields, rows, statuses):
+    """ Unsaved rollup rows from values(*key_fields, 'status') rows annotated with number """
+    from ecwsp.attendance.aggregation import AttendanceCounts
+    counts = {}
+    for row in rows:
+        key = tuple([row[field] for field in key_fields])
+        counts.setdefault(key, AttendanceCounts(statuses)).add(row['status'], row['number'])
+    days = []
+    for key, day_counts in counts.items():
+        day = rollup(**dict([(ATTNAMES[field], value) for field, value in zip(key_fields, key)]))
+        day.records = sum(day_counts.by_status.values())
+        for counter in COUNTERS:
+            setattr(day, counter, getattr(day_counts, counter))
+        days.append(day)
+    return days
+
+
+def _refresh(source, rollup, key_fields, keys):
+    """ Recount the rollup rows of keys, tuples of key_fields values """
+    keys = list(set(keys))
+    if not keys:
+        return
+    statuses = _statuses()
+    for i in range(0, len(keys), REFRESH_CHUNK):
+        chunk = set(keys[i:i + REFRESH_CHUNK])
+        student_ids = set([key[0] for key in chunk])
+        dates = set([key[-1] for key in chunk])
+        rows = source.objects.filter(student__in=student_ids, date__in=dates).values(
+            *(key_fields + ('status',))).annotate(number=Count('id')).order_by()
+        rows = [row for row in rows if tuple([row[field] for field in key_fields]) in chunk]
+        old_ids = [values[0] for values in rollup.objects.filter(
+            student__in=student_ids, date__in=dates).values_list('id', *key_fields)
+            if tuple(values[1:]) in chunk]
+        if old_ids:
+            rollup.objects.filter(id__in=old_ids).delete()
+        rollup.objects.bulk_create(_count_days(rollup, key_fields, rows, statuses))
+
+
+def refresh_student_days(keys):
+    """ Recount StudentAttendanceDay for (student_id, date) keys """
+    source, rollup, key_fields = _tables()[0]
+    _refresh(source, rollup, key_fields, keys)
+
+
+def refresh_course_days(keys):
+    """ Recount CourseAttendanceDay for (student_id, course_id, date) keys """
+    source, rollup, key_fields = _tables()[1]
+    _refresh(source, rollup, key_fields, keys)
+
+
+def rebuild_attendance_days(start=None, end=None):
+    """ Recount every rollup row, or only those from start to end.
+    Returns the number of (daily, course) rows written """
+    statuses = _statuses()
+    written = []
+    for source, rollup, key_fields in _tables():
+        records = source.objects.all()
+        days = rollup.objects.all()
+        if start is not None:
+            records = records.filter(date__gte=start)
+            days = days.filter(date__gte=start)
+        if end is not None:
+            records = records.filter(date__lte=end)
+            days = days.filter(date__lte=end)
+        days.delete()
+        rows = records.values(*(key_fields + ('status',))).annotate(number=Count('id')).order_by()
+        new_days = _count_days(rollup, key_fields, rows, statuses)
+        rollup.objects.bulk_create(new_days, batch_size=REFRESH_CHUNK)
+        written.append(len(new_days))
+    return tuple(written)
+
+
+def _key(instance, key_fields):
+    key = [getattr(instance, ATTNAMES[field]) for field in key_fields]
+    # date defaults to datetime.now
+    if isinstance(key[-1], datetime.datetime):
+        key[-1] = key[-1].date()
+    return tuple(key)
+
+
+def attendance_pre_save(sender, instance, **kwargs):
+    """ Remember the day an existing record belonged to, in case it moves """
+    instance._rollup_old_key = None
+    if instance.pk:
+        source, rollup, key_fields = _table_for(sender)
+        old = sender.objects.filter(pk=instance.pk).values_list(*key_fields)
+        if old:
+            instance._rollup_old_key = tuple(old[0])
+
+
+def attendance_changed(sender, instance, **kwargs):
+    """ post_save and post_delete of StudentAttendance and CourseAttendance """
+    source, rollup, key_fields = _table_for(sender)
+    keys = [_key(instance, key_fields)]
+    if getattr(instance, '_rollup_old_key', None):
+        keys.append(instance._rollup_old_key)
+    _refresh(source, rollup, key_fields, keys)
+
+
+def attendance_status_changed(sender, instance, created=False, **kwargs):
+    """ An edited status can change the counters of every day that uses it """
+    if created:
+        return
+    for source, rollup, key_fields in _tables():
+        keys = source.objects.filter(status=instance).values_list(*key_fields).order_by().distinct()
+        _refresh(source, rollup, key_fields, [tuple(key) for key in keys])
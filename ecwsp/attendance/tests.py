@@ -6,6 +6,15 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import User
+
+from ecwsp.sis.models import Student, SchoolYear
+from ecwsp.attendance.models import AttendanceStatus, StudentAttendance, StudentAttendanceDay, save_student_attendance
+from ecwsp.attendance.aggregation import AttendanceMatrix
+from ecwsp.attendance.rollup import rebuild_attendance_days
+
+from datetime import date
 
 
 class SimpleTest(TestCase):
@@ -14,3 +23,92 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class AttendanceMatrixTest(TestCase):
+    def setUp(self):
+        self.student = Student.objects.create(fname="Joe", lname="Student", username="jstudent")
+        self.student2 = Student.objects.create(fname="Jane", lname="Student", username="jstudent2")
+        self.year = SchoolYear.objects.create(name="2010-2011", start_date=date(2010,7,1), end_date=date(2011,5,1))
+        self.absent = AttendanceStatus.objects.create(name="Absent", code="A", absent=True)
+        self.excused = AttendanceStatus.objects.create(name="Absent Excused", code="AX", absent=True, excused=True)
+        self.tardy = AttendanceStatus.objects.create(name="Tardy", code="T", tardy=True)
+        for student, day, status in (
+            (self.student, date(2010,7,5), self.absent),
+            (self.student, date(2010,9,6), self.excused),
+            (self.student, date(2010,9,7), self.tardy),
+            (self.student2, date(2010,7,6), self.tardy),
+            (self.student, date(2011,6,1), self.absent), # After the school year
+        ):
+            StudentAttendance.objects.create(student=student, date=day, status=status)
+
+    def test_overlapping_periods(self):
+        """ Counts must match a filtered count() for each period, even
+        when a period contains another one """
+        first = (date(2010,7,1), date(2010,9,1))
+        matrix = AttendanceMatrix([self.year, first])
+        self.assertEqual(matrix.get(self.student, self.year).absent, 2)
+        self.assertEqual(matrix.get(self.student, self.year).absent_unexcused, 1)
+        self.assertEqual(matrix.get(self.student, self.year).tardy, 1)
+        self.assertEqual(matrix.get(self.student, first).absent, 1)
+        self.assertEqual(matrix.get(self.student, first).tardy, 0)
+        self.assertEqual(matrix.get(self.student2.id, first).tardy, 1)
+        self.assertEqual(matrix.total(self.year).tardy, 2)
+        self.assertEqual(matrix.total(first).count(code="A"), 1)
+
+    def test_grade_report_data(self):
+        from ecwsp.schedule.models import MarkingPeriod
+        from ecwsp.sis.report_data import GradeReportData
+        mp = MarkingPeriod.objects.create(name="Q1", shortname="Q1", school_year=self.year,
+            start_date=date(2010,9,1), end_date=date(2010,11,1))
+        data = GradeReportData([self.student], date(2011,5,1), MarkingPeriod.objects.all())
+        counts = data.get_attendance(self.student, mp.start_date, mp.end_date)
+        self.assertEqual((counts.absent, counts.absent_unexcused, counts.tardy), (1, 0, 1))
+
+
+class AttendanceRollupTest(TestCase):
+    def setUp(self):
+        self.student = Student.objects.create(fname="Joe", lname="Student", username="jstudent")
+        self.absent = AttendanceStatus.objects.create(name="Absent", code="A", absent=True)
+        self.tardy = AttendanceStatus.objects.create(name="Tardy", code="T", tardy=True)
+
+    def get_day(self, day):
+        return StudentAttendanceDay.objects.get(student=self.student, date=day)
+
+    def test_signals(self):
+        attendance = StudentAttendance.objects.create(student=self.student, date=date(2010,9,6), status=self.absent)
+        self.assertEqual(self.get_day(date(2010,9,6)).absent_unexcused, 1)
+
+        # Moving a record recounts both days
+        attendance.date = date(2010,9,7)
+        attendance.save()
+        self.assertFalse(StudentAttendanceDay.objects.filter(date=date(2010,9,6)).exists())
+        self.assertEqual(self.get_day(date(2010,9,7)).absent, 1)
+
+        self.absent.excused = True
+        self.absent.save()
+        self.assertEqual(self.get_day(date(2010,9,7)).absent_unexcused, 0)
+
+        attendance.delete()
+        self.assertFalse(StudentAttendanceDay.objects.exists())
+
+    def test_rebuild(self):
+        StudentAttendance.objects.create(student=self.student, date=date(2010,9,6), status=self.absent)
+        StudentAttendance.objects.create(student=self.student, date=date(2010,9,6), status=self.tardy)
+        StudentAttendanceDay.objects.all().update(absent=0, tardy=0)
+        self.assertEqual(rebuild_attendance_days(), (1, 0))
+        day = self.get_day(date(2010,9,6))
+        self.assertEqual((day.records, day.absent, day.tardy), (2, 1, 1))
+
+    def test_bulk_save(self):
+        user = User.objects.create_user('dburke', 'dburke@example.com', 'aa')
+        present = AttendanceStatus.objects.create(name="Present", code="P")
+        student2 = Student.objects.create(fname="Jane", lname="Student", username="jstudent2")
+        saved = save_student_attendance([
+            StudentAttendance(student=self.student, date=date(2010,9,6), status=self.absent),
+            StudentAttendance(student=student2, date=date(2010,9,6), status=present),
+        ], user=user)
+        self.assertEqual([attendance.student for attendance in saved], [self.student])
+        self.assertEqual(saved[0].id, StudentAttendance.objects.get().id)
+        self.assertEqual(self.get_day(date(2010,9,6)).absent, 1)
+        self.assertEqual(LogEntry.objects.filter(user=user, object_id=str(saved[0].id)).count(), 1)
@@ -19,10 +19,9 @@
 from django.shortcuts import render_to_response, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test, permission_required
-from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
-from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError
 from django.db.models import Q, Sum, Count, get_model
 from django.forms.models import BaseModelFormSet, modelformset_factory
 from django.forms.formsets import formset_factory
@@ -31,7 +30,8 @@ from django.template import RequestContext
 
 from models import *
 from forms import *
-from ecwsp.schedule.models import Course
+from aggregation import AttendanceMatrix
+from ecwsp.schedule.models import Course, CourseEnrollment
 from ecwsp.sis.models import Student, UserPreference, Faculty
 from ecwsp.sis.helper_functions import Struct
 from ecwsp.administration.models import Template
@@ -87,59 +87,59 @@ def teacher_attendance(request, course=None):
                     "the course is not set to the current marking period.')
             return HttpResponseRedirect(reverse('admin:index'))
         course = courses[0]
-    students = course.get_attendance_students()
+    students = list(course.get_attendance_students())
+    student_ids = [student.id for student in students]
+    
+    # Attendance already taken today and enrollment notes, for the whole roster
+    marked = {}
+    for attendance in StudentAttendance.objects.filter(date=today, student__in=student_ids).select_related('status'):
+        marked.setdefault(attendance.student_id, attendance)
+    enroll_notes = {}
+    for user_id, note in CourseEnrollment.objects.filter(course=course, user__in=student_ids).values_list('user', 'attendance_note'):
+        enroll_notes.setdefault(user_id, note)
+    unmarked = [student for student in students if student.id not in marked]
     
     readonly = False
     msg = ""
-    if AttendanceLog.objects.filter(date=datetime.date.today(), user=request.user, course=course).count() > 0:
+    if AttendanceLog.objects.filter(date=today, user=request.user, course=course).exists():
         readonly = True
     AttendanceFormset = modelformset_factory(
         StudentAttendance, form=StudentAttendanceForm,
-        extra=students.exclude(student_attn__date=datetime.date.today()).count())
+        formset=BaseStudentAttendanceFormSet,
+        extra=len(unmarked))
     
     if request.method == 'POST':
-        formset = AttendanceFormset(request.POST)
+        formset = AttendanceFormset(request.POST, students=students)
         if formset.is_valid():
-            for form in formset.forms:
-                object = form.save()
-                LogEntry.objects.log_action(
-                    user_id         = request.user.pk, 
-                    content_type_id = ContentType.objects.get_for_model(object).pk,
-                    object_id       = object.pk,
-                    object_repr     = unicode(object), 
-                    action_flag     = ADDITION
-                )
-            AttendanceLog(user=request.user, date=datetime.date.today(), course=course).save()
-            messages.success(request, 'Attendance recorded')
-            return HttpResponseRedirect(reverse('admin:index'))
-        else:
-            msg = "\nDuplicate entry detected! It's possible someone else is entering " \
-                "attendance for these students at the same time. Please confirm attendance." \
-                " If problems persist contact an administrator."
+            try:
+                save_student_attendance(formset.save(commit=False), user=request.user)
+            except IntegrityError:
+                # Someone else entered some of these students since validation
+                pass
+            else:
+                AttendanceLog(user=request.user, date=today, course=course).save()
+                messages.success(request, 'Attendance recorded')
+                return HttpResponseRedirect(reverse('admin:index'))
+        msg = "\nDuplicate entry detected! It's possible someone else is entering " \
+            "attendance for these students at the same time. Please confirm attendance." \
+            " If problems persist contact an administrator."
     
     initial = []
-    enroll_notes = []
     for student in students:
-        attendances = StudentAttendance.objects.filter(date=datetime.date.today(), student=student)
-        if attendances.count():
+        if student.id in marked:
             student.marked = True
-            student.status = attendances[0].status
-            student.notes = attendances[0].notes
+            student.status = marked[student.id].status
+            student.notes = marked[student.id].notes
         else:
             student.marked = False
-            initial.append({'student': student.id, 'status': None, 'notes': None, 'date': datetime.date.today() })
-            note = student.courseenrollment_set.filter(course=course)[0].attendance_note
-            if note: enroll_notes.append(unicode(note))
-            else: enroll_notes.append("")
-    formset = AttendanceFormset(initial=initial, queryset=StudentAttendance.objects.none())
+            initial.append({'student': student.id, 'status': None, 'notes': None, 'date': today })
+    formset = AttendanceFormset(initial=initial, queryset=StudentAttendance.objects.none(), students=students)
     
     # add notes to each form
-    i = 0
-    form_students = students.exclude(student_attn__date=datetime.date.today())
-    for form in formset.forms:
-        form.enroll_note = enroll_notes[i]
-        form.student_display = form_students[i]
-        i += 1
+    for form, student in zip(formset.forms, unmarked):
+        note = enroll_notes.get(student.id)
+        form.enroll_note = unicode(note) if note else ""
+        form.student_display = student
     
     # add form to each student, so we can use for student in students in the template
     i = 0
@@ -200,25 +200,32 @@ def daily_attendance_report(adate, private_notes=False, type="odt", request=None
     
     active_year = SchoolYear.objects.get(active_year=True)
     active_year_dates = (active_year.start_date, active_year.end_date)
+    matrix = AttendanceMatrix([active_year_dates], students=students)
+    statuses = AttendanceStatus.objects.exclude(name="Present")
+    # {(grade level id, status id): number of students}
+    day_counts = {}
+    for row in attendance.values('student__year', 'status').annotate(number=Count('id')).order_by():
+        day_counts[(row['student__year'], row['status'])] = row['number']
     
     for year in GradeLevel.objects.all():
-        attns = attendance.filter(student__year__id=year.id)
+        attns = attendance.filter(student__year__id=year.id).select_related('status')
         for attn in attns:
+            counts = matrix.get(attn.student_id, active_year_dates)
             if attn.status.absent:
-                attn.total = StudentAttendance.objects.filter(student=attn.student, status__absent=True, status__half=False, date__range=active_year_dates).count()
-                halfs = StudentAttendance.objects.filter(student=attn.student, status__absent=True, status__half=True,date__range=active_year_dates).count() / 2 
+                attn.total = counts.count(absent=True, half=False)
+                halfs = counts.count(absent=True, half=True) / 2 
                 attn.total += (float(halfs)/2)
             elif attn.status.tardy:
-                attn.total = StudentAttendance.objects.filter(student=attn.student, status__tardy=True, date__range=active_year_dates).count()
+                attn.total = counts.tardy
             else:
-                attn.total = StudentAttendance.objects.filter(student=attn.student, status=attn.status, date__range=active_year_dates).count()
+                attn.total = counts.by_status.get(attn.status_id, 0)
         data['absences_' + str(year.id)] = attns
         
         attn_list = ""
-        for status in AttendanceStatus.objects.exclude(name="Present"):
-            attn = StudentAttendance.objects.filter(status=status, date=adate, student__year__id=year.id)
-            if attn.count() > 0:
-                attn_list += unicode(status.name) + " " + unicode(attn.count()) + ",  " 
+        for status in statuses:
+            count = day_counts.get((year.id, status.id), 0)
+            if count > 0:
+                attn_list += unicode(status.name) + " " + unicode(count) + ",  " 
         if len(attn_list) > 3: attn_list = attn_list[:-3]
         data['stat_' + str(year.id)] = attn_list
         
@@ -350,6 +357,7 @@ def course_attendance(request, course_id, for_date=datetime.date.today):
 @permission_required('sis.reports') 
 def attendance_report(request):
     from ecwsp.sis.xlsReport import xlsReport
+    from ecwsp.sis.stream_report import StreamingReport
     
     form = AttendanceReportForm()
     daily_form = AttendanceDailyForm()
@@ -395,55 +403,38 @@ def attendance_report(request):
                     titles.append("Student")
                     titles.append("Total Absences (not half)")
                     titles.append("Total Tardies")
-                    for status in AttendanceStatus.objects.exclude(name="Present"):
+                    statuses = AttendanceStatus.objects.exclude(name="Present")
+                    for status in statuses:
                         titles.append(status)
                     pref = UserPreference.objects.get_or_create(user=request.user)[0]
-                    students_absent = students.filter(
-                        student_attn__status__absent=True,
-                        student_attn__status__half=False,
-                        student_attn__in=attendances).annotate(abs=Count('student_attn'))
-                    students_tardy = students.filter(
-                        student_attn__status__tardy=True,
-                        student_attn__in=attendances).annotate(abs=Count('student_attn'))
-                    attn_tardy = attendances.filter(status__tardy=True)
-                    
-                    students_each_total = {}
-                    for status in AttendanceStatus.objects.exclude(name="Present"):
-                        students_each_total[status.name] = students.filter(
-                            student_attn__status=status,
-                            student_attn__in=attendances).annotate(abs=Count('student_attn'))
+                    dates = form.get_dates()
+                    matrix = AttendanceMatrix([dates], students=students, attendance=attendances)
+                    additional_fields = pref.get_additional_student_fields_resolver(students)
+                    titles += additional_fields.titles
                     
-                    for student in students:
-                        add = True
-                        row = []
-                        row.append(student)
-                        if student in students_absent:
-                            total_absent = students_absent.filter(id=student.id)[0].abs
-                        else:
-                            total_absent = 0
-                        
-                        if student in students_tardy:
-                            total_tardy = students_tardy.filter(id=student.id)[0].abs
-                        else:
-                            total_tardy = 0
-                            
-                        if (total_absent >= form.cleaned_data['filter_total_absences'] and
-                            total_tardy >= form.cleaned_data['filter_total_tardies']):
-                            row.append( total_absent )
-                            row.append( total_tardy )
-                            for status in AttendanceStatus.objects.exclude(name="Present"):
-                                count = 0
-                                if student in students_each_total[status.name]:
-                                    count = students_each_total[status.name].filter(id=student.id)[0].abs
-                                row.append(count)
-                                if (form.cleaned_data['filter_status'] == status and
-                                    attendances.filter(
-                                        student=student,
-                                        status=status).count() < form.cleaned_data['filter_count']):
-                                    add = False
-                            pref.get_additional_student_fields(row, student, students, titles)
-                            if add: data.append(row)    
-                    report = xlsReport(data, titles, "attendance_report.xls", heading="Attendance Report")
+                    def student_rows():
+                        for student in students:
+                            add = True
+                            row = []
+                            row.append(student)
+                            counts = matrix.get(student, dates)
+                            total_absent = counts.count(absent=True, half=False)
+                            total_tardy = counts.tardy
+                                
+                            if (total_absent >= form.cleaned_data['filter_total_absences'] and
+                                total_tardy >= form.cleaned_data['filter_total_tardies']):
+                                row.append( total_absent )
+                                row.append( total_tardy )
+                                for status in statuses:
+                                    count = counts.by_status.get(status.id, 0)
+                                    row.append(count)
+                                    if (form.cleaned_data['filter_status'] == status and
+                                        count < form.cleaned_data['filter_count']):
+                                        add = False
+                                row += additional_fields.cells(student)
+                                if add: yield row
+                    report = StreamingReport("attendance_report", pref.get_format(type="spreadsheet"))
+                    report.add_sheet(student_rows(), titles, heading="Attendance Report")
                     
                 elif 'perfect_attendance' in request.POST:
                     form = AttendanceReportForm(request.POST)
@@ -460,14 +451,11 @@ def attendance_report(request):
                                     'lookup_form': lookup_form}, RequestContext(request, {}),)
                         
                         students = Student.objects.all()
-                        perfect_students = []
                         if not form.cleaned_data['include_deleted']:
                             students = students.filter(inactive=False)
-                        for student in students:
-                            total_absent = attendances.filter(status__absent=True, student=student).count()
-                            total_tardy = attendances.filter(status__tardy=True, student=student).count()
-                            if not total_absent and not total_tardy:
-                                perfect_students.append(student)
+                        missed_days = StudentAttendanceDay.objects.filter(
+                            date__range=form.get_dates()).filter(Q(absent__gt=0) | Q(tardy__gt=0))
+                        perfect_students = list(students.exclude(id__in=missed_days.values('student')))
                         
                         format = UserPreference.objects.get_or_create(user=request.user)[0].get_format(type="document")
                         return pod_report_all(template, students=perfect_students, format=format)
@@ -500,7 +488,8 @@ def attendance_report(request):
                     data.append([])
                     
                     students = Student.objects.filter(inactive=False).count()
-                    absents = attendances.filter(status__absent=True).count()
+                    absents = StudentAttendanceDay.objects.filter(
+                        date__range=form.get_dates()).aggregate(Sum('absent'))['absent__sum'] or 0
                     if form.cleaned_data['marking_period']:
                         days = 0
                         for mp in form.cleaned_data['marking_period']:
@@ -0,0 +1,197 @@
+""" Bulk benchmark GPA calculation.
+
+benchmark_ruled_calculate_grade_for_courses queries Aggregates one marking
+period, course and rule category at a time for a single student.
+BenchmarkGPAData loads the courses, marking periods, calculation rules and
+category Aggregates of a set of students in a few queries, then repeats the
+same arithmetic in memory and in the same order, so results are identical.
+Courses of years without benchmark grades use ecwsp.sis.gpa.GPAData.
+"""
+from ecwsp.benchmark_grade.models import Aggregate
+from ecwsp.benchmark_grade.recalculation import RuleData
+from ecwsp.schedule.models import Course, CourseEnrollment, MarkingPeriod, OmitCourseGPA, OmitYearGPA
+from ecwsp.sis.gpa import GPAData
+
+from decimal import Decimal, ROUND_HALF_UP
+import logging
+
+# TODO: Decimal places configuration value
+DECIMAL_PLACES = 2
+
+
+class BenchmarkGPAData(object):
+    """ Every row needed to calculate benchmark GPAs of a set of students """
+    def __init__(self, students, marking_period=None, year=None):
+        """ Courses counted for each student are those ecwsp.sis.gpa.compute_gpas
+        hands the single student calculation for this marking period, year or,
+        with neither, for the cumulative GPA """
+        self.students = list(students)
+        student_ids = [student.id for student in self.students]
+
+        enrollments = CourseEnrollment.objects.filter(user__in=student_ids, course__graded=True)
+        if marking_period is not None:
+            enrollments = enrollments.filter(course__marking_period=marking_period)
+        elif year is not None:
+            enrollments = enrollments.filter(course__marking_period__school_year=year)
+        else:
+            enrollments = enrollments.filter(course__marking_period__show_reports=True)
+        # {student_id: set(course_id)}
+        self.student_courses = {}
+        for student_id, course_id in enrollments.values_list('user_id', 'course_id').distinct():
+            self.student_courses.setdefault(student_id, set()).add(course_id)
+        course_ids = set()
+        for courses in self.student_courses.values():
+            course_ids |= courses
+
+        self.courses = Course.objects.in_bulk(list(course_ids))
+        # {course_id: set(marking_period_id)}
+        self.course_mps = dict([(course_id, set()) for course_id in course_ids])
+        for course_id, mp_id in Course.marking_period.through.objects.filter(
+                course__in=course_ids).values_list('course_id', 'markingperiod_id'):
+            self.course_mps[course_id].add(mp_id)
+        mp_ids = set()
+        for mps in self.course_mps.values():
+            mp_ids |= mps
+        self.marking_periods = MarkingPeriod.objects.select_related('school_year').in_bulk(list(mp_ids))
+        # Marking periods counted, the ones the enrollments were filtered on
+        if marking_period is not None:
+            self.counted_mp_ids = set([marking_period.id])
+        elif year is not None:
+            self.counted_mp_ids = set([mp.id for mp in self.marking_periods.values() if mp.school_year_id == year.id])
+        else:
+            self.counted_mp_ids = set([mp.id for mp in self.marking_periods.values() if mp.show_reports])
+
+        if year is None:
+            omit_courses = set(OmitCourseGPA.objects.filter(
+                student__in=student_ids).values_list('student_id', 'course_id'))
+            omit_years = set()
+            if marking_period is None:
+                omit_years = set(OmitYearGPA.objects.filter(
+                    student__in=student_ids).values_list('student_id', 'year_id'))
+            for student_id, courses in self.student_courses.items():
+                for course_id in list(courses):
+                    years = set([self.marking_periods[mp_id].school_year_id for mp_id in self.course_mps[course_id]])
+                    if (student_id, course_id) in omit_courses or \
+                            [year_id for year_id in years if (student_id, year_id) in omit_years]:
+                        courses.remove(course_id)
+
+        # {(student_id, course_id, category_id, marking_period_id): cached_value}
+        self.aggregates = {}
+        aggregates = Aggregate.objects.filter(
+            student__in=student_ids,
+            course__in=course_ids,
+            marking_period__in=self.counted_mp_ids,
+        ).exclude(category=None).values_list('student_id', 'course_id', 'category_id', 'marking_period_id', 'cached_value')
+        for student_id, course_id, category_id, mp_id, value in aggregates.order_by('id'):
+            self.aggregates.setdefault((student_id, course_id, category_id, mp_id), value)
+
+        # {school_year_id: RuleData}
+        self.rules = {}
+        self.gpa_data = None
+
+    def get_rule(self, school_year):
+        from ecwsp.benchmark_grade.utility import benchmark_find_calculation_rule
+        if school_year.id not in self.rules:
+            self.rules[school_year.id] = RuleData(benchmark_find_calculation_rule(school_year))
+        return self.rules[school_year.id]
+
+    def get_legacy_grade(self, student_id, course_id, marking_period, date_report):
+        """ Same as Student._calculate_grade_for_single_course, (grade, credit) or None """
+        if self.gpa_data is None:
+            self.gpa_data = GPAData([student.id for student in self.students])
+        return self.gpa_data.grade_for_single_course(student_id, course_id, marking_period, date_report)
+
+    def calculate_gpa(self, student, marking_period=None, date_report=None):
+        """ Same as benchmark_ruled_calculate_grade_for_courses
+        marking_period: restricts GPA calculation to a _single_ marking period
+        date_report: restricts GPA calculation to marking periods _ending_ on or before a date """
+        course_ids = sorted(self.student_courses.get(student.id, ()))
+        if marking_period is not None:
+            mps = [self.marking_periods.get(marking_period.id, marking_period)]
+        else:
+            mp_ids = set()
+            for course_id in course_ids:
+                mp_ids |= self.course_mps[course_id] & self.counted_mp_ids
+            mps = [self.marking_periods[mp_id] for mp_id in mp_ids]
+            if date_report is not None:
+                mps = [mp for mp in mps if mp.end_date <= date_report]
+        # MarkingPeriod's ordering
+        mps.sort(key=lambda mp: mp.start_date, reverse=True)
+
+        student_numer = student_denom = float(0)
+        for mp in [mp for mp in mps if mp.school_year.benchmark_grade]:
+            mp_numer = mp_denom = float(0)
+            rule = self.get_rule(mp.school_year)
+            mp_courses = [self.courses[course_id] for course_id in course_ids if mp.id in self.course_mps[course_id]]
+            for course in mp_courses:
+                # IMO, Course.credits should be required, and we should not treat None as 0.
+                if course.credits is None:
+                    continue
+                # Handle per-course categories according to the calculation rule
+                course_numer = course_denom = float(0)
+                for category_id, weight in rule.course_categories(course.department_id):
+                    value = self.aggregates.get((student.id, course.id, category_id, mp.id))
+                    if value is not None:
+                        # simplified normalization; assumes minimum is 0
+                        normalized_value = value / rule.points_possible
+                        course_numer += float(weight) * float(normalized_value)
+                        course_denom += float(weight)
+                if course_denom > 0:
+                    credits = float(course.credits) / len(self.course_mps[course.id])
+                    mp_numer += credits * course_numer / course_denom
+                    mp_denom += credits
+
+            # Handle aggregates of categories that are counted as courses
+            # Categories as courses shouldn't increase the weight of a marking period!
+            mp_denom_before_categories = mp_denom
+            for category_id, department_ids in rule.category_as_course_rows:
+                category_numer = category_denom = float(0)
+                for course in mp_courses:
+                    if course.department_id not in department_ids or course.credits is None:
+                        continue
+                    credits = float(course.credits) / len(self.course_mps[course.id])
+                    value = self.aggregates.get((student.id, course.id, category_id, mp.id))
+                    if value is not None:
+                        # simplified normalization; assumes minimum is 0
+                        normalized_value = value / rule.points_possible
+                        category_numer += credits * float(normalized_value)
+                        category_denom += credits
+                if category_denom > 0:
+                    mp_numer += category_numer / category_denom
+                    mp_denom += 1
+
+            if mp_denom > 0:
+                mp_numer *= 4 # HARD CODED 4.0 SCALE!!!
+                student_numer += mp_numer / mp_denom * mp_denom_before_categories
+                student_denom += mp_denom_before_categories
+
+        # Handle non-benchmark-grade years. Calculation rules don't apply.
+        legacy_mp_ids = set([mp.id for mp in mps if not mp.school_year.benchmark_grade])
+        for course_id in course_ids:
+            course = self.courses[course_id]
+            if course.credits is None or not legacy_mp_ids & self.course_mps[course_id]:
+                continue
+            result = self.get_legacy_grade(student.id, course_id, marking_period, date_report)
+            if result is None:
+                logging.warning('Legacy course grade calculation failed for student {}, course {}, marking_period {}, date_report {}'.format(
+                    student.id, course, marking_period, date_report))
+                continue
+            grade, credits = result
+            student_numer += grade * credits
+            student_denom += credits
+
+        if student_denom > 0:
+            return Decimal(student_numer / student_denom).quantize(Decimal(10) ** (-1 * DECIMAL_PLACES), ROUND_HALF_UP)
+        else:
+            return 'N/A'
+
+
+def benchmark_compute_gpas(students, marking_period=None, date_report=None, year=None):
+    """ benchmark_calculate_grade_for_courses for many students at once
+    Returns {student.id: Decimal or "N/A"} """
+    students = list(students)
+    data = BenchmarkGPAData(students, marking_period, year)
+    gpas = {}
+    for student in students:
+        gpas[student.id] = data.calculate_gpa(student, marking_period, date_report)
+    return gpas
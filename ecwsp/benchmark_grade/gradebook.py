@@ -0,0 +1,174 @@
+""" Everything the gradebook page shows, from a few queries.
+
+The page is a student x item (or demonstration) matrix of marks, with each
+student's average and Standards counts and the counts of each Standards item.
+Marks missing from the matrix, for students who enrolled after an item was
+created, are bulk created.
+"""
+from django.db.models import Max, Count
+
+from ecwsp.benchmark_grade.models import Aggregate, Category, Demonstration, Mark
+from ecwsp.benchmark_grade.portal import students_grades_changed
+from ecwsp.benchmark_grade.recalculation import CourseAggregates
+from ecwsp.benchmark_grade.utility import benchmark_find_calculation_rule, gradebook_format_average
+
+# TC's column and row of counts
+# TODO: don't hardcode
+STANDARDS_CATEGORY = 'Standards'
+PASSING_GRADE = 3
+
+
+def _counts_text(passing, total):
+    if total:
+        return '{} / {} ({:.0f}%)'.format(passing, total, 100.0 * passing / total)
+    return None
+
+
+class Gradebook(object):
+    def __init__(self, course, students, items, allow_duplicates=False):
+        """ course: Course of the gradebook
+        students: Students shown
+        items: Item queryset shown
+        allow_duplicates: show every mark even when a student has several for
+        the same item, instead of raising an exception """
+        self.course = course
+        self.item_queryset = items
+        self.items = list(items.select_related('category', 'benchmark').order_by('id'))
+        self.students = list(students)
+        self.student_ids = [student.id for student in self.students]
+        item_ids = [item.id for item in self.items]
+        items_by_id = dict([(item.id, item) for item in self.items])
+        for item in self.items:
+            item.demonstrations = []
+        for demonstration in Demonstration.objects.filter(item__in=item_ids).order_by('id'):
+            demonstration.item = items_by_id[demonstration.item_id]
+            demonstration.item.demonstrations.append(demonstration)
+        # (item_id, demonstration_id or None) of each column
+        self.columns = []
+        for item in self.items:
+            if item.demonstrations:
+                self.columns += [(item.id, demonstration.id) for demonstration in item.demonstrations]
+            else:
+                self.columns.append((item.id, None))
+        self.decimal_places = None
+
+        cells = self._load_marks(item_ids)
+        missing = []
+        for student_id in self.student_ids:
+            for item_id, demonstration_id in self.columns:
+                if (student_id, item_id, demonstration_id) not in cells:
+                    # maybe student enrolled after assignments were created
+                    missing.append(Mark(item_id=item_id, demonstration_id=demonstration_id, student_id=student_id))
+        if missing:
+            Mark.objects.bulk_create(missing)
+            students_grades_changed([mark.student_id for mark in missing])
+            cells = self._load_marks(item_ids)
+        for student in self.students:
+            student.marks = []
+            for item_id, demonstration_id in self.columns:
+                marks = cells.get((student.id, item_id, demonstration_id), [])
+                if len(marks) > 1 and not allow_duplicates:
+                    # Yikes, there are multiple marks per student per item. Stop loading the gradebook now.
+                    raise Exception('Multiple marks per student per item.')
+                student.marks += marks
+
+    def _load_marks(self, item_ids):
+        """ {(student_id, item_id, demonstration_id): [mark, ...]} """
+        cells = {}
+        marks = Mark.objects.filter(item__in=item_ids, student__in=self.student_ids).order_by('id')
+        for mark in marks:
+            cells.setdefault((mark.student_id, mark.item_id, mark.demonstration_id), []).append(mark)
+        return cells
+
+    def get_decimal_places(self):
+        if self.decimal_places is None:
+            school_year = self.course.marking_period.all()[0].school_year
+            self.decimal_places = benchmark_find_calculation_rule(school_year).decimal_places
+        return self.decimal_places
+
+    def set_averages(self):
+        """ student.average, the stored course average, calculating the missing
+        ones with the category aggregates they average """
+        key = (self.course.id, None, None)
+        averages = {}
+        duplicates = set()
+        for student_id, value, substitution in Aggregate.objects.filter(
+                student__in=self.student_ids, course=self.course, category=None,
+                marking_period=None).values_list('student_id', 'cached_value', 'cached_substitution'):
+            if student_id in averages:
+                duplicates.add(student_id)
+            averages[student_id] = (value, substitution)
+        missing = [student for student in self.students if student.id not in averages or student.id in duplicates]
+        if missing:
+            course_aggregates = CourseAggregates(self.course, missing)
+            if course_aggregates.rule is not None:
+                keys = [(self.course.id, category_id, None) for category_id, weight in
+                        course_aggregates.rule.course_categories(self.course.department_id)]
+                course_aggregates.recalculate(keys + [key])
+                for student in missing:
+                    averages[student.id] = course_aggregates.get(student.id, key)
+        for student in self.students:
+            value, substitution = averages.get(student.id, (None, None))
+            if substitution is None and value is not None:
+                student.average = gradebook_format_average(value, None, None, self.get_decimal_places())
+            else:
+                student.average = gradebook_format_average(value, substitution, None, None)
+
+    def set_filtered_averages(self, category, marking_period):
+        """ student.filtered_average over the items shown only, like
+        gradebook_get_average with items. Nothing is stored """
+        course_aggregates = CourseAggregates(self.course, self.students, self.item_queryset)
+        key = (self.course.id, getattr(category, 'id', None), getattr(marking_period, 'id', None))
+        for student in self.students:
+            student.filtered_average = None
+            if course_aggregates.rule is not None:
+                value, substitution = course_aggregates.get(student.id, key)
+                if substitution is None and value is not None:
+                    student.filtered_average = gradebook_format_average(
+                        value, None, category, self.get_decimal_places())
+                else:
+                    student.filtered_average = gradebook_format_average(value, substitution, category, None)
+
+    def set_standards_counts(self, filtered=False):
+        """ student.standards_counts, and student.filtered_standards_counts when
+        filtered: how many Standards items a student passed over how many have
+        a mark. item.marks_counts: the same for each Standards item over students """
+        standards = list(Category.objects.filter(name=STANDARDS_CATEGORY)[:1])
+        shown_ids = set([item.id for item in self.items])
+        # {student_id: [passing, total, filtered passing, filtered total]}
+        counts = dict([(student_id, [0, 0, 0, 0]) for student_id in self.student_ids])
+        if standards:
+            best_marks = Mark.objects.filter(
+                item__course=self.course,
+                item__category=standards[0],
+                student__in=self.student_ids,
+            ).values('student', 'item').annotate(best_mark=Max('mark')).order_by()
+            for row in best_marks:
+                if row['best_mark'] is None:
+                    continue
+                student_counts = counts[row['student']]
+                passing = row['best_mark'] >= PASSING_GRADE
+                student_counts[0] += passing
+                student_counts[1] += 1
+                if row['item'] in shown_ids:
+                    student_counts[2] += passing
+                    student_counts[3] += 1
+        for student in self.students:
+            passing, total, filtered_passing, filtered_total = counts[student.id]
+            student.standards_counts = _counts_text(passing, total)
+            if filtered:
+                student.filtered_standards_counts = _counts_text(filtered_passing, filtered_total)
+
+        standards_items = [item.id for item in self.items if standards and item.category_id == standards[0].id]
+        totals = {}
+        passing = {}
+        if standards_items:
+            marks = Mark.objects.filter(item__in=standards_items).exclude(mark=None)
+            totals = dict(marks.values_list('item').annotate(number=Count('id')).order_by())
+            passing = dict(marks.filter(mark__gte=PASSING_GRADE).values_list('item').annotate(
+                number=Count('id')).order_by())
+        for item in self.items:
+            if item.id in standards_items:
+                item.marks_counts = _counts_text(passing.get(item.id, 0), totals.get(item.id, 0))
+            else:
+                item.marks_counts = 'N/A'
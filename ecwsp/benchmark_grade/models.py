@@ -17,11 +17,15 @@
 #   MA 02110-1301, USA.
 
 from django.db import models
-from django.db.models import Min, Max, Sum, Avg
+from django.db.models import Min, Max, Sum, Avg, Count
+from django.db.models.signals import post_save, post_delete
 #from django.contrib.localflavor.us.models import *
 from django.conf import settings
 from decimal import Decimal
 
+from ecwsp.schedule.models import CourseEnrollment
+from ecwsp.benchmark_grade.portal import mark_changed, aggregate_changed, item_changed, enrollment_changed
+
 from django.core.exceptions import ImproperlyConfigured
 if not 'ecwsp.benchmarks' in settings.INSTALLED_APPS:
     raise ImproperlyConfigured('benchmark_grade depends on benchmarks but it is not in installed apps')
@@ -183,48 +187,87 @@ class Aggregate(models.Model):
     marking_period = models.ForeignKey('schedule.MarkingPeriod', blank=True, null=True)
     points_possible = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True)
 
+    # Statistics of the marks averaged into cached_value, stored with it so
+    # max(), min() and mean() don't query. marks_count is None until calculated
+    marks_count = models.IntegerField(blank=True, null=True)
+    marks_sum = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True)
+    marks_points_possible = models.DecimalField(max_digits=12, decimal_places=2, blank=True, null=True)
+    normalized_max = models.FloatField(blank=True, null=True)
+    normalized_min = models.FloatField(blank=True, null=True)
+    normalized_mean = models.FloatField(blank=True, null=True)
+    STATS_FIELDS = ('marks_count', 'marks_sum', 'marks_points_possible', 'normalized_max', 'normalized_min', 'normalized_mean')
+
+    def calculate_stats(self):
+        """ Set the statistics from the student's marks in the items of this
+        aggregate's course and category (and marking period, if any) in one
+        query. Course averages and categories as courses have no marks of
+        their own. Does not save """
+        self.marks_count = 0
+        self.marks_sum = self.marks_points_possible = None
+        self.normalized_max = self.normalized_min = self.normalized_mean = None
+        if self.course_id is None or self.category_id is None:
+            return
+        marks = Mark.objects.filter(item__course=self.course_id, item__category=self.category_id,
+            student=self.student_id).exclude(mark=None)
+        if self.marking_period_id is not None:
+            marks = marks.filter(item__marking_period=self.marking_period_id)
+        stats = marks.aggregate(Count('id'), Sum('mark'), Sum('item__points_possible'),
+            Max('normalized_mark'), Min('normalized_mark'), Avg('normalized_mark'))
+        self.marks_count = stats['id__count']
+        if self.marks_count:
+            self.marks_sum = stats['mark__sum']
+            self.marks_points_possible = stats['item__points_possible__sum']
+            self.normalized_max = stats['normalized_mark__max']
+            self.normalized_min = stats['normalized_mark__min']
+            self.normalized_mean = stats['normalized_mark__avg']
+
+    def get_stats(self):
+        """ Calculate and store the statistics if they never were """
+        if self.marks_count is None:
+            self.calculate_stats()
+            if self.pk is not None:
+                Aggregate.objects.filter(id=self.pk).update(
+                    **dict([(field, getattr(self, field)) for field in self.STATS_FIELDS]))
+
     def max(self):
         if self.points_possible is None:
             return None
-        items = Item.objects.filter(course=self.course, category=self.category, marking_period=self.marking_period)
-        marks = Mark.objects.filter(item__in=items, student=self.student).exclude(normalized_mark=None)
-        if not marks:
+        self.get_stats()
+        if self.normalized_max is None:
             return None
-        highest = marks.aggregate(Max('normalized_mark'))['normalized_mark__max']
-        highest *= self.points_possible
-        return highest
+        return Decimal(self.normalized_max) * self.points_possible
 
     def min(self):
         if self.points_possible is None:
             return None
-        items = Item.objects.filter(course=self.course, category=self.category, marking_period=self.marking_period)
-        marks = Mark.objects.filter(item__in=items, student=self.student).exclude(normalized_mark=None)
-        if not marks:
+        self.get_stats()
+        if self.normalized_min is None:
             return None
-        lowest = marks.aggregate(Min('normalized_mark'))['normalized_mark__min']
-        lowest *= self.points_possible
-        return lowest
+        return Decimal(self.normalized_min) * self.points_possible
 
     def mean(self, normalize=False):
         if self.points_possible is None:
             return None
-        items = Item.objects.filter(course=self.course, category=self.category, marking_period=self.marking_period)
+        self.get_stats()
         if normalize: # mark should always == normalized_mark, but meh
-            marks = Mark.objects.filter(item__in=items, student=self.student).exclude(normalized_mark=None)
-        else:
-            marks = Mark.objects.filter(item__in=items, student=self.student).exclude(mark=None)
-        if not marks:
-            return None
-        if normalize:
-            mean = Decimal(marks.aggregate(Avg('normalized_mark'))['normalized_mark__avg']) # angry that the DB/ORM returns a float
+            if self.normalized_mean is None:
+                return None
+            mean = Decimal(self.normalized_mean) # angry that the DB/ORM returns a float
         else:
-            numerator = marks.aggregate(Sum('mark'))['mark__sum']
-            denominator = marks.aggregate(Sum('item__points_possible'))['item__points_possible__sum']
-            if denominator == 0:
+            if not self.marks_count or not self.marks_points_possible:
                 return None
-            mean = numerator / denominator
+            mean = self.marks_sum / self.marks_points_possible
         mean *= self.points_possible
         return mean
-        
+
     def __unicode__(self):
         return self.name # not useful
+
+post_save.connect(mark_changed, sender=Mark)
+post_delete.connect(mark_changed, sender=Mark)
+post_save.connect(aggregate_changed, sender=Aggregate)
+post_delete.connect(aggregate_changed, sender=Aggregate)
+post_save.connect(item_changed, sender=Item)
+post_delete.connect(item_changed, sender=Item)
+post_save.connect(enrollment_changed, sender=CourseEnrollment)
+post_delete.connect(enrollment_changed, sender=CourseEnrollment)
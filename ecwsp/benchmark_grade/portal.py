@@ -0,0 +1,86 @@
+""" Cached grade pages of the student and family portals.
+
+Students and parents load the same grade summary and course details over and
+over, most of all the night grades are released. What a page shows is built
+once and kept in a Django cache under the student's current version, so
+repeated hits don't touch the grade tables. Saving or deleting a Mark or
+Aggregate of a student, an Item the student has marks in or an enrollment of
+the student gives them a new version, and their old pages are never read
+again. Writes that don't send signals (bulk_create, update) call
+students_grades_changed themselves.
+
+Pages are only cached when settings.BENCHMARK_PORTAL_CACHE names a cache in
+CACHES shared by every worker process. A cache local to one process would
+keep showing old grades after another process saved new ones.
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+
+import uuid
+
+
+def _portal_cache():
+    """ The shared cache of portal pages, None when caching is off """
+    cache_name = getattr(settings, 'BENCHMARK_PORTAL_CACHE', None)
+    if cache_name:
+        return get_cache(cache_name)
+    return None
+
+def _timeout():
+    return getattr(settings, 'BENCHMARK_PORTAL_CACHE_TIMEOUT', 3600)
+
+def _version_key(student_id):
+    return 'benchmark_grade_portal:%s' % (student_id,)
+
+def _page_key(student_id, version, page):
+    return 'benchmark_grade_portal:%s:%s:%s' % (student_id, version, ':'.join([unicode(part) for part in page]))
+
+
+def cached_portal_page(student, page, build):
+    """ What build() returns, from the cache when the student's grades didn't
+    change since it was last built.
+    page: tuple of whatever the result depends on besides the student's grades,
+    such as the course and marking period shown or today's date
+    The result is pickled, so querysets in it should be lists already """
+    cache = _portal_cache()
+    if cache is None:
+        return build()
+    version_key = _version_key(student.id)
+    # Read the version first, a page built while grades change is stored
+    # under the old version
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(version_key, version, _timeout())
+    key = _page_key(student.id, version, page)
+    result = cache.get(key)
+    if result is None:
+        result = build()
+        cache.set(key, result, _timeout())
+    return result
+
+
+def students_grades_changed(student_ids):
+    """ Drop the cached pages of students """
+    cache = _portal_cache()
+    if cache is None:
+        return
+    versions = dict([(_version_key(student_id), uuid.uuid4().hex) for student_id in set(student_ids)])
+    if versions:
+        cache.set_many(versions, _timeout())
+
+
+def mark_changed(sender, instance, **kwargs):
+    students_grades_changed([instance.student_id])
+
+def aggregate_changed(sender, instance, **kwargs):
+    if instance.student_id is not None:
+        students_grades_changed([instance.student_id])
+
+def item_changed(sender, instance, **kwargs):
+    """ Pages only show items their student has marks in """
+    from ecwsp.benchmark_grade.models import Mark
+    students_grades_changed(Mark.objects.filter(item=instance.id).values_list('student', flat=True).distinct())
+
+def enrollment_changed(sender, instance, **kwargs):
+    students_grades_changed([instance.user_id])
@@ -0,0 +1,564 @@
+""" Recalculating the Aggregates of a course from one load.
+
+An Aggregate caches a student's average in a course category, in a whole
+course (category None) or in a category counted as a course across all of the
+student's courses (course None), for a marking period or for the whole course
+(marking period None). The utility functions calculate them one at a time with
+several queries each. CourseAggregates loads the calculation rule, items,
+marks and stored aggregates of a course once, calculates in memory and only
+writes the rows whose value changed.
+
+Aggregates depend on items by category and marking period, and on the marks
+of their student in those items. aggregates_for_item() lists what an item
+feeds, so a new mark only recalculates those aggregates of its student.
+
+Category aggregates also store statistics of the marks they average (count,
+sums, highest, lowest and mean normalized mark), written in the same pass as
+cached_value. refresh_aggregate_stats() rewrites them for a whole course or
+marking period from one grouped query.
+"""
+from ecwsp.benchmark_grade.models import Aggregate, Item, Mark, Category
+from ecwsp.benchmark_grade.models import CalculationRulePerCourseCategory, CalculationRuleCategoryAsCourse, CalculationRuleSubstitution
+from ecwsp.benchmark_grade.portal import students_grades_changed
+from ecwsp.schedule.models import Course, CourseEnrollment, MarkingPeriod
+from ecwsp.grades.models import Grade
+from ecwsp.sis.gpa import defer_gpa_updates
+from django.db.models import Count, Sum, Max, Min, Avg
+
+from decimal import Decimal
+import logging
+
+
+def _related_ids(through, source_field, target_field, source_ids):
+    """ {source_id: set(target_id)} of a many to many relation in one query """
+    related = dict([(source_id, set()) for source_id in source_ids])
+    rows = through.objects.filter(**{source_field + '__in': source_ids}).values_list(
+        source_field + '_id', target_field + '_id')
+    for source_id, target_id in rows:
+        related[source_id].add(target_id)
+    return related
+
+
+def _applies_to_department(department_ids, department_id):
+    """ Same as filter(apply_to_departments=department) which, for a course
+    without department, matches rows without any department """
+    if department_id is None:
+        return not department_ids
+    return department_id in department_ids
+
+
+def _stored(value):
+    """ A value as the two decimal places columns will hold it """
+    if value is None:
+        return None
+    return Decimal(value).quantize(Decimal('0.01'))
+
+
+def _same_stats(aggregate, fields):
+    """ Whether an Aggregate already holds these statistics. Means and
+    extremes are floats that may differ in the last digits between the
+    database and Python """
+    for field in Aggregate.STATS_FIELDS:
+        old = getattr(aggregate, field)
+        new = fields[field]
+        if field in ('marks_sum', 'marks_points_possible'):
+            old, new = _stored(old), _stored(new)
+        elif field.startswith('normalized_') and old is not None and new is not None:
+            if abs(old - new) > 1e-9:
+                return False
+            continue
+        if old != new:
+            return False
+    return True
+
+
+class MarkStats(object):
+    """ Statistics of a student's marks, the same Aggregate.calculate_stats sets """
+    def __init__(self):
+        self.count = 0
+        self.sum = Decimal(0)
+        self.points_possible = None
+        self.max = self.min = None
+        self.normalized_count = 0
+        self.normalized_sum = float(0)
+
+    @classmethod
+    def from_row(cls, row):
+        """ Statistics of a row of refresh_aggregate_stats' grouped query """
+        stats = cls()
+        stats.count = row['count']
+        stats.sum = _stored(row['sum'])
+        stats.points_possible = _stored(row['points_possible'])
+        stats.max = row['max']
+        stats.min = row['min']
+        stats.normalized_count = row['normalized_count']
+        if row['mean'] is not None:
+            stats.normalized_sum = row['mean'] * row['normalized_count']
+        return stats
+
+    def add(self, mark, points_possible, normalized_mark):
+        self.count += 1
+        self.sum += mark
+        if points_possible is not None:
+            self.points_possible = (self.points_possible or 0) + points_possible
+        if normalized_mark is not None:
+            self.max = max(self.max, normalized_mark) if self.max is not None else normalized_mark
+            self.min = min(self.min, normalized_mark) if self.min is not None else normalized_mark
+            self.normalized_count += 1
+            self.normalized_sum += normalized_mark
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        if other.points_possible is not None:
+            self.points_possible = (self.points_possible or 0) + other.points_possible
+        for value in (other.max, other.min):
+            if value is not None:
+                self.max = max(self.max, value) if self.max is not None else value
+                self.min = min(self.min, value) if self.min is not None else value
+        self.normalized_count += other.normalized_count
+        self.normalized_sum += other.normalized_sum
+
+    def fields(self):
+        """ {Aggregate field: value} """
+        fields = dict([(field, None) for field in Aggregate.STATS_FIELDS])
+        fields['marks_count'] = self.count
+        if self.count:
+            fields['marks_sum'] = self.sum
+            fields['marks_points_possible'] = self.points_possible
+            fields['normalized_max'] = self.max
+            fields['normalized_min'] = self.min
+        if self.normalized_count:
+            fields['normalized_mean'] = self.normalized_sum / self.normalized_count
+        return fields
+
+
+class RuleData(object):
+    """ A CalculationRule with its categories and substitutions, in four queries """
+    def __init__(self, rule):
+        self.rule = rule
+        self.points_possible = rule.points_possible
+        self.decimal_places = rule.decimal_places
+
+        per_course = list(rule.per_course_category_set.order_by('id'))
+        departments = _related_ids(CalculationRulePerCourseCategory.apply_to_departments.through,
+            'calculationrulepercoursecategory', 'department', [row.id for row in per_course])
+        # [(category_id, weight, set(department_id)), ...]
+        self.per_course_categories = [
+            (row.category_id, row.weight, departments[row.id]) for row in per_course]
+
+        as_course = list(rule.category_as_course_set.order_by('id'))
+        departments = _related_ids(CalculationRuleCategoryAsCourse.include_departments.through,
+            'calculationrulecategoryascourse', 'department', [row.id for row in as_course])
+        # [(category_id, set(department_id)), ...]
+        self.category_as_course_rows = [(row.category_id, departments[row.id]) for row in as_course]
+        # {category_id: set(department_id)}
+        self.categories_as_courses = {}
+        for category_id, department_ids in self.category_as_course_rows:
+            self.categories_as_courses.setdefault(category_id, department_ids)
+
+        substitutions = list(rule.substitution_set.order_by('id'))
+        substitution_ids = [row.id for row in substitutions]
+        departments = _related_ids(CalculationRuleSubstitution.apply_to_departments.through,
+            'calculationrulesubstitution', 'department', substitution_ids)
+        categories = _related_ids(CalculationRuleSubstitution.apply_to_categories.through,
+            'calculationrulesubstitution', 'category', substitution_ids)
+        # [(substitution, set(department_id), set(category_id)), ...]
+        self.substitutions = [(row, departments[row.id], categories[row.id]) for row in substitutions]
+
+    def substitute(self, department_id, category_id, value):
+        """ Same as CalculationRule.substitute for an item of that department and category
+        Returns (calculate_as, display_as) """
+        for substitution, department_ids, category_ids in self.substitutions:
+            if not _applies_to_department(department_ids, department_id) or category_id not in category_ids:
+                continue
+            if substitution.applies_to(value):
+                if substitution.calculate_as is not None:
+                    value = substitution.calculate_as
+                return value, substitution.display_as
+        return value, None
+
+    def course_categories(self, department_id):
+        """ [(category_id, weight), ...] making up the average of a course in department """
+        return [(category_id, weight) for category_id, weight, department_ids in self.per_course_categories
+                if _applies_to_department(department_ids, department_id)]
+
+    def is_category_as_course(self, category_id, department_id):
+        return (category_id in self.categories_as_courses and
+                _applies_to_department(self.categories_as_courses[category_id], department_id))
+
+
+class CourseAggregates(object):
+    """ Aggregates of students in a course.
+    Aggregate keys are (course_id, category_id, marking_period_id) tuples """
+    def __init__(self, course, students=None, items=None):
+        """ students: defaults to the active students enrolled in course.
+        Only their marks are loaded
+        items: Item queryset to average instead of every item of the course.
+        Like gradebook_get_average with items, course averages then take
+        categories without any of these items from the stored aggregates, and
+        nothing can be stored """
+        self.course = course
+        if students is None:
+            students = course.get_enrolled_students()
+        self.students = list(students)
+        student_ids = [student.id for student in self.students]
+
+        # {school_year_id: RuleData}
+        self.rules = {}
+        self.marking_periods = dict([(mp.id, mp) for mp in course.marking_period.select_related('school_year')])
+        mps = sorted(self.marking_periods.values(), key=lambda mp: mp.start_date, reverse=True)
+        self.rule = None
+        if mps:
+            self.rule = self.get_rule(mps[0].school_year)
+        self.categories = dict([(category.id, category) for category in Category.objects.all()])
+        self.one_off = items is not None
+        if self.one_off:
+            marks = Mark.objects.filter(item__in=items)
+        else:
+            items = Item.objects.filter(course=course)
+            marks = Mark.objects.filter(item__course=course)
+        self.items = list(items.order_by('id'))
+        self.items_by_id = dict([(item.id, item) for item in self.items])
+        self.item_categories = set([item.category_id for item in self.items])
+        # {student_id: [(item_id, mark, normalized_mark), ...]} in the order of the marks
+        self.marks = {}
+        marks = marks.filter(student__in=student_ids).exclude(mark=None).values_list(
+            'student_id', 'item_id', 'mark', 'normalized_mark')
+        for student_id, item_id, mark, normalized_mark in marks.order_by('id'):
+            self.marks.setdefault(student_id, []).append((item_id, mark, normalized_mark))
+        # {(student_id, key): (cached_value, cached_substitution)}
+        self.results = {}
+        # {(category_id, marking_period_id): {student_id: [(course, credits, cached_value or None), ...]}}
+        self.other_courses = {}
+        # {(student_id, key): (cached_value, cached_substitution)} of the course's stored aggregates
+        self.stored = None
+
+    def get_rule(self, school_year):
+        from ecwsp.benchmark_grade.utility import benchmark_find_calculation_rule
+        if school_year.id not in self.rules:
+            self.rules[school_year.id] = RuleData(benchmark_find_calculation_rule(school_year))
+        return self.rules[school_year.id]
+
+    def get_marking_period(self, marking_period_id):
+        if marking_period_id not in self.marking_periods:
+            self.marking_periods[marking_period_id] = MarkingPeriod.objects.select_related(
+                'school_year').get(id=marking_period_id)
+        return self.marking_periods[marking_period_id]
+
+    def aggregates_for_item(self, item):
+        """ Keys of the aggregates an item (saved or not) is part of """
+        if self.rule is None:
+            return []
+        course_id = self.course.id
+        category_id = item.category_id
+        marking_period_id = item.marking_period_id
+        department_id = self.course.department_id
+        keys = [(course_id, category_id, marking_period_id), (course_id, category_id, None)]
+        course_categories = self.rule.course_categories(department_id)
+        if category_id in [row[0] for row in course_categories]:
+            for mp_id in (marking_period_id, None):
+                for rule_category_id, weight in course_categories:
+                    keys.append((course_id, rule_category_id, mp_id))
+                keys.append((course_id, None, mp_id))
+        if marking_period_id is not None:
+            rule = self.get_rule(self.get_marking_period(marking_period_id).school_year)
+            if rule.is_category_as_course(category_id, department_id):
+                keys.append((None, category_id, marking_period_id))
+        unique_keys = []
+        for key in keys:
+            if key not in unique_keys:
+                unique_keys.append(key)
+        return unique_keys
+
+    def all_aggregates(self):
+        """ Keys of every aggregate of the course's items """
+        keys = []
+        for item in self.items:
+            keys += [key for key in self.aggregates_for_item(item) if key not in keys]
+        return keys
+
+    def get(self, student_id, key):
+        """ (cached_value, cached_substitution) of a student's aggregate """
+        if (student_id, key) not in self.results:
+            course_id, category_id, marking_period_id = key
+            if course_id is None:
+                result = self._category_as_course(student_id, category_id, marking_period_id)
+            elif category_id is None:
+                result = self._course_average(student_id, marking_period_id)
+            else:
+                result = self._category_average(student_id, category_id, marking_period_id)
+            self.results[(student_id, key)] = result
+        return self.results[(student_id, key)]
+
+    def get_stored(self, student_id, key):
+        """ (cached_value, cached_substitution) of a stored aggregate of the
+        course, (None, None) when there is none """
+        if self.stored is None:
+            self.stored = {}
+            aggregates = Aggregate.objects.filter(
+                student__in=[student.id for student in self.students],
+                course=self.course,
+            ).values_list('student_id', 'category_id', 'marking_period_id', 'cached_value', 'cached_substitution')
+            for student_id, category_id, marking_period_id, value, substitution in aggregates.order_by('id'):
+                self.stored.setdefault(
+                    (student_id, (self.course.id, category_id, marking_period_id)), (value, substitution))
+        return self.stored.get((student_id, key), (None, None))
+
+    def _category_average(self, student_id, category_id, marking_period_id):
+        """ Same as benchmark_calculate_course_category_aggregate """
+        department_id = self.course.department_id
+        items = dict([(item.id, item) for item in self.items if item.category_id == category_id and
+                      (marking_period_id is None or item.marking_period_id == marking_period_id)])
+        numer = denom = Decimal(0)
+        substitution = None
+        marks = [(item_id, mark) for item_id, mark, normalized_mark in self.marks.get(student_id, []) if item_id in items]
+        if self.categories[category_id].allow_multiple_demonstrations:
+            # The highest mark amongst demonstrations counts as the grade for the item
+            best = {}
+            for item_id, mark in marks:
+                best[item_id] = max(best.get(item_id, mark), mark)
+            marks = [(item_id, best[item_id]) for item_id in sorted(best.keys())]
+        for item_id, mark in marks:
+            if items[item_id].points_possible is None:
+                continue
+            calculate_as, display_as = self.rule.substitute(department_id, category_id, mark)
+            numer += calculate_as
+            denom += items[item_id].points_possible
+            if display_as is not None:
+                substitution = display_as
+        if denom:
+            return numer / denom * 4, substitution
+        return None, substitution
+
+    def get_stats(self, student_id, key):
+        """ {Aggregate field: value} of the statistics of a student's aggregate,
+        the same Aggregate.calculate_stats sets """
+        course_id, category_id, marking_period_id = key
+        stats = MarkStats()
+        if course_id is not None and category_id is not None:
+            for item_id, mark, normalized_mark in self.marks.get(student_id, []):
+                item = self.items_by_id[item_id]
+                if item.category_id == category_id and \
+                        (marking_period_id is None or item.marking_period_id == marking_period_id):
+                    stats.add(mark, item.points_possible, normalized_mark)
+        return stats.fields()
+
+    def _course_average(self, student_id, marking_period_id):
+        """ Same as benchmark_calculate_course_aggregate """
+        numer = denom = Decimal(0)
+        substitution = None
+        for category_id, weight in self.rule.course_categories(self.course.department_id):
+            key = (self.course.id, category_id, marking_period_id)
+            if self.one_off and category_id not in self.item_categories:
+                value, category_substitution = self.get_stored(student_id, key)
+            else:
+                value, category_substitution = self.get(student_id, key)
+            if value is not None:
+                numer += weight * value
+                denom += weight
+                if category_substitution is not None:
+                    substitution = category_substitution
+        if denom:
+            return numer / denom, substitution
+        return None, substitution
+
+    def _load_other_courses(self, category_id, marking_period_id):
+        """ The category aggregates of every course counted in a category as
+        course, stored ones for other courses, for every student at once """
+        from ecwsp.benchmark_grade.utility import benchmark_calculate_course_category_aggregate
+        marking_period = self.get_marking_period(marking_period_id)
+        rule = self.get_rule(marking_period.school_year)
+        student_ids = [student.id for student in self.students]
+        enrollments = CourseEnrollment.objects.filter(
+            user__in=student_ids,
+            course__marking_period=marking_period,
+            course__department__in=rule.categories_as_courses[category_id],
+        ).values_list('user_id', 'course_id').order_by('course__id').distinct()
+        course_ids = set([course_id for student_id, course_id in enrollments])
+        courses = Course.objects.in_bulk(list(course_ids))
+        mp_counts = dict(Course.marking_period.through.objects.filter(course__in=course_ids).values_list(
+            'course').annotate(number=Count('id')).order_by())
+        stored = {}
+        for student_id, course_id, value in Aggregate.objects.filter(
+                student__in=student_ids, marking_period=marking_period, category=category_id,
+                course__in=course_ids).values_list('student_id', 'course_id', 'cached_value').order_by('id'):
+            stored.setdefault((student_id, course_id), value)
+        students = dict([(student.id, student) for student in self.students])
+        other_courses = {}
+        for student_id, course_id in enrollments:
+            course = courses[course_id]
+            if course.credits is None:
+                continue
+            if course_id == self.course.id:
+                value = self.get(student_id, (course_id, category_id, marking_period_id))[0]
+            elif (student_id, course_id) in stored:
+                value = stored[(student_id, course_id)]
+            else:
+                # Never calculated, the utility function stores it
+                value = benchmark_calculate_course_category_aggregate(
+                    students[student_id], course, self.categories[category_id], marking_period)[0].cached_value
+            credits = Decimal(course.credits) / mp_counts[course_id]
+            other_courses.setdefault(student_id, []).append((course, credits, value))
+        self.other_courses[(category_id, marking_period_id)] = other_courses
+
+    def _category_as_course(self, student_id, category_id, marking_period_id):
+        """ Same as benchmark_calculate_category_as_course_aggregate """
+        if (category_id, marking_period_id) not in self.other_courses:
+            self._load_other_courses(category_id, marking_period_id)
+        rule = self.get_rule(self.get_marking_period(marking_period_id).school_year)
+        numer = denom = Decimal(0)
+        substitution = None
+        for course, credits, value in self.other_courses[(category_id, marking_period_id)].get(student_id, []):
+            if value is None:
+                continue
+            calculate_as, display_as = rule.substitute(course.department_id, category_id, value)
+            numer += credits * calculate_as
+            denom += credits
+            if display_as is not None:
+                substitution = display_as
+        if denom:
+            return numer / denom, substitution
+        return None, substitution
+
+    def name(self, student, key):
+        """ The name the utility functions give an aggregate """
+        course_id, category_id, marking_period_id = key
+        marking_period = None
+        if marking_period_id is not None:
+            marking_period = self.get_marking_period(marking_period_id)
+        if course_id is None:
+            return u'G! {} - {} (All Courses, {})'.format(student, self.categories[category_id], marking_period)
+        if category_id is None:
+            return u'G! {} - Course Average ({}, {})'.format(student, self.course, marking_period)
+        return u'G! {} - {} ({}, {})'.format(student, self.categories[category_id], self.course, marking_period)
+
+    def recalculate(self, keys=None):
+        """ Calculate aggregates of every loaded student, with their
+        statistics, and write those that changed, creating missing ones. Course averages of a marking period
+        are copied into Grade like benchmark_calculate_course_aggregate does.
+        keys: defaults to all_aggregates()
+        Returns the number of aggregates written """
+        if self.one_off:
+            raise Exception('Averages of a selection of items are not stored.')
+        if self.rule is None:
+            return 0
+        if keys is None:
+            keys = self.all_aggregates()
+        student_ids = [student.id for student in self.students]
+        category_as_course_keys = [key for key in keys if key[0] is None]
+        # {(student_id, key): [aggregate, ...]}
+        existing = {}
+        aggregates = Aggregate.objects.filter(student__in=student_ids, course=self.course)
+        if category_as_course_keys:
+            aggregates = aggregates | Aggregate.objects.filter(
+                student__in=student_ids,
+                course=None,
+                category__in=[key[1] for key in category_as_course_keys],
+                marking_period__in=[key[2] for key in category_as_course_keys],
+            )
+        for aggregate in aggregates.order_by('id'):
+            key = (aggregate.course_id, aggregate.category_id, aggregate.marking_period_id)
+            existing.setdefault((aggregate.student_id, key), []).append(aggregate)
+
+        written = 0
+        new_aggregates = []
+        changed_students = set()
+        for student in self.students:
+            for key in keys:
+                value, substitution = self.get(student.id, key)
+                stats = self.get_stats(student.id, key)
+                name = self.name(student, key)
+                rows = existing.get((student.id, key), [])
+                if len(rows) > 1:
+                    logging.error('Expected 0 or 1 Aggregate but found {}; flushing them all!'.format(len(rows)))
+                    Aggregate.objects.filter(id__in=[row.id for row in rows]).delete()
+                    rows = []
+                if not rows:
+                    new_aggregates.append(Aggregate(
+                        name=name,
+                        student=student,
+                        course_id=key[0],
+                        category_id=key[1],
+                        marking_period_id=key[2],
+                        cached_value=value,
+                        cached_substitution=substitution,
+                        **stats
+                    ))
+                elif (rows[0].name, _stored(rows[0].cached_value), rows[0].cached_substitution) != \
+                        (name, _stored(value), substitution) or not _same_stats(rows[0], stats):
+                    Aggregate.objects.filter(id=rows[0].id).update(
+                        name=name, cached_value=value, cached_substitution=substitution, **stats)
+                    written += 1
+                    changed_students.add(student.id)
+        Aggregate.objects.bulk_create(new_aggregates)
+        written += len(new_aggregates)
+        students_grades_changed(changed_students | set([aggregate.student_id for aggregate in new_aggregates]))
+        self._update_grades([key for key in keys if key[0] is not None and key[1] is None and key[2] is not None])
+        return written
+
+    def _update_grades(self, keys):
+        """ Copy course averages of marking periods into Grade, saving changed grades only """
+        if not keys:
+            return
+        student_ids = [student.id for student in self.students]
+        marking_period_ids = [key[2] for key in keys]
+        grades = {}
+        for grade in Grade.objects.filter(student__in=student_ids, course=self.course,
+                                          marking_period__in=marking_period_ids):
+            grades[(grade.student_id, grade.marking_period_id)] = grade
+        letter_grade_max_length = Grade._meta.get_field_by_name('letter_grade')[0].max_length
+        with defer_gpa_updates():
+            for student in self.students:
+                for key in keys:
+                    value, substitution = self.get(student.id, key)
+                    grade = grades.get((student.id, key[2]))
+                    if grade is None:
+                        grade = Grade(student=student, course=self.course, marking_period_id=key[2])
+                    elif grade.override_final:
+                        continue
+                    old = (_stored(grade.grade), grade.letter_grade)
+                    if substitution is not None:
+                        grade.letter_grade = substitution[:letter_grade_max_length]
+                        grade.grade = None
+                    else:
+                        grade.set_grade(value)
+                    if grade.pk is None or old != (_stored(grade.grade), grade.letter_grade):
+                        grade.save()
+
+
+def refresh_aggregate_stats(course, marking_period=None):
+    """ Rewrite the statistics of the stored category aggregates of a course,
+    or only of those of one marking period, from one grouped query of marks.
+    Returns the number of aggregates written """
+    marks = Mark.objects.filter(item__course=course).exclude(mark=None)
+    aggregates = Aggregate.objects.filter(course=course).exclude(category=None)
+    if marking_period is not None:
+        marks = marks.filter(item__marking_period=marking_period)
+        aggregates = aggregates.filter(marking_period=marking_period)
+    rows = marks.values('student', 'item__category', 'item__marking_period').annotate(
+        count=Count('id'),
+        sum=Sum('mark'),
+        points_possible=Sum('item__points_possible'),
+        max=Max('normalized_mark'),
+        min=Min('normalized_mark'),
+        mean=Avg('normalized_mark'),
+        normalized_count=Count('normalized_mark'),
+    ).order_by()
+    # {(student_id, category_id, marking_period_id): MarkStats}
+    stats = {}
+    for row in rows:
+        row_stats = MarkStats.from_row(row)
+        student_id, category_id = row['student'], row['item__category']
+        stats.setdefault((student_id, category_id, row['item__marking_period']), MarkStats()).merge(row_stats)
+        if marking_period is None and row['item__marking_period'] is not None:
+            # Aggregates without marking period cover the whole course
+            stats.setdefault((student_id, category_id, None), MarkStats()).merge(row_stats)
+
+    written = 0
+    for aggregate in aggregates.only('id', 'student', 'category', 'marking_period', *Aggregate.STATS_FIELDS):
+        fields = stats.get((aggregate.student_id, aggregate.category_id, aggregate.marking_period_id), MarkStats()).fields()
+        if not _same_stats(aggregate, fields):
+            Aggregate.objects.filter(id=aggregate.id).update(**fields)
+            written += 1
+    return written
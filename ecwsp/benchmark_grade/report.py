@@ -11,6 +11,7 @@ from ecwsp.schedule.calendar import *
 from ecwsp.sis.report import *
 from ecwsp.benchmark_grade.models import *
 from ecwsp.benchmark_grade.utility import benchmark_find_calculation_rule, gradebook_get_average
+from ecwsp.attendance.aggregation import AttendanceMatrix
 
 import tempfile
 import os
@@ -35,6 +36,8 @@ def benchmark_report_card(template, options, students, format="odt"):
                                                   start_date__lt=for_date,
                                                   show_reports=True)
     marking_period = attendance_marking_periods.order_by('-start_date')[0]
+    attendance_marking_periods = list(attendance_marking_periods.order_by('start_date'))
+    attendance = AttendanceMatrix(attendance_marking_periods, students=students)
     for student in students:
         student.courses = Course.objects.filter(
             courseenrollment__user=student,
@@ -118,10 +121,11 @@ def benchmark_report_card(template, options, students, format="odt"):
         student.tardy_total = 0
         student.dismissed_total = 0
         student.attendance_marking_periods = []
-        for mp in attendance_marking_periods.order_by('start_date'):
-            absent = student.student_attn.filter(status__absent=True, date__range=(mp.start_date, mp.end_date)).count()
-            tardy = student.student_attn.filter(status__tardy=True, date__range=(mp.start_date, mp.end_date)).count()
-            dismissed = student.student_attn.filter(status__code="D", date__range=(mp.start_date, mp.end_date)).count()
+        for mp in attendance_marking_periods:
+            counts = attendance.get(student, mp)
+            absent = counts.absent
+            tardy = counts.tardy
+            dismissed = counts.dismissed
             student.absent_total += absent
             student.tardy_total += tardy
             student.dismissed_total += dismissed
@@ -159,6 +163,8 @@ def bleh_benchmark_report_card(template, options, students, format="odt"):
     #except:
         # how do we really handle errors around here?
      #   return HttpResponse("Could not find a marking period for the date " + str(for_date) + ".")
+    attendance_marking_periods = list(attendance_marking_periods.order_by('start_date'))
+    attendance = AttendanceMatrix(attendance_marking_periods, students=students)
         
     for student in students:
         courses = Course.objects.filter(
@@ -281,10 +287,11 @@ def bleh_benchmark_report_card(template, options, students, format="odt"):
         student.tardy_total = 0
         student.dismissed_total = 0
         student.attendance_marking_periods = []
-        for mp in attendance_marking_periods.order_by('start_date'):
-            absent = student.student_attn.filter(status__absent=True, date__range=(mp.start_date, mp.end_date)).count()
-            tardy = student.student_attn.filter(status__tardy=True, date__range=(mp.start_date, mp.end_date)).count()
-            dismissed = student.student_attn.filter(status__code="D", date__range=(mp.start_date, mp.end_date)).count()
+        for mp in attendance_marking_periods:
+            counts = attendance.get(student, mp)
+            absent = counts.absent
+            tardy = counts.tardy
+            dismissed = counts.dismissed
             student.absent_total += absent
             student.tardy_total += tardy
             student.dismissed_total += dismissed
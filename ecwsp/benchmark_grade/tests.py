@@ -0,0 +1,226 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.db import connection
+
+from ecwsp.sis.models import SchoolYear, Student
+from ecwsp.schedule.models import MarkingPeriod, Department, Course, CourseEnrollment
+from ecwsp.benchmark_grade.models import Aggregate, CalculationRule, CalculationRulePerCourseCategory, Category, Item, Mark
+from ecwsp.benchmark_grade.gradebook import Gradebook
+from ecwsp.benchmark_grade.gpa import benchmark_compute_gpas
+from ecwsp.benchmark_grade.portal import cached_portal_page
+from ecwsp.benchmark_grade.recalculation import CourseAggregates, refresh_aggregate_stats
+from ecwsp.benchmark_grade.utility import benchmark_calculate_grade_for_courses
+
+from datetime import date
+from decimal import Decimal
+
+
+class GradebookTest(TestCase):
+    def setUp(self):
+        self.year = SchoolYear.objects.create(name="2012", start_date=date(2012,8,27), end_date=date(2013,6,14),
+            active_year=True, benchmark_grade=True)
+        self.mps = []
+        for name, start, end in (("S1", date(2012,8,27), date(2013,1,18)), ("S2", date(2013,1,21), date(2013,6,14))):
+            self.mps.append(MarkingPeriod.objects.create(name=name, shortname=name, school_year=self.year,
+                start_date=start, end_date=end))
+        department = Department.objects.create(name="Math")
+        self.course = Course.objects.create(fullname="Algebra", shortname="Algebra", credits=1, department=department)
+        for mp in self.mps:
+            self.course.marking_period.add(mp)
+        rule = CalculationRule.objects.create(first_year_effective=self.year)
+        standards = Category.objects.create(name="Standards", display_order=1)
+        engagement = Category.objects.create(name="Engagement", display_order=2)
+        for category, weight in ((standards, Decimal("0.7")), (engagement, Decimal("0.3"))):
+            rule_category = CalculationRulePerCourseCategory.objects.create(
+                category=category, weight=weight, calculation_rule=rule)
+            rule_category.apply_to_departments.add(department)
+        self.students = []
+        for i in range(8):
+            student = Student.objects.create(fname="Joe", lname="Student%s" % (i,), username="jstudent%s" % (i,))
+            CourseEnrollment.objects.create(course=self.course, user=student)
+            self.students.append(student)
+        for i in range(6):
+            item = Item.objects.create(name="Item %s" % (i,), course=self.course, marking_period=self.mps[i % 2],
+                category=(standards, engagement)[i % 3 == 0], points_possible=4)
+            # Only some students have marks, the gradebook creates the others
+            for j, student in enumerate(self.students[:4]):
+                Mark.objects.create(item=item, student=student, mark=(i + j) % 5)
+
+    def count_queries(self, function):
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        function()
+        number = len(connection.queries) - start
+        connection.use_debug_cursor = use_debug_cursor
+        return number
+
+    def load(self, students):
+        gradebook = Gradebook(self.course, students, Item.objects.filter(course=self.course))
+        gradebook.set_averages()
+        gradebook.set_filtered_averages(None, self.mps[0])
+        gradebook.set_standards_counts(filtered=True)
+        return gradebook
+
+    def test_constant_queries(self):
+        students = list(self.students)
+        for i in range(len(students), 40):
+            student = Student.objects.create(fname="Joe", lname="Student%s" % (i,), username="jstudent%s" % (i,))
+            CourseEnrollment.objects.create(course=self.course, user=student)
+            students.append(student)
+        gradebook = self.load(students)
+        self.assertEqual(Mark.objects.count(), 6 * 40)
+        self.assertEqual([len(gradebook_student.marks) for gradebook_student in gradebook.students], [6] * 40)
+        queries = [self.count_queries(lambda: self.load(students[:number])) for number in (1, 2, 8, 40)]
+        self.assertEqual(queries, [queries[0]] * 4)
+
+    def test_missing_averages(self):
+        """ Averages the gradebook calculates are stored with their category aggregates """
+        self.load(self.students)
+        aggregates = Aggregate.objects.filter(course=self.course, marking_period=None)
+        for student in self.students:
+            self.assertEqual(set(aggregates.filter(student=student).values_list('category__name', flat=True)),
+                set([None, "Standards", "Engagement"]))
+
+    def test_gpa(self):
+        CourseAggregates(self.course).recalculate()
+        students = Student.objects.filter(id__in=[student.id for student in self.students])
+        for date_report, marking_period in ((date(2013,6,30), None), (None, self.mps[1])):
+            gpas = benchmark_compute_gpas(students, marking_period, date_report)
+            for student in students:
+                courses = student.course_set.filter(graded=True)
+                if marking_period is None:
+                    courses = courses.filter(marking_period__show_reports=True).distinct()
+                else:
+                    courses = courses.filter(marking_period=marking_period)
+                self.assertEqual(gpas[student.id],
+                    benchmark_calculate_grade_for_courses(student, courses, marking_period, date_report))
+
+    def test_gpa_counted_marking_periods(self):
+        """ Hidden marking periods don't count in the cumulative GPA, nor
+        other years in the year GPA, even when they have aggregates """
+        next_year = SchoolYear.objects.create(name="2013", start_date=date(2013,8,26), end_date=date(2014,6,13),
+            benchmark_grade=True)
+        hidden = MarkingPeriod.objects.create(name="Summer", shortname="Summer", school_year=self.year,
+            start_date=date(2013,6,17), end_date=date(2013,8,9), show_reports=False)
+        fall = MarkingPeriod.objects.create(name="S1", shortname="S1", school_year=next_year,
+            start_date=date(2013,8,26), end_date=date(2014,1,17))
+        standards = Category.objects.get(name="Standards")
+        for mp in (hidden, fall):
+            self.course.marking_period.add(mp)
+            item = Item.objects.create(name="Late", course=self.course, marking_period=mp,
+                category=standards, points_possible=4)
+            for student in self.students[:4]:
+                Mark.objects.create(item=item, student=student, mark=4)
+        CourseAggregates(self.course).recalculate()
+        self.assertTrue(Aggregate.objects.filter(marking_period=hidden, category=standards).exists())
+        students = Student.objects.filter(id__in=[student.id for student in self.students])
+        date_report = date(2014,6,30)
+        gpas = benchmark_compute_gpas(students, None, date_report)
+        year_gpas = benchmark_compute_gpas(students, None, date_report, self.year)
+        for student in students:
+            courses = student.course_set.filter(graded=True)
+            self.assertEqual(gpas[student.id], benchmark_calculate_grade_for_courses(
+                student, courses.filter(marking_period__show_reports=True).distinct(), None, date_report))
+            self.assertEqual(year_gpas[student.id], benchmark_calculate_grade_for_courses(
+                student, courses.filter(marking_period__school_year=self.year), None, date_report))
+
+    def test_recalculation_matches_utility(self):
+        """ CourseAggregates must store what the one at a time utility functions do """
+        from ecwsp.benchmark_grade.models import CalculationRuleCategoryAsCourse, CalculationRuleSubstitution
+        from ecwsp.benchmark_grade.utility import benchmark_calculate_course_category_aggregate
+        from ecwsp.benchmark_grade.utility import benchmark_calculate_course_aggregate, benchmark_calculate_category_as_course_aggregate
+        from ecwsp.grades.models import Grade
+        rule = CalculationRule.objects.get()
+        department = self.course.department
+        standards, engagement = Category.objects.order_by('display_order')
+        homework = Category.objects.create(name="Homework", display_order=3, allow_multiple_demonstrations=True)
+        rule_category = CalculationRulePerCourseCategory.objects.create(
+            category=homework, weight=Decimal("0.2"), calculation_rule=rule)
+        rule_category.apply_to_departments.add(department)
+        as_course = CalculationRuleCategoryAsCourse.objects.create(category=engagement, calculation_rule=rule)
+        as_course.include_departments.add(department)
+        substitution = CalculationRuleSubstitution.objects.create(
+            operator='<', match_value=1, display_as='INC', calculation_rule=rule)
+        substitution.apply_to_departments.add(department)
+        substitution.apply_to_categories.add(standards)
+        # The best of several demonstrations counts
+        homework_item = Item.objects.create(name="Homework", course=self.course, marking_period=self.mps[0],
+            category=homework, points_possible=10)
+        for student, marks in ((self.students[0], (3, 9, None)), (self.students[1], (None,)), (self.students[2], (7, 2))):
+            for mark in marks:
+                Mark.objects.create(item=homework_item, student=student, mark=mark)
+        # Excluded marks: without a mark or in an item without points possible
+        ungraded = Item.objects.create(name="Ungraded", course=self.course, marking_period=self.mps[1], category=standards)
+        Mark.objects.create(item=ungraded, student=self.students[3], mark=2)
+        Mark.objects.create(item=Item.objects.filter(category=standards)[0], student=self.students[5], mark=None)
+
+        def stored():
+            aggregates = dict([((aggregate.student_id, aggregate.course_id, aggregate.category_id, aggregate.marking_period_id),
+                                (aggregate.cached_value, aggregate.cached_substitution))
+                               for aggregate in Aggregate.objects.filter(student__in=self.students)])
+            grades = dict([((grade.student_id, grade.marking_period_id), (grade.grade, grade.letter_grade))
+                           for grade in Grade.objects.filter(course=self.course)])
+            return aggregates, grades
+        CourseAggregates(self.course).recalculate()
+        aggregates, grades = stored()
+        self.assertTrue([value for value, display_as in aggregates.values() if value is not None])
+        self.assertTrue([key for key in aggregates if key[1] is None])
+        self.assertTrue('INC' in [display_as for value, display_as in aggregates.values()])
+
+        Aggregate.objects.all().delete()
+        Grade.objects.all().delete()
+        students = dict([(student.id, student) for student in self.students])
+        categories = dict([(category.id, category) for category in Category.objects.all()])
+        mps = dict([(mp.id, mp) for mp in self.mps])
+        # Categories first, then the course averages and categories as courses using them
+        for student_id, course_id, category_id, mp_id in sorted(aggregates, key=lambda key: (key[1] is None, key[2] is None, key)):
+            student = students[student_id]
+            if course_id is None:
+                benchmark_calculate_category_as_course_aggregate(student, categories[category_id], mps[mp_id])
+            elif category_id is None:
+                benchmark_calculate_course_aggregate(student, self.course, mps.get(mp_id))
+            else:
+                benchmark_calculate_course_category_aggregate(student, self.course, categories[category_id], mps.get(mp_id))
+        self.assertEqual(stored(), (aggregates, grades))
+
+    def test_aggregate_stats(self):
+        CourseAggregates(self.course).recalculate()
+        aggregates = Aggregate.objects.filter(course=self.course).exclude(category=None)
+        self.assertTrue(aggregates.filter(marks_count__gt=0).exists())
+        for aggregate in aggregates:
+            stored = [getattr(aggregate, field) for field in Aggregate.STATS_FIELDS]
+            aggregate.calculate_stats()
+            self.assertEqual(stored[:3], [getattr(aggregate, field) for field in Aggregate.STATS_FIELDS[:3]])
+            for value, field in zip(stored[3:], Aggregate.STATS_FIELDS[3:]):
+                self.assertAlmostEqual(value, getattr(aggregate, field))
+        self.assertEqual(refresh_aggregate_stats(self.course), 0)
+        Aggregate.objects.filter(course=self.course).update(normalized_max=None)
+        self.assertEqual(refresh_aggregate_stats(self.course, self.mps[0]),
+            aggregates.filter(marking_period=self.mps[0], marks_count__gt=0).count())
+
+    @override_settings(BENCHMARK_PORTAL_CACHE='default')
+    def test_portal_cache(self):
+        builds = []
+        def page(student):
+            return cached_portal_page(student, ('test',), lambda: builds.append(student.id) or len(builds))
+        first, second = self.students[:2]
+        self.assertEqual(page(first), 1)
+        self.assertEqual(page(first), 1)
+        self.assertEqual(page(second), 2)
+        mark = Mark.objects.filter(student=first)[0]
+        mark.mark = 2
+        mark.save()
+        self.assertEqual(page(first), 3)
+        self.assertEqual(page(second), 2)
+        mark.item.save()
+        self.assertEqual(page(first), 4)
+        self.assertEqual(page(second), 5)
+
+    @override_settings(BENCHMARK_PORTAL_CACHE=None)
+    def test_portal_cache_off(self):
+        builds = []
+        student = self.students[0]
+        for i in range(2):
+            cached_portal_page(student, ('test',), lambda: builds.append(student.id))
+        self.assertEqual(len(builds), 2)
@@ -17,7 +17,7 @@
 #   MA 02110-1301, USA.
 
 from ecwsp.benchmark_grade.models import CalculationRule, Aggregate, Item, Mark, Category
-from ecwsp.schedule.models import MarkingPeriod
+from ecwsp.schedule.models import MarkingPeriod, Course
 from ecwsp.grades.models import Grade
 from django.db.models import Avg, Sum, Min, Max
 import logging
@@ -86,6 +86,7 @@ def benchmark_calculate_category_as_course_aggregate(student, category, marking_
         agg.cached_value = category_numer / category_denom
     else:
         agg.cached_value = None
+    agg.calculate_stats()
     agg.save()
     return agg, created
 
@@ -144,6 +145,7 @@ def benchmark_calculate_course_category_aggregate(student, course, category, mar
     else:
         agg.cached_value = None
     if save:
+        agg.calculate_stats()
         agg.save()
     return agg, created
 
@@ -194,6 +196,7 @@ def benchmark_calculate_course_aggregate(student, course, marking_period, items=
     else:
         agg.cached_value = None
     if save:
+        agg.calculate_stats()
         agg.save()
         if marking_period is not None:
             # temporary(?) integration with the rest of sword
@@ -209,30 +212,31 @@ def benchmark_calculate_course_aggregate(student, course, marking_period, items=
     return agg, created
 
 def gradebook_recalculate_on_item_change(item, students=None):
-    if students is None:
-        students = item.course.get_enrolled_students()
-    course = item.course
-    category = item.category
-    marking_period = item.marking_period
-    calculation_rule = benchmark_find_calculation_rule(item.course.marking_period.all()[0].school_year)
-    affects_overall_course = calculation_rule.per_course_category_set.filter(category=category, apply_to_departments=course.department).count() > 0
-    affects_overall_category = calculation_rule.category_as_course_set.filter(category=category, include_departments=course.department).count() > 0
-
-    for student in students:
-        # always recalculate the aggregate for this course, category, and marking period
-        benchmark_calculate_course_category_aggregate(student, course, category, marking_period)
-        if affects_overall_course:
-            benchmark_calculate_course_aggregate(student, course, marking_period) 
-        if affects_overall_category:
-            benchmark_calculate_category_as_course_aggregate(student, category, marking_period)
-        # always recalculate the course-long (i.e. marking_period=None) aggregate for this category
-        benchmark_calculate_course_category_aggregate(student, course, category, None)
-        if affects_overall_course:
-            benchmark_calculate_course_aggregate(student, course, None) 
+    """ Recalculate every aggregate item is part of, see ecwsp.benchmark_grade.recalculation
+    item: may be an unsaved copy of a deleted or changed item """
+    from ecwsp.benchmark_grade.recalculation import CourseAggregates
+    course_aggregates = CourseAggregates(item.course, students)
+    course_aggregates.recalculate(course_aggregates.aggregates_for_item(item))
 
 def gradebook_recalculate_on_mark_change(mark):
     gradebook_recalculate_on_item_change(mark.item, (mark.student, ))
 
+def gradebook_format_average(cached_value, cached_substitution, category, decimal_places):
+    """ How gradebooks and reports show an aggregate's value
+    decimal_places: of the calculation rule, only needed when there is a value and no substitution """
+    if cached_substitution is not None:
+        return cached_substitution
+    elif cached_value is not None:
+        cached_value = Decimal(cached_value)
+        if category is not None and category.display_scale is not None:
+            pretty = cached_value / 4 * category.display_scale # TODO: use agg.points_possible (and actually set it when aggregates are calculated)
+            pretty = '{}{}'.format(pretty.quantize(Decimal(10) ** (-1 * decimal_places), ROUND_HALF_UP), category.display_symbol)
+        else:
+            pretty = cached_value.quantize(Decimal(10) ** (-1 * decimal_places), ROUND_HALF_UP)
+        return pretty
+    else:
+        return None
+
 def gradebook_get_average(student, course, category=None, marking_period=None, items=None):
     try:
         if items is not None: # averages of one-off sets of items aren't saved and must be calculated every time
@@ -244,36 +248,20 @@ def gradebook_get_average(student, course, category=None, marking_period=None, i
             agg, created = benchmark_calculate_course_aggregate(student, course, marking_period, items)
         else:
             agg, created = benchmark_calculate_course_category_aggregate(student, course, category, marking_period, items)
-    if agg.cached_substitution is not None:
-        return agg.cached_substitution
-    elif agg.cached_value is not None:
+    if agg.cached_substitution is None and agg.cached_value is not None:
         calculation_rule = benchmark_find_calculation_rule(course.marking_period.all()[0].school_year)
-        if category is not None and category.display_scale is not None:
-            pretty = agg.cached_value / 4 * category.display_scale # TODO: use agg.points_possible (and actually set it when aggregates are calculated)
-            pretty = '{}{}'.format(pretty.quantize(Decimal(10) ** (-1 * calculation_rule.decimal_places), ROUND_HALF_UP), category.display_symbol)
-        else:
-            pretty = agg.cached_value.quantize(Decimal(10) ** (-1 * calculation_rule.decimal_places), ROUND_HALF_UP)
-        return pretty
-    else:
-        return None
+        return gradebook_format_average(agg.cached_value, None, category, calculation_rule.decimal_places)
+    return gradebook_format_average(agg.cached_value, agg.cached_substitution, category, None)
 
 def gradebook_get_category_average(student, category, marking_period):
     try:
         agg = benchmark_get_or_flush(Aggregate, student=student, course=None, category=category, marking_period=marking_period)
     except Aggregate.DoesNotExist:
         agg, created = benchmark_calculate_category_as_course_aggregate(student, category, marking_period)
-    if agg.cached_substitution is not None:
-        return agg.cached_substitution
-    elif agg.cached_value is not None:
+    if agg.cached_substitution is None and agg.cached_value is not None:
         calculation_rule = benchmark_find_calculation_rule(marking_period.school_year)
-        if category.display_scale is not None:
-            pretty = agg.cached_value / 4 * category.display_scale # TODO: use agg.points_possible (and actually set it when aggregates are calculated)
-            pretty = '{}{}'.format(pretty.quantize(Decimal(10) ** (-1 * calculation_rule.decimal_places), ROUND_HALF_UP), category.display_symbol)
-        else:
-            pretty = agg.cached_value.quantize(Decimal(10) ** (-1 * calculation_rule.decimal_places), ROUND_HALF_UP)
-        return pretty
-    else:
-        return None
+        return gradebook_format_average(agg.cached_value, None, category, calculation_rule.decimal_places)
+    return gradebook_format_average(agg.cached_value, agg.cached_substitution, category, None)
 
 
 ''' ye olde belowe '''
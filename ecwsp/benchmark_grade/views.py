@@ -37,6 +37,8 @@ from ecwsp.benchmark_grade.forms import BenchmarkGradeVerifyForm, GradebookFilte
 from ecwsp.benchmarks.models import Benchmark
 from ecwsp.benchmark_grade.utility import gradebook_get_average, gradebook_recalculate_on_item_change, gradebook_recalculate_on_mark_change
 from ecwsp.benchmark_grade.utility import benchmark_find_calculation_rule
+from ecwsp.benchmark_grade.gradebook import Gradebook
+from ecwsp.benchmark_grade.portal import cached_portal_page
 
 from decimal import Decimal
 import logging
@@ -108,14 +110,16 @@ def benchmark_grade_upload(request, id):
     }, RequestContext(request, {}),)
 
 def student_family_grade_common(student):
+    """ Marking periods of the active year with the student's courses, their
+    categories and averages. Lists only, so it can be cached """
     PASSING_GRADE = 3 # TODO: pull config value. Roche has it set to something crazy now and I don't want to deal with it
     school_year = SchoolYear.objects.get(active_year=True)
-    mps = MarkingPeriod.objects.filter(school_year=school_year, start_date__lte=datetime.date.today()).order_by('-start_date')
+    mps = list(MarkingPeriod.objects.filter(school_year=school_year, start_date__lte=datetime.date.today()).order_by('-start_date'))
     calculation_rule = benchmark_find_calculation_rule(school_year)
     for mp in mps:
-        mp.courses = Course.objects.filter(courseenrollment__user=student, graded=True, marking_period=mp).order_by('fullname')
+        mp.courses = list(Course.objects.filter(courseenrollment__user=student, graded=True, marking_period=mp).order_by('fullname'))
         for course in mp.courses:
-            course.categories = Category.objects.filter(item__course=course, item__mark__student=student).distinct()
+            course.categories = list(Category.objects.filter(item__course=course, item__mark__student=student).distinct())
             course.category_by_name = {}
             for category in course.categories:
                 category.percentage = calculation_rule.per_course_category_set.get(
@@ -139,7 +143,8 @@ def student_grade(request):
     error_message = None
     try:
         student = Student.objects.get(username=request.user.username)
-        mps = student_family_grade_common(student)
+        mps = cached_portal_page(student, ('summary', datetime.date.today()),
+            lambda: student_family_grade_common(student))
     except Student.DoesNotExist:
         logging.warning('No student found for user "' + request.user.username + '"', exc_info=True)
         student = None
@@ -155,6 +160,8 @@ def student_grade(request):
     }, RequestContext(request, {}),)
 
 def student_family_grade_course_detail_common(student, course, mp, items=None):
+    """ Marking periods with the student's marked items of a course by
+    category and name. Lists only, so it can be cached """
     # TODO: move into CalculationRule?
     CATEGORY_NAME_TO_FLAG_CRITERIA = {
         'Standards': {'best_mark__lt': 3},
@@ -170,19 +177,19 @@ def student_family_grade_course_detail_common(student, course, mp, items=None):
     # always filter in case a bad person passes us items from a different course
     items = items.filter(course=course, mark__student=student)
     if mp is None:
-        mps = MarkingPeriod.objects.filter(item__in=items).distinct().order_by('-start_date')
+        mps = list(MarkingPeriod.objects.filter(item__in=items).distinct().order_by('-start_date'))
     else:
         mps = (mp,)
     for mp in mps:
         mp_items = items.filter(marking_period=mp)
-        mp.categories = Category.objects.filter(item__in=mp_items).distinct()
+        mp.categories = list(Category.objects.filter(item__in=mp_items).distinct())
         for category in mp.categories:
             category_items = mp_items.filter(category=category).annotate(best_mark=Max('mark__mark')).exclude(best_mark=None)
             item_names = category_items.values_list('name').distinct()
             category.item_groups = {}
             for item_name_tuple in item_names:
                 item_name = item_name_tuple[0]
-                category.item_groups[item_name] = category_items.filter(name=item_name).distinct() 
+                category.item_groups[item_name] = list(category_items.filter(name=item_name).distinct().select_related('benchmark'))
             if specific_items:
                 # get a disposable average for these specific items
                 category.average = gradebook_get_average(student, course, category, mp, category_items)
@@ -190,7 +197,7 @@ def student_family_grade_course_detail_common(student, course, mp, items=None):
                 category.average = gradebook_get_average(student, course, category, mp, None)
             category.flagged_item_pks = []
             if category.name in CATEGORY_NAME_TO_FLAG_CRITERIA:
-                category.flagged_item_pks = category_items.filter(**CATEGORY_NAME_TO_FLAG_CRITERIA[category.name]).values_list('pk', flat=True)
+                category.flagged_item_pks = list(category_items.filter(**CATEGORY_NAME_TO_FLAG_CRITERIA[category.name]).values_list('pk', flat=True))
 
     return mps
     
@@ -202,7 +209,8 @@ def student_grade_course_detail(request, course_id, marking_period_id):
     error_message = None
     try:
         student = Student.objects.get(username=request.user.username)
-        mps = student_family_grade_course_detail_common(student, course, mp)
+        mps = cached_portal_page(student, ('course_detail', course.id, mp.id),
+            lambda: student_family_grade_course_detail_common(student, course, mp))
     except Student.DoesNotExist:
         logging.warning('No student found for user "' + request.user.username + '"', exc_info=True)
         student = None
@@ -236,7 +244,8 @@ def family_grade(request):
         student = available_students.get(username=request.GET['student_username'])
 
     if student is not None:
-        mps = student_family_grade_common(student)
+        mps = cached_portal_page(student, ('summary', datetime.date.today()),
+            lambda: student_family_grade_common(student))
     return render_to_response('benchmark_grade/student_grade.html', {
         'student': student,
         'available_students': available_students,
@@ -264,7 +273,8 @@ def family_grade_course_detail(request, course_id, marking_period_id):
         student = available_students.get(username=request.GET['student_username'])
 
     if student is not None:
-        mps = student_family_grade_course_detail_common(student, course, mp)
+        mps = cached_portal_page(student, ('course_detail', course.id, mp.id),
+            lambda: student_family_grade_course_detail_common(student, course, mp))
     else:
         mps = None
 
@@ -362,74 +372,18 @@ def gradebook(request, course_id):
     
     # Freeze these now in case someone else gets in here!
     items = items.order_by('id').all()
-    # whoa, super roll of the dice. is Item.demonstration_set really guaranteed to be ordered by id?
-    # precarious; sorting must match items (and demonstrations!) exactly
-    marks = Mark.objects.filter(item__in=items).order_by('item__id', 'demonstration__id').all() 
-    items_count = items.filter(demonstration=None).count() + Demonstration.objects.filter(item__in=items).count()
-    for student in students:
-        student_marks = marks.filter(student=student)
-        if student_marks.count() < items_count:
-            # maybe student enrolled after assignments were created
-            for item in items:
-                if len(item.demonstration_set.all()):
-                    # must create mark for each demonstration
-                    for demonstration in item.demonstration_set.all():
-                        mark, created = Mark.objects.get_or_create(item=item, demonstration=demonstration, student=student)
-                        if created:
-                            mark.save()
-                else:
-                    # a regular item without demonstrations; make only one mark
-                    mark, created = Mark.objects.get_or_create(item=item, student=student)
-                    if created:
-                        mark.save()
-        if student_marks.count() > items_count:
-            # Yikes, there are multiple marks per student per item. Stop loading the gradebook now.
-            if 'dangerous' in request.GET:
-                pass
-            else:
-                raise Exception('Multiple marks per student per item.')
-        student.marks = student_marks
-        student.average = gradebook_get_average(student, course, None, None, None)
-        if filtered:
-            student.filtered_average = gradebook_get_average(student, course, filter_form.cleaned_data['category'],
-                                                             filter_form.cleaned_data['marking_period'], items)
-        # TC's column of counts
-        # TODO: don't hardcode
-        standards_category = Category.objects.get(name='Standards')
-        PASSING_GRADE = 3
-        standards_objects = Item.objects.filter(course=course, category=standards_category, mark__student=student).annotate(best_mark=Max('mark__mark')).exclude(best_mark=None)
-        standards_count_passing = standards_objects.filter(best_mark__gte=PASSING_GRADE).count()
-        standards_count_total = standards_objects.count()
-        if standards_count_total:
-            student.standards_counts = '{} / {} ({:.0f}%)'.format(standards_count_passing, standards_count_total, 100.0 * standards_count_passing / standards_count_total)
-        else:
-            student.standards_counts_ = None
-        if filtered:
-            standards_objects = items.filter(course=course, category=standards_category, mark__student=student).annotate(best_mark=Max('mark__mark')).exclude(best_mark=None)
-            standards_count_passing = standards_objects.filter(best_mark__gte=PASSING_GRADE).count()
-            standards_count_total = standards_objects.count()
-            if standards_count_total:
-                student.filtered_standards_counts = '{} / {} ({:.0f}%)'.format(standards_count_passing, standards_count_total, 100.0 * standards_count_passing / standards_count_total)
-            else:
-                student.filtered_standards_counts = None
-
-        # TC's row of counts
-        # TODO: don't hardcode
-        for item in items:
-            if item.category != standards_category:
-                item.marks_counts = 'N/A'
-                continue
-            marks_count_passing = item.mark_set.filter(mark__gte=PASSING_GRADE).count()
-            marks_count_total = item.mark_set.exclude(mark=None).count()
-            if marks_count_total:
-                item.marks_counts = '{} / {} ({:.0f}%)'.format(marks_count_passing, marks_count_total, 100.0 * marks_count_passing / marks_count_total)
-            else:
-                item.marks_counts = None
-            
+    gradebook_data = Gradebook(course, students, items, allow_duplicates='dangerous' in request.GET)
+    gradebook_data.set_averages()
+    if filtered:
+        gradebook_data.set_filtered_averages(filter_form.cleaned_data['category'],
+                                             filter_form.cleaned_data['marking_period'])
+    gradebook_data.set_standards_counts(filtered)
+    items = gradebook_data.items
+    students = gradebook_data.students
 
     return render_to_response('benchmark_grade/gradebook.html', {
         'items': items,
-        'item_pks': ','.join(map(str,items.values_list('pk', flat=True))),
+        'item_pks': ','.join([str(item.pk) for item in items]),
         'students': students,
         'course': course,
         'teacher_courses': teacher_courses,
@@ -464,11 +418,17 @@ def ajax_get_item_form(request, course_id, item_id=None):
     if request.POST:
         if item_id:
             item = get_object_or_404(Item, pk=item_id)
+            old_item = Item(course=item.course, category_id=item.category_id, marking_period_id=item.marking_period_id)
             form = ItemForm(request.POST, instance=item, prefix="item")
         else:
             form = ItemForm(request.POST, prefix="item")
         if form.is_valid():
             item = form.save()
+            if item_id is not None:
+                # points possible, category or marking period may have changed
+                gradebook_recalculate_on_item_change(item)
+                if (old_item.category_id, old_item.marking_period_id) != (item.category_id, item.marking_period_id):
+                    gradebook_recalculate_on_item_change(old_item)
             if item_id is None:
                 # a new item!
                 dem = None
@@ -660,6 +620,10 @@ def ajax_get_fill_all_form(request, course_id, object_type, object_id):
             for m in item_or_demonstration.mark_set.all():
                 m.mark = form.cleaned_data['mark']
                 m.save()
+            if type(item_or_demonstration) == Item:
+                gradebook_recalculate_on_item_change(item_or_demonstration)
+            else:
+                gradebook_recalculate_on_item_change(item_or_demonstration.item)
             messages.success(request, 'Marked all students {} for {}'.format(form.cleaned_data['mark'], item_or_demonstration))
             return HttpResponse('SUCCESS')
     else:
@@ -21,7 +21,7 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test, permission_required
 from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.core.urlresolvers import reverse
-from django.db.models import Count
+from django.db.models import Count, Sum
 from django.forms.models import BaseModelFormSet, modelformset_factory
 from django.template import RequestContext
 from django.http import HttpResponse, HttpResponseRedirect
@@ -29,6 +29,7 @@ from django.http import HttpResponse, HttpResponseRedirect
 from ecwsp.administration.models import *
 from ecwsp.sis.models import UserPreference, SchoolYear, Student
 from ecwsp.sis.xlsReport import *
+from ecwsp.attendance.models import StudentAttendance, StudentAttendanceDay
 from models import *
 from forms import *
 import datetime
@@ -144,27 +145,36 @@ def generate_from_attendance(request):
     
     year = SchoolYear.objects.get(active_year=True)
     
-    students = []
-    for student in Student.objects.filter(
+    candidates = Student.objects.filter(
         student_attn__date=datetime.date.today(),
         student_attn__status__tardy=True,
         student_attn__status__excused=False
-        ):
-        if (student.student_attn.filter(
-                status__tardy=True,
-                status__excused=False,
-                date__range=(year.start_date,year.end_date)
-            ).count() >= int(tardies_before_disc) and
-            not StudentDiscipline.objects.filter(
-                students=student,date=datetime.date.today()
-            ).count()
-            ):
-            student.tardies = student.student_attn.filter(
-                status__tardy=True,
-                status__excused=False,
-                date__range=(year.start_date,year.end_date)
-            )
+        ).distinct()
+    # Unexcused tardies this year per candidate, from the attendance rollup
+    year_tardies = {}
+    for row in StudentAttendanceDay.objects.filter(
+        student__in=candidates,
+        date__range=(year.start_date, year.end_date),
+        ).values('student').annotate(number=Sum('tardy_unexcused')).order_by():
+        year_tardies[row['student']] = row['number']
+    disciplined = set(StudentDiscipline.objects.filter(
+        date=datetime.date.today()).values_list('students', flat=True))
+    students = []
+    for student in candidates:
+        if (year_tardies.get(student.id, 0) >= int(tardies_before_disc) and
+            student.id not in disciplined):
+            student.tardies = []
             students.append(student)
+    # Each listed student's tardies, all at once
+    tardies = StudentAttendance.objects.filter(
+        student__in=[student.id for student in students],
+        status__tardy=True,
+        status__excused=False,
+        date__range=(year.start_date,year.end_date)
+    ).select_related('status')
+    students_by_id = dict([(student.id, student) for student in students])
+    for tardy in tardies:
+        students_by_id[tardy.student_id].tardies.append(tardy)
             
             
     return render_to_response('discipline/generate_from_attendance.html', {
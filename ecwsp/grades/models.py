@@ -104,10 +104,9 @@ class Grade(models.Model):
         super(Grade, self).save(*args, **kwargs)
         
         #cache student's GPA
-        if self.grade and self.student:
-            self.student.cache_gpa = self.student.calculate_gpa()
-            if self.student.cache_gpa != "N/A":
-                self.student.save()
+        if self.grade and self.student_id:
+            from ecwsp.sis.gpa import gpa_changed
+            gpa_changed(self.student_id)
     
     def __unicode__(self):
         return unicode(self.get_grade(self))
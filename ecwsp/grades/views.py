@@ -13,6 +13,7 @@ from ecwsp.administration.models import Configuration
 from ecwsp.schedule.models import *
 from ecwsp.sis.models import *
 from ecwsp.sis.helper_functions import Struct
+from ecwsp.sis.gpa import GPAData
 from ecwsp.sis.uno_report import replace_spreadsheet
 from models import *
 from forms import *
@@ -21,6 +22,27 @@ import datetime
 import time
 import logging
 
+def ensure_grades_exist(students, courses, marking_periods):
+    """ Create the blank grades gradesheets show for each student, course and
+    marking period, with one query for those that already exist """
+    student_ids = [student.id for student in students]
+    course_ids = [course.id for course in courses]
+    mp_ids = [mp.id for mp in marking_periods]
+    if not (student_ids and course_ids and mp_ids):
+        return
+    existing = set(Grade.objects.filter(
+        student__in=student_ids,
+        course__in=course_ids,
+        marking_period__in=mp_ids,
+    ).values_list('student_id', 'course_id', 'marking_period_id'))
+    missing = []
+    for student_id in student_ids:
+        for course_id in course_ids:
+            for mp_id in mp_ids:
+                if (student_id, course_id, mp_id) not in existing:
+                    missing.append(Grade(student_id=student_id, course_id=course_id, marking_period_id=mp_id))
+    Grade.objects.bulk_create(missing)
+
 @permission_required('grades.change_own_grade')
 def teacher_grade(request):
     if Faculty.objects.filter(username=request.user.username):
@@ -136,18 +158,23 @@ def teacher_grade_upload(request, id):
     
     marking_periods = course.marking_period.all().order_by('start_date')
     
-    # Ensure grades exists
-    for mp in marking_periods:
-        for student in students:
-            grade, created = Grade.objects.get_or_create(student=student, course=course, marking_period=mp)
+    ensure_grades_exist(students, [course], marking_periods)
     
+    grades = {}
+    overrides = {}
+    for grade in course.grade_set.filter(student__in=students).select_related('marking_period').order_by('id'):
+        if grade.override_final:
+            overrides.setdefault(grade.student_id, grade)
+        else:
+            grades.setdefault(grade.student_id, []).append(grade)
+    finals = course.get_final_grades(students)
     for student in students:
-        student.grades = student.grade_set.filter(course=course, override_final=False)
-        try:
-            student.final = student.grade_set.get(course=course, override_final=True).get_grade()
+        student.grades = grades.get(student.id, [])
+        if student.id in overrides:
+            student.final = overrides[student.id].get_grade()
             student.final_override = True
-        except Grade.DoesNotExist:
-            student.final = course.calculate_final_grade(student)
+        else:
+            student.final = finals[student.id].grade
     
     if request.user.is_superuser or \
         request.user.has_perm('grades.change_own_final_grade') or \
@@ -334,17 +361,24 @@ def student_gradesheet(request, id, year_id=None):
         school_year = SchoolYear.objects.get(active_year=True)
     courses = courses.filter(marking_period__school_year=school_year).distinct()
     
+    courses = list(courses)
+    ensure_grades_exist([student], courses, school_year.markingperiod_set.all())
+    
+    grades = {}
+    overrides = {}
+    for grade in student.grade_set.filter(course__in=courses).select_related('marking_period').order_by('id'):
+        if grade.override_final:
+            overrides.setdefault(grade.course_id, grade)
+        else:
+            grades.setdefault(grade.course_id, []).append(grade)
+    gpa_data = GPAData([student.id], course_ids=[course.id for course in courses])
     for course in courses:
-        for mp in school_year.markingperiod_set.all():
-            grade, created = Grade.objects.get_or_create(student=student, course=course, marking_period=mp)
-        course.grades = student.grade_set.filter(course=course, override_final=False)
-        
-        try:
-            override_grade = course.grade_set.get(student=student, override_final=True)
-            course.final = unicode(override_grade.get_grade())
+        course.grades = grades.get(course.id, [])
+        if course.id in overrides:
+            course.final = unicode(overrides[course.id].get_grade())
             course.final_override = True  # effects CSS
-        except:
-            course.final = course.calculate_final_grade(student)
+        else:
+            course.final = gpa_data.get_final_grade(student.id, course.id)
     
     marking_periods = MarkingPeriod.objects.filter(course__in=courses).distinct().order_by('start_date')
     
@@ -15,20 +15,20 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 from django.utils.html import strip_tags
-from django.db.models import F
 
 from ecwsp.sis.xlsReport import *
 from ecwsp.sis.report import *
 from ecwsp.sis.helper_functions import Struct
 from ecwsp.administration.models import Template
 from ecwsp.omr.models import *
-from ecwsp.benchmarks.models import Benchmark
+from ecwsp.omr.results import TestResults
 
 import xlwt
 
 class ReportManager(object):
     def download_results(self, test):
         """ Create basic xls report for OMR. Includes summary and details """
+        results = TestResults(test)
         
         # Summary sheet
         data = [[test.name]]
@@ -38,8 +38,8 @@ class ReportManager(object):
         data.append([])
         data.append(['Student', 'Points Earned', 'Percentage'])
         i = 7
-        for ti in test.testinstance_set.annotate(earned=Sum('answerinstance__points_earned')):
-            data.append([ti.student, ti.earned, xlwt.Formula("B%s / $B$2" % i)])
+        for y, ti in enumerate(results.test_instances):
+            data.append([ti.student, results.get_earned(y), xlwt.Formula("B%s / $B$2" % i)])
             i += 1
         #xlwt.Formula("B2")
         report = xlsReport(data, fileName="OMR report.xls", heading="Summary", heading_top=False)
@@ -49,25 +49,24 @@ class ReportManager(object):
         data_answers = []
         row_points = ["Student"]
         row_answers = ["Student"]
-        for question in test.question_set.all():
+        for question in results.questions:
             row_points.append("%s %s" % (question.order, strip_tags(question.question).strip()))
             row_answers.append("%s %s" % (question.order, strip_tags(question.question).strip()))
         data_points.append(row_points)
         data_answers.append(row_answers)
         
-        for test_instance in test.testinstance_set.all():
+        for y, test_instance in enumerate(results.test_instances):
             row_points = []
             row_answers = []
             row_points.append(test_instance.student)
             row_answers.append(test_instance.student)
-            for question in test.question_set.all():
-                try:
-                    answer = test_instance.answerinstance_set.get(question=question)
-                    row_points.append(answer.points_earned)
-                    row_answers.append(strip_tags(answer.answer).strip())
-                except:
+            for x, points in enumerate(results.points[y]):
+                if points is None:
                     row_points.append('')
                     row_answers.append('')
+                else:
+                    row_points.append(points)
+                    row_answers.append(strip_tags(results.get_answer(y, x).answer).strip())
             data_points.append(row_points)
             data_answers.append(row_answers)
         
@@ -78,19 +77,19 @@ class ReportManager(object):
         data = []
         row = ['Benchmark']
         row2 = ['Points Possible']
-        for benchmark in Benchmark.objects.filter(question__test=test).distinct():
+        for benchmark in results.benchmarks:
             row.append(benchmark)
             row.append('%')
-            row2.append(test.question_set.filter(benchmarks=benchmark).aggregate(Sum('point_value'))['point_value__sum'])
+            row2.append(benchmark.points_possible)
             row2.append('')
         data.append(row)
         data.append(row2)
         i = 3 # 3 for third row on spreadsheet
-        for test_instance in test.testinstance_set.all():
+        for y, test_instance in enumerate(results.test_instances):
             row = [test_instance.student]
             a = 98 # the letter c or column c in spreadsheet
-            for benchmark in Benchmark.objects.filter(question__test=test).distinct():
-                row.append(test_instance.answerinstance_set.filter(question__benchmarks=benchmark).aggregate(Sum('points_earned'))['points_earned__sum'])
+            for points in results.benchmark_points[y]:
+                row.append(points)
                 if a <= 122: # 122 = z
                     row.append(xlwt.Formula(chr(a)+str(i)+'/'+chr(a)+'$2'))
                 elif a <= 148:
@@ -104,37 +103,44 @@ class ReportManager(object):
             data.append(row)
         report.addSheet(data, heading="Benchmark", heading_top=False)
         
+        # Item statistics sheet
+        data = [['Question', 'Points Possible', 'P-Value', 'Point Biserial']]
+        for question in results.item_statistics():
+            data.append([
+                "%s %s" % (question.order, strip_tags(question.question).strip()),
+                question.point_value,
+                '' if question.p_value is None else round(question.p_value, 3),
+                '' if question.point_biserial is None else round(question.point_biserial, 3),
+            ])
+        report.addSheet(data, heading="Item Statistics", heading_top=False)
+        
         return report.finish()
         
     def download_student_results(self, test, format, template):
         """ Make appy based report showing results for each student """
         data = get_default_data()
+        results = TestResults(test)
         
-        test_instances = test.testinstance_set.all()
-        benchmarks = Benchmark.objects.filter(question__test=test)
-        
-        for benchmark in benchmarks:
-            benchmark.points_possible = test.question_set.filter(benchmarks=benchmark).aggregate(Sum('point_value'))['point_value__sum']
+        test_instances = results.test_instances
+        benchmarks = results.benchmarks
         
-        for test_instance in test_instances:
+        for y, test_instance in enumerate(test_instances):
             benchmark_instances = []
-            for benchmark in benchmarks:
+            for benchmark, points_earned in zip(benchmarks, results.benchmark_points[y]):
                 benchmark_instance = Struct()
                 benchmark_instance.benchmark = benchmark
                 benchmark_instance.points_possible = benchmark.points_possible
-                benchmark_instance.points_earned = test_instance.answerinstance_set.filter(question__benchmarks=benchmark).aggregate(Sum('points_earned'))['points_earned__sum']
+                benchmark_instance.points_earned = points_earned
                 benchmark_instances.append(benchmark_instance)
             test_instance.benchmarks = benchmark_instances
         
-            test_instance.incorrects = test_instance.answerinstance_set.filter(points_earned__lt=F('points_possible'))
+            test_instance.incorrects = results.get_incorrects(y)
             for incorrect in test_instance.incorrects:
-                try:
-                    incorrect.right_answer = incorrect.question.answer_set.order_by('point_value').reverse()[0]
-                except:
-                    incorrect.right_answer = "No correct answer"
+                incorrect.right_answer = results.get_right_answer(incorrect.question) or "No correct answer"
             
         data['test'] = test
         data['tests'] = test_instances
+        data['questions'] = results.item_statistics()
         
         filename = 'Student Results for ' + unicode(test)
         return pod_save(filename, "." + str(format), data, template)  
@@ -0,0 +1,122 @@
+""" Results of an OMR test as matrices.
+
+TestResults loads the questions, test instances, question benchmarks and
+every AnswerInstance of a test in a handful of queries and pivots them into
+student x question matrices of points and answers and a student x benchmark
+matrix of points. Rows follow test_instances and columns questions or
+benchmarks; a None cell is a question the student has no answer for.
+Both the spreadsheet and the appy reports are written from them, and item
+statistics come from the same matrices.
+"""
+from ecwsp.omr.models import Answer, AnswerInstance, Question
+from ecwsp.benchmarks.models import Benchmark
+
+import math
+
+
+def _mean(values):
+    return float(sum(values)) / len(values)
+
+def _correlation(xs, ys):
+    """ Pearson correlation, None when either variable doesn't vary """
+    if len(xs) < 2:
+        return None
+    mean_x = _mean(xs)
+    mean_y = _mean(ys)
+    covariance = sum([(x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)])
+    variance_x = sum([(x - mean_x) ** 2 for x in xs])
+    variance_y = sum([(y - mean_y) ** 2 for y in ys])
+    if not variance_x or not variance_y:
+        return None
+    return covariance / math.sqrt(variance_x * variance_y)
+
+
+class TestResults(object):
+    def __init__(self, test):
+        self.test = test
+        self.questions = list(test.question_set.all())
+        self.test_instances = list(test.testinstance_set.select_related('student'))
+        question_columns = dict([(question.id, x) for x, question in enumerate(self.questions)])
+        instance_rows = dict([(test_instance.id, y) for y, test_instance in enumerate(self.test_instances)])
+
+        # Points earned and AnswerInstance of each student and question
+        self.points = [[None] * len(self.questions) for test_instance in self.test_instances]
+        self.answer_instances = [[None] * len(self.questions) for test_instance in self.test_instances]
+        questions = dict([(question.id, question) for question in self.questions])
+        answer_instances = AnswerInstance.objects.filter(
+            test_instance__test=test).select_related('answer').order_by('id')
+        for answer_instance in answer_instances:
+            y = instance_rows[answer_instance.test_instance_id]
+            x = question_columns[answer_instance.question_id]
+            answer_instance.question = questions[answer_instance.question_id]
+            answer_instance.test_instance = self.test_instances[y]
+            self.points[y][x] = answer_instance.points_earned
+            self.answer_instances[y][x] = answer_instance
+
+        self.benchmarks = list(Benchmark.objects.filter(question__test=test).distinct())
+        benchmark_columns = dict([(benchmark.id, column) for column, benchmark in enumerate(self.benchmarks)])
+        # [set(benchmark column), ...] of each question
+        self.question_benchmarks = [set() for question in self.questions]
+        for question_id, benchmark_id in Question.benchmarks.through.objects.filter(
+                question__test=test).values_list('question_id', 'benchmark_id'):
+            self.question_benchmarks[question_columns[question_id]].add(benchmark_columns[benchmark_id])
+        for x, benchmark in enumerate(self.benchmarks):
+            benchmark.points_possible = None
+            for question, columns in zip(self.questions, self.question_benchmarks):
+                if x in columns:
+                    benchmark.points_possible = (benchmark.points_possible or 0) + question.point_value
+        # Points earned by each student in each benchmark, None without answers
+        self.benchmark_points = []
+        for row in self.points:
+            benchmark_row = [None] * len(self.benchmarks)
+            for points, columns in zip(row, self.question_benchmarks):
+                if points is None:
+                    continue
+                for x in columns:
+                    benchmark_row[x] = (benchmark_row[x] or 0) + points
+            self.benchmark_points.append(benchmark_row)
+        self.right_answers = None
+
+    def get_earned(self, y):
+        """ Points earned of a test instance, None without answers """
+        points = [value for value in self.points[y] if value is not None]
+        if not points:
+            return None
+        return sum(points)
+
+    def get_answer(self, y, x):
+        """ The Answer a student gave to a question, or None """
+        answer_instance = self.answer_instances[y][x]
+        if answer_instance is None:
+            return None
+        return answer_instance.answer
+
+    def get_right_answer(self, question):
+        """ The answer of a question worth the most points, or None """
+        if self.right_answers is None:
+            self.right_answers = {}
+            for answer in Answer.objects.filter(question__test=self.test).order_by('-point_value'):
+                self.right_answers.setdefault(answer.question_id, answer)
+        return self.right_answers.get(question.id)
+
+    def get_incorrects(self, y):
+        """ AnswerInstances of a test instance worth less than their points possible """
+        return sorted([answer_instance for answer_instance in self.answer_instances[y]
+                       if answer_instance is not None and answer_instance.points_earned < answer_instance.points_possible],
+                      key=lambda answer_instance: answer_instance.id)
+
+    def item_statistics(self):
+        """ Set question.p_value, the mean share of the question's points
+        students earned, and question.point_biserial, the correlation of that
+        share with students' points earned on the whole test. Only tests with
+        results received count, unanswered questions as no points """
+        rows = [y for y, test_instance in enumerate(self.test_instances) if test_instance.results_received]
+        totals = [self.get_earned(y) or 0 for y in rows]
+        for x, question in enumerate(self.questions):
+            question.p_value = question.point_biserial = None
+            if not rows or not question.point_value:
+                continue
+            scores = [float(self.points[y][x] or 0) / question.point_value for y in rows]
+            question.p_value = _mean(scores)
+            question.point_biserial = _correlation(scores, totals)
+        return self.questions
@@ -14,3 +14,48 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class TestResultsTest(TestCase):
+    def test_matrices(self):
+        from ecwsp.sis.models import Student
+        from ecwsp.benchmarks.models import Benchmark
+        from ecwsp.omr.models import Test, Question, Answer, TestInstance, AnswerInstance
+        from ecwsp.omr.results import TestResults
+        import math
+        test = Test.objects.create(name="Quiz")
+        benchmarks = [Benchmark.objects.create(name="B%s" % (i,)) for i in range(2)]
+        questions = []
+        answers = []
+        for i, (point_value, question_benchmarks) in enumerate(((1, benchmarks[:1]), (2, benchmarks))):
+            question = Question.objects.create(test=test, question="Q%s" % (i,), point_value=point_value)
+            question.benchmarks = question_benchmarks
+            questions.append(question)
+            answers.append((Answer.objects.create(question=question, answer="Right", point_value=point_value),
+                            Answer.objects.create(question=question, answer="Wrong", point_value=0)))
+        instances = []
+        for i, picks in enumerate(((0, 0), (0, 1), (1, None))):
+            student = Student.objects.create(fname="Joe", lname="Student%s" % (i,), username="jstudent%s" % (i,))
+            instance = TestInstance.objects.create(test=test, student=student, results_received=True)
+            for question, question_answers, pick in zip(questions, answers, picks):
+                if pick is not None:
+                    AnswerInstance.objects.create(test_instance=instance, question=question, answer=question_answers[pick],
+                        points_earned=question_answers[pick].point_value, points_possible=question.point_value)
+            instances.append(instance)
+
+        results = TestResults(test)
+        rows = dict([(test_instance.id, y) for y, test_instance in enumerate(results.test_instances)])
+        rows = [rows[test_instance.id] for test_instance in instances]
+        self.assertEqual([results.points[y] for y in rows], [[1, 2], [1, 0], [0, None]])
+        self.assertEqual([results.get_earned(y) for y in rows], [3, 1, 0])
+        by_benchmark = dict([(benchmark.id, x) for x, benchmark in enumerate(results.benchmarks)])
+        self.assertEqual([[results.benchmark_points[y][by_benchmark[benchmark.id]] for benchmark in benchmarks] for y in rows],
+            [[3, 2], [1, 0], [0, None]])
+        self.assertEqual([benchmark.points_possible for benchmark in sorted(results.benchmarks, key=lambda b: b.name)], [3, 2])
+        incorrects = results.get_incorrects(rows[1])
+        self.assertEqual([incorrect.question for incorrect in incorrects], [questions[1]])
+        self.assertEqual(results.get_right_answer(incorrects[0].question), answers[1][0])
+        statistics = results.item_statistics()
+        self.assertAlmostEqual(statistics[0].p_value, 2.0 / 3)
+        self.assertAlmostEqual(statistics[1].p_value, 1.0 / 3)
+        self.assertAlmostEqual(statistics[0].point_biserial, 4 / math.sqrt(28))
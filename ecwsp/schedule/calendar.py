@@ -21,17 +21,16 @@
 # Handles all calendar operations to create ical files and sync
 # with Google calendar
 
-from ecwsp.schedule.models import *
 from ecwsp.sis.models import SchoolYear
 from ecwsp.administration.models import Configuration
+from ecwsp.schedule.schedule_grid import get_schedule_grids
+from ecwsp.schedule.locator import get_location_index
 
 #import vobject
 from datetime import datetime
 
 def get_active_class_config():
-    if Configuration.get_or_default("Only Active Classes in Schedule", None).value == "True" \
-    or Configuration.get_or_default("Only Active Classes in Schedule", None).value == "true" \
-    or Configuration.get_or_default("Only Active Classes in Schedule", None).value == "T":
+    if Configuration.get_bool("Only Active Classes in Schedule"):
         return "True"
     else:
         return "False"
@@ -44,43 +43,28 @@ class Calendar:
         
     def find_student(self, student, date=None):
         """ Find a student's current location.
-        date: defaults to right now. """
+        date: defaults to right now.
+        Returns the Location or None when the student isn't in a class """
         if not date:
             date = datetime.now()
-        mps = MarkingPeriod.objects.filter(start_date__lt=date, end_date__gt=date)
-        periods = Period.objects.filter(start_time__lt=date, end_time__gt=date)
-        day = date.isoweekday()
-        courses = Course.objects.filter(marking_period__in=mps, periods__in=periods, enrollments__student=student)
-        course_meet = CourseMeet.objects.filter(course__in=courses, day=day, period__in=periods)
-        return course_meet[0].location
+        course_meet = get_location_index(date.date()).find(student, date)
+        if course_meet:
+            return course_meet.location
     
+    def find_students(self, date=None):
+        """ Where every scheduled student is at once
+        Returns {student.id: CourseMeet} """
+        if not date:
+            date = datetime.now()
+        return get_location_index(date.date()).everyone(date)
     
     def build_schedule(self, student, marking_period, include_asp=False):
         """
         Returns days ['Monday', 'Tuesday'...] and periods
         """
-        periods = Period.objects.filter(course__courseenrollment__user=student, course__marking_period=marking_period).order_by('start_time').distinct()
-        course_meets = CourseMeet.objects.filter(course__courseenrollment__user=student, course__marking_period=marking_period).distinct()
-        
-        days = []
-        arr_days = []
-        for day in CourseMeet.day_choice:
-            if course_meets.filter(day=day[0]).count():
-                days.append(day[1])
-                arr_days.append(day)
-                
-        for period in periods:
-            period.days = []
-            for day in arr_days:
-                if Configuration.get_or_default("Only Active Classes in Schedule", "False").value == "True" \
-                or Configuration.get_or_default("Only Active Classes in Schedule", "False").value == "true" \
-                or Configuration.get_or_default("Only Active Classes in Schedule", "False").value == "T":
-                    course = course_meets.filter(day=day[0], period=period, course__active=True)
-                else:
-                    course = course_meets.filter(day=day[0], period=period)
-                if course.count():
-                    period.days.append(course[0])
-                else:
-                    period.days.append(None)
-            CourseMeet.objects.filter(course__courseenrollment__user=student, course__marking_period=marking_period, ).distinct()
-        return days, periods
+        return get_schedule_grids([student], marking_period)[student.id]
+    
+    def build_schedules(self, students, marking_period):
+        """ build_schedule for many students at once
+        Returns {student.id: (days, periods)} """
+        return get_schedule_grids(students, marking_period)
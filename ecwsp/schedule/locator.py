@@ -0,0 +1,96 @@
+""" Where students are supposed to be right now.
+
+LocationIndex maps (student, weekday, period) to the CourseMeet the student
+attends then, for every marking period in session on a date. It is built from
+three queries and kept in the schedule cache for that date for at most
+LOCATION_INDEX_TIMEOUT seconds. The key has a version replaced when an
+enrollment, course, course meet, period, location or marking period is saved
+or deleted and the highest id and number of enrollments and course meets, so
+the emergency report sees rows inserted by any process, signals or not.
+Looking up a student, or every student at once, is then a dictionary access.
+"""
+from ecwsp.schedule.schedule_cache import schedule_cache, schedule_cache_timeout, get_version, new_version
+from ecwsp.schedule.schedule_cache import data_version
+
+import datetime
+
+# Seconds an index is used at most, changes no version catches show up after that
+LOCATION_INDEX_TIMEOUT = 60
+
+
+class LocationIndex(object):
+    def __init__(self, day):
+        from ecwsp.schedule.models import Period, MarkingPeriod, CourseEnrollment, CourseMeet
+        self.date = day
+        self.periods = list(Period.objects.order_by('start_time'))
+        # {(weekday, period_id): {student_id: course_meet}}
+        self.meets = {}
+
+        marking_periods = MarkingPeriod.objects.filter(start_date__lte=day, end_date__gte=day)
+        # {course_id: set(student_id)}
+        course_students = {}
+        # Days each enrolled student is excused from a course
+        excluded = set()
+        enrollments = CourseEnrollment.objects.filter(
+            course__marking_period__in=marking_periods,
+        ).values_list('user', 'course', 'exclude_days__day').distinct()
+        for student_id, course_id, exclude_day in enrollments:
+            course_students.setdefault(course_id, set()).add(student_id)
+            if exclude_day:
+                excluded.add((student_id, course_id, exclude_day))
+        if not course_students:
+            return
+        course_meets = CourseMeet.objects.filter(
+            course__in=course_students.keys(),
+        ).select_related('course__teacher', 'location', 'period').order_by('id')
+        for course_meet in course_meets:
+            meets = self.meets.setdefault((course_meet.day, course_meet.period_id), {})
+            for student_id in course_students[course_meet.course_id]:
+                if (student_id, course_meet.course_id, course_meet.day) not in excluded:
+                    # Like the schedule, the first course meet wins
+                    meets.setdefault(student_id, course_meet)
+
+    def get_period(self, time):
+        """ Period going on at time, or None between periods """
+        for period in self.periods:
+            if period.start_time <= time < period.end_time:
+                return period
+
+    def get(self, student_id, weekday, period_id):
+        """ CourseMeet of a student on an isoweekday and period, or None """
+        return self.meets.get((unicode(weekday), period_id), {}).get(student_id)
+
+    def everyone(self, when):
+        """ {student_id: CourseMeet} of every student scheduled at datetime when """
+        period = self.get_period(when.time())
+        if period is None:
+            return {}
+        return self.meets.get((unicode(when.isoweekday()), period.id), {})
+
+    def find(self, student, when):
+        """ CourseMeet of a student (or student id) at datetime when, or None """
+        return self.everyone(when).get(getattr(student, 'id', student))
+
+
+def get_location_index(day=None):
+    """ LocationIndex for a date, defaults to today """
+    from ecwsp.schedule.models import CourseEnrollment, CourseMeet
+    if day is None:
+        day = datetime.date.today()
+    key = 'location_index:%s:%s:%s' % (
+        day.isoformat(), get_version('location_index'), data_version(CourseEnrollment, CourseMeet))
+    cache = schedule_cache()
+    index = cache.get(key)
+    if index is None:
+        index = LocationIndex(day)
+        cache.set(key, index, min(LOCATION_INDEX_TIMEOUT, schedule_cache_timeout()))
+    return index
+
+
+def clear_location_index():
+    """ Stop using the cached indexes, for writes that send no signals """
+    new_version('location_index')
+
+
+def schedule_locations_changed(sender, **kwargs):
+    clear_location_index()
@@ -1,13 +1,16 @@
 from django.db import models
 from django.db.models import Max
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.contrib import messages
 from django.conf import settings
 
 from ecwsp.sis.models import Student
 from ecwsp.administration.models import Configuration
+from ecwsp.schedule.school_days import get_marking_period_days, marking_period_days_changed, days_off_pre_save, days_off_changed
+from ecwsp.schedule.schedule_grid import enrollment_changed, schedule_changed
+from ecwsp.schedule.locator import schedule_locations_changed
 
-from datetime import date, datetime, timedelta
-from decimal import Decimal, ROUND_HALF_UP
+from datetime import date, datetime
 import copy
 
 def duplicate(obj, changes=None):
@@ -60,35 +63,14 @@ class MarkingPeriod(models.Model):
         if self.start_date > self.end_date:
             raise ValidationError('Cannot end before starting!')
         
-    def get_number_days(self, date=date.today()):
-        """ Get number of days in a marking period"""
+    def get_number_days(self, date=None):
+        """ Get number of days in a marking period
+        date: Defaults to today, count days up to this date"""
+        if date is None:
+            date = datetime.today().date()
         if (self.school_days or self.school_days == 0) and date >= self.end_date:
             return self.school_days
-        day = 0
-        current_day = self.start_date
-        while current_day <= date:
-            is_day = False
-            if current_day >= self.start_date and current_day <= self.end_date:
-                days_off = []
-                for d in self.daysoff_set.all().values_list('date'): days_off.append(d[0])
-                if not current_day in days_off:
-                    if self.monday and current_day.isoweekday() == 1:
-                        is_day = True
-                    elif self.tuesday and current_day.isoweekday() == 2:
-                        is_day = True
-                    elif self.wednesday and current_day.isoweekday() == 3:
-                        is_day = True
-                    elif self.thursday and current_day.isoweekday() == 4:
-                        is_day = True
-                    elif self.friday and current_day.isoweekday() == 5:
-                        is_day = True
-                    elif self.saturday and current_day.isoweekday() == 6:
-                        is_day = True
-                    elif self.sunday and current_day.isoweekday() == 7:
-                        is_day = True
-            if is_day: day += 1
-            current_day += timedelta(days=1)
-        return day
+        return get_marking_period_days(self).count(end=date)
         
 class DaysOff(models.Model):
     date = models.DateField()
@@ -97,6 +79,11 @@ class DaysOff(models.Model):
     def __unicode__(self):
         return unicode(self.date)
 
+post_save.connect(marking_period_days_changed, sender=MarkingPeriod)
+post_delete.connect(marking_period_days_changed, sender=MarkingPeriod)
+pre_save.connect(days_off_pre_save, sender=DaysOff)
+post_save.connect(days_off_changed, sender=DaysOff)
+post_delete.connect(days_off_changed, sender=DaysOff)
 
 class Period(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -180,16 +167,38 @@ class Department(models.Model):
     name = models.CharField(max_length=255, unique=True)
     order_rank = models.IntegerField(blank=True, null=True, help_text="Rank that courses will show up in reports")
     def get_graduation_credits(self, student):
-        try:
-            # We have a credits requirement explicitly matching this student's class year
-            graduation_credits_object = self.departmentgraduationcredits_set.get(class_year=student.class_of_year)
-        except DepartmentGraduationCredits.DoesNotExist:
-            # No explicit match, so find the most recent requirement that went into effect *before* this marking period's school year
-            try:
-                graduation_credits_object = self.departmentgraduationcredits_set.filter(class_year__year__lt=student.class_of_year.year).order_by('-class_year__year')[0]
-            except IndexError:
-                return None
-        return graduation_credits_object.credits
+        return Department.get_graduation_credits_for((student,), (self,)).get((self.id, student.id))
+    
+    @staticmethod
+    def get_graduation_credits_for(students, departments=None):
+        """ Graduation credits required of many students in many departments
+        from two queries.
+        students: Students or student ids
+        departments: Departments or ids, defaults to all
+        Returns {(department_id, student_id): credits}, without the pairs that
+        have no requirement """
+        requirements = DepartmentGraduationCredits.objects.all()
+        if departments is not None:
+            requirements = requirements.filter(department__in=departments)
+        # {department_id: [(class year, credits), ...]} most recent first
+        by_department = {}
+        for department_id, year, credits in requirements.values_list(
+                'department_id', 'class_year__year', 'credits').order_by('-class_year__year'):
+            by_department.setdefault(department_id, []).append((year, credits))
+        student_ids = [getattr(student, 'id', student) for student in students]
+        class_years = Student.objects.filter(id__in=student_ids).values_list('id', 'class_of_year__year')
+        results = {}
+        for student_id, class_year in class_years:
+            if class_year is None:
+                continue
+            for department_id, department_requirements in by_department.items():
+                # A requirement explicitly matching the student's class year,
+                # or else the most recent one that went into effect before it
+                for year, credits in department_requirements:
+                    if year <= class_year:
+                        results[(department_id, student_id)] = credits
+                        break
+        return results
     def __unicode__(self):
         return unicode(self.name)
     class Meta:
@@ -257,16 +266,11 @@ class Course(models.Model):
     
     def is_passing(self, student, date_report=None):
         """ Is student passing course? """
-        pass_score = float(Configuration.get_or_default("Passing Grade", '70').value)
+        from ecwsp.sis.gpa import is_passing_grade
+        pass_score = Configuration.get_decimal("Passing Grade", '70')
         grade = self.get_final_grade(student, date_report=date_report)
-        try:
-            if grade >= int(pass_score):
-                return True
-        except:
-            pass_letters = Configuration.get_or_default("Letter Passing Grade", 'A,B,C,P').value
-            if grade in pass_letters.split(','):
-                return True
-        return False
+        pass_letters = Configuration.get_or_default("Letter Passing Grade", 'A,B,C,P').value
+        return is_passing_grade(grade, pass_score, pass_letters)
     
     def get_attendance_students(self):
         """ Should be one line of code. Sorry this is so aweful
@@ -320,40 +324,31 @@ class Course(models.Model):
         """
         if 'ecwsp.grades' in settings.INSTALLED_APPS:
             from ecwsp.grades.models import Grade
-            final = Decimal(0)
-            number = 0
-            letter_grade = False
-            grades =  Grade.objects.filter(student=student, course=self)
+            from ecwsp.sis.gpa import grade_value, final_grade_from_values
+            grades = Grade.objects.filter(student=student, course=self)
             if date_report:
                 grades = grades.filter(marking_period__end_date__lte=date_report)
-            for grade in grades:
-                try:
-                    final += grade.get_grade()
-                    number += 1
-                # otherwise it's a letter grade.
-                except TypeError:
-                    # I (Incomplete) results in the final grade being I
-                    if grade.get_grade() == "I":
-                        return "I"
-                    elif grade.get_grade() in ["P","HP","LP"]:
-                        final += 100
-                        number += 1
-                        letter_grade = True
-                    elif grade.get_grade() == 'F':
-                        number += 1
-                        letter_grade = True
-                    
-            if number != 0:
-                final = final / number
-                final = Decimal(final).quantize(Decimal("0.01"), ROUND_HALF_UP)
-                if letter_grade == True:
-                    if final > int(Configuration.get_or_default('letter_grade_required_for_pass', '60').value):
-                        return "P"
-                    else:
-                        return "F"
-            else:
-                final = None
-            return final
+            values = [grade_value(grade, letter_grade) for grade, letter_grade in
+                      grades.values_list('grade', 'letter_grade')]
+            return final_grade_from_values(
+                values, Configuration.get_int('letter_grade_required_for_pass', 60))
+    
+    def get_final_grades(self, students=None, date_report=None, include_latest_mid=False):
+        """ Final grade, pass/fail and credits earned of many students from one
+        grade query, same results as get_final_grade, is_passing and
+        get_credits_earned.
+        students: Students or student ids, defaults to everyone enrolled
+        Returns {student_id: Struct with grade, passing and credits} """
+        from ecwsp.sis.gpa import GPAData
+        if students is None:
+            students = self.get_enrolled_students(show_deleted=True)
+        student_ids = [getattr(student, 'id', student) for student in students]
+        gpa_data = GPAData(student_ids, course_ids=[self.id])
+        results = {}
+        for student_id in student_ids:
+            results[student_id] = gpa_data.get_course_result(
+                student_id, self.id, date_report, include_latest_mid)
+        return results
     
     def copy_instance(self, request):
         changes = (("fullname", self.fullname + " copy"),)
@@ -369,6 +364,32 @@ class Course(models.Model):
         messages.success(request, 'Copy successful!')
         
         
+post_save.connect(enrollment_changed, sender=CourseEnrollment)
+post_delete.connect(enrollment_changed, sender=CourseEnrollment)
+post_save.connect(schedule_changed, sender=Course)
+post_delete.connect(schedule_changed, sender=Course)
+post_save.connect(schedule_changed, sender=CourseMeet)
+post_delete.connect(schedule_changed, sender=CourseMeet)
+post_save.connect(schedule_changed, sender=Period)
+post_delete.connect(schedule_changed, sender=Period)
+post_save.connect(schedule_changed, sender=Location)
+post_delete.connect(schedule_changed, sender=Location)
+m2m_changed.connect(schedule_changed, sender=Course.marking_period.through)
+post_save.connect(schedule_locations_changed, sender=CourseEnrollment)
+post_delete.connect(schedule_locations_changed, sender=CourseEnrollment)
+post_save.connect(schedule_locations_changed, sender=Course)
+post_delete.connect(schedule_locations_changed, sender=Course)
+post_save.connect(schedule_locations_changed, sender=CourseMeet)
+post_delete.connect(schedule_locations_changed, sender=CourseMeet)
+post_save.connect(schedule_locations_changed, sender=Period)
+post_delete.connect(schedule_locations_changed, sender=Period)
+post_save.connect(schedule_locations_changed, sender=Location)
+post_delete.connect(schedule_locations_changed, sender=Location)
+post_save.connect(schedule_locations_changed, sender=MarkingPeriod)
+post_delete.connect(schedule_locations_changed, sender=MarkingPeriod)
+m2m_changed.connect(schedule_locations_changed, sender=Course.marking_period.through)
+m2m_changed.connect(schedule_locations_changed, sender=CourseEnrollment.exclude_days.through)
+
 class OmitCourseGPA(models.Model):
     """ Used to keep repeated or invalid course from affecting GPA """
     student = models.ForeignKey('sis.Student')
@@ -0,0 +1,63 @@
+""" Cache of values computed from the schedule.
+
+Schedule grids, the student location index and school day counts are built
+from several tables and read far more often than those change. They are kept
+in the Django cache named by settings.SCHEDULE_CACHE, for at most
+SCHEDULE_CACHE_TIMEOUT seconds, under keys that include a version of what they
+were built from. Saving or deleting a model gives a new version through
+signals and code writing without signals (bulk_create, update) asks for one
+itself, so no process sharing the cache reads the old values again. With a
+cache local to each process, like the default LocMemCache, other processes see
+such changes when their entries time out unless the key also has a version
+read from the database (data_version).
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import Count, Max
+
+import uuid
+
+
+def schedule_cache():
+    return get_cache(getattr(settings, 'SCHEDULE_CACHE', 'default'))
+
+def schedule_cache_timeout():
+    return getattr(settings, 'SCHEDULE_CACHE_TIMEOUT', 300)
+
+def _version_key(name):
+    return 'schedule_version:%s' % (name,)
+
+
+def get_versions(names):
+    """ {name: version} of cached values, names without a version get one """
+    cache = schedule_cache()
+    keys = dict([(_version_key(name), name) for name in names])
+    cached = cache.get_many(keys.keys())
+    missing = dict([(key, uuid.uuid4().hex) for key in keys if key not in cached])
+    if missing:
+        cache.set_many(missing, schedule_cache_timeout())
+        cached.update(missing)
+    return dict([(name, cached[key]) for key, name in keys.items()])
+
+def get_version(name):
+    return get_versions([name])[name]
+
+
+def new_versions(names):
+    """ Stop reading values cached under the current versions of names """
+    versions = dict([(_version_key(name), uuid.uuid4().hex) for name in set(names)])
+    if versions:
+        schedule_cache().set_many(versions, schedule_cache_timeout())
+
+def new_version(name):
+    new_versions([name])
+
+
+def data_version(*models):
+    """ Highest id and number of rows of each model, which changes with any
+    insert or delete even when no signal was sent """
+    version = []
+    for model in models:
+        row = model.objects.aggregate(Max('id'), Count('id'))
+        version.append('%s.%s' % (row['id__max'], row['id__count']))
+    return '-'.join(version)
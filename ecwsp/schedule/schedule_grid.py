@@ -0,0 +1,112 @@
+""" Weekly schedule grids of students.
+
+A grid is the days a student has classes in a marking period and, for every
+period, the CourseMeet of each of those days (or None). Grids are built for any
+number of students from one query of enrollments and one of course meets, and
+kept in the schedule cache by (student, marking period). Saving or deleting an
+enrollment gives its student's grids a new version, a course, course meet,
+period or location every grid. See ecwsp.schedule.schedule_cache.
+"""
+from ecwsp.administration.models import Configuration
+from ecwsp.schedule.schedule_cache import schedule_cache, schedule_cache_timeout, get_version, get_versions
+from ecwsp.schedule.schedule_cache import new_version, new_versions
+
+import copy
+
+# Students per enrollment query
+GRID_CHUNK = 500
+
+
+def _build_grids(student_ids, marking_period, only_active_classes):
+    """ {student_id: (days, [(period, [course_meet or None, ...]), ...])} """
+    from ecwsp.schedule.models import CourseEnrollment, CourseMeet
+    # {student_id: set(course_id)}
+    courses = {}
+    enrollments = CourseEnrollment.objects.filter(
+        user__in=student_ids,
+        course__marking_period=marking_period,
+    ).values_list('user', 'course').distinct()
+    for student_id, course_id in enrollments:
+        courses.setdefault(student_id, set()).add(course_id)
+    # {course_id: [course_meet, ...]}
+    course_meets = {}
+    course_ids = set().union(*courses.values())
+    if course_ids:
+        for course_meet in CourseMeet.objects.filter(course__in=course_ids).select_related(
+                'period', 'course', 'location').order_by('id'):
+            course_meets.setdefault(course_meet.course_id, []).append(course_meet)
+
+    grids = {}
+    for student_id in student_ids:
+        meets = []
+        for course_id in courses.get(student_id, []):
+            meets += course_meets.get(course_id, [])
+        meets.sort(key=lambda course_meet: course_meet.id)
+        meet_days = set([course_meet.day for course_meet in meets])
+        days = [day for day in CourseMeet.day_choice if day[0] in meet_days]
+        periods = dict([(course_meet.period_id, course_meet.period) for course_meet in meets])
+        periods = sorted(periods.values(), key=lambda period: (period.start_time, period.id))
+        # First course meet of each (day, period)
+        cells = {}
+        for course_meet in meets:
+            if only_active_classes and not course_meet.course.active:
+                continue
+            cells.setdefault((course_meet.day, course_meet.period_id), course_meet)
+        rows = [(period, [cells.get((day[0], period.id)) for day in days]) for period in periods]
+        grids[student_id] = ([day[1] for day in days], rows)
+    return grids
+
+
+def _student_version_name(student_id):
+    return 'schedule_grid_student:%s' % (student_id,)
+
+
+def get_schedule_grids(students, marking_period):
+    """ Schedules of many students in a marking period
+    students: Students or student ids
+    Returns {student_id: (days, periods)}, days are names such as 'Monday' and each
+    period has a days attribute listing the CourseMeet (or None) of each day """
+    only_active_classes = Configuration.get_bool("Only Active Classes in Schedule")
+    student_ids = [getattr(student, 'id', student) for student in students]
+    version = get_version('schedule_grid')
+    student_versions = get_versions([_student_version_name(student_id) for student_id in set(student_ids)])
+    keys = dict([(student_id, 'schedule_grid:%s:%s:%s:%s:%s' % (
+        version, student_versions[_student_version_name(student_id)], student_id, marking_period.id,
+        int(only_active_classes))) for student_id in student_ids])
+    cache = schedule_cache()
+    grids = cache.get_many(keys.values())
+    missing = [student_id for student_id in keys if keys[student_id] not in grids]
+    for i in range(0, len(missing), GRID_CHUNK):
+        built = _build_grids(missing[i:i + GRID_CHUNK], marking_period, only_active_classes)
+        built = dict([(keys[student_id], grid) for student_id, grid in built.items()])
+        cache.set_many(built, schedule_cache_timeout())
+        grids.update(built)
+
+    schedules = {}
+    for student_id in student_ids:
+        days, rows = grids[keys[student_id]]
+        # Copies, callers may change them and other students share the periods
+        periods = []
+        for period, cells in rows:
+            period = copy.copy(period)
+            period.days = list(cells)
+            periods.append(period)
+        schedules[student_id] = (list(days), periods)
+    return schedules
+
+
+def clear_schedule_grids(student_id=None):
+    """ Drop the cached grids of a student, or of everyone """
+    if student_id is None:
+        new_version('schedule_grid')
+    else:
+        new_versions([_student_version_name(student_id)])
+
+
+def enrollment_changed(sender, instance, **kwargs):
+    clear_schedule_grids(instance.user_id)
+
+
+def schedule_changed(sender, **kwargs):
+    """ Courses, course meets, periods and locations can be in anyone's grid """
+    clear_schedule_grids()
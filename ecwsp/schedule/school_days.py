@@ -0,0 +1,146 @@
+""" Counting school (instructional) days without walking the calendar.
+
+Days are counted as full weeks times the number of school weekdays plus the
+remaining few days, minus the days off. Weekdays and days off of each marking
+period are kept in the schedule cache and dropped whenever the marking period
+or one of its days off is saved or deleted.
+"""
+from ecwsp.schedule.schedule_cache import schedule_cache, schedule_cache_timeout, get_version, new_version
+
+from datetime import timedelta
+
+
+def count_weekdays(start, end, weekdays):
+    """ Number of days from start to end (inclusive) whose isoweekday is in weekdays """
+    if end < start or not weekdays:
+        return 0
+    total = (end - start).days + 1
+    full_weeks, remainder = divmod(total, 7)
+    count = full_weeks * len(weekdays)
+    weekday = start.isoweekday()
+    for i in range(remainder):
+        if (weekday + i - 1) % 7 + 1 in weekdays:
+            count += 1
+    return count
+
+
+class MarkingPeriodDays(object):
+    """ What is needed to know if a date is a school day in a marking period """
+    def __init__(self, marking_period, days_off):
+        self.start_date = marking_period.start_date
+        self.end_date = marking_period.end_date
+        self.weekdays = frozenset(number for number, enabled in enumerate((
+            marking_period.monday,
+            marking_period.tuesday,
+            marking_period.wednesday,
+            marking_period.thursday,
+            marking_period.friday,
+            marking_period.saturday,
+            marking_period.sunday,
+        ), 1) if enabled)
+        self.days_off = frozenset(days_off)
+
+    def is_school_day(self, day):
+        return (self.start_date <= day <= self.end_date and
+                day.isoweekday() in self.weekdays and
+                day not in self.days_off)
+
+    def count(self, start=None, end=None):
+        """ School days from start to end inclusive, clipped to the marking period """
+        if start is None or start < self.start_date:
+            start = self.start_date
+        if end is None or end > self.end_date:
+            end = self.end_date
+        if end < start:
+            return 0
+        days_off = len([day for day in self.days_off
+                        if start <= day <= end and day.isoweekday() in self.weekdays])
+        return count_weekdays(start, end, self.weekdays) - days_off
+
+
+def _cache_key(marking_period_id):
+    return 'school_days:%s:%s' % (get_version('school_days'), marking_period_id)
+
+
+def get_marking_period_days(marking_period):
+    """ Cached MarkingPeriodDays for a marking period """
+    cache = schedule_cache()
+    key = _cache_key(marking_period.id)
+    days = cache.get(key)
+    if days is None:
+        days_off = marking_period.daysoff_set.values_list('date', flat=True)
+        days = MarkingPeriodDays(marking_period, days_off)
+        cache.set(key, days, schedule_cache_timeout())
+    return days
+
+
+def clear_school_days_cache(marking_period_id=None):
+    if marking_period_id is None:
+        new_version('school_days')
+    else:
+        schedule_cache().delete(_cache_key(marking_period_id))
+
+
+def instructional_days_between(marking_periods, start, end):
+    """ Number of dates from start to end inclusive that are a school day in
+    at least one of marking_periods. Overlapping marking periods count a date once. """
+    if end < start:
+        return 0
+    periods = [get_marking_period_days(mp) for mp in marking_periods]
+    # Split the range wherever a marking period starts or stops so each
+    # segment is covered by the same marking periods from end to end.
+    boundaries = set([start, end + timedelta(days=1)])
+    for period in periods:
+        for boundary in (period.start_date, period.end_date + timedelta(days=1)):
+            if start < boundary <= end:
+                boundaries.add(boundary)
+    boundaries = sorted(boundaries)
+    count = 0
+    for segment_start, next_start in zip(boundaries, boundaries[1:]):
+        segment_end = next_start - timedelta(days=1)
+        covering = [period for period in periods
+                    if period.start_date <= segment_start and segment_end <= period.end_date]
+        if len(covering) == 1:
+            count += covering[0].count(segment_start, segment_end)
+        elif covering:
+            weekdays = frozenset().union(*[period.weekdays for period in covering])
+            count += count_weekdays(segment_start, segment_end, weekdays)
+            # Only days off in every covering marking period are lost
+            candidates = frozenset().union(*[period.days_off for period in covering])
+            for day in candidates:
+                if (segment_start <= day <= segment_end and day.isoweekday() in weekdays and
+                    not [period for period in covering if period.is_school_day(day)]):
+                    count -= 1
+    return count
+
+
+def get_school_day_number(day, marking_periods=None):
+    """ Which school day of the year day is, counting from the first marking period
+    marking_periods: defaults to the active year's marking periods """
+    if marking_periods is None:
+        from ecwsp.schedule.models import MarkingPeriod
+        marking_periods = MarkingPeriod.objects.filter(school_year__active_year=True)
+    marking_periods = sorted(marking_periods, key=lambda mp: mp.start_date)
+    if not marking_periods:
+        return 0
+    return instructional_days_between(marking_periods, marking_periods[0].start_date, day)
+
+
+def marking_period_days_changed(sender, instance, **kwargs):
+    clear_school_days_cache(instance.id)
+
+
+def days_off_pre_save(sender, instance, **kwargs):
+    """ Remember the marking period an existing day off belonged to, in case it moves """
+    instance._school_days_old_marking_period_id = None
+    if instance.pk:
+        old = sender.objects.filter(pk=instance.pk).values_list('marking_period_id', flat=True)
+        if old:
+            instance._school_days_old_marking_period_id = old[0]
+
+
+def days_off_changed(sender, instance, **kwargs):
+    clear_school_days_cache(instance.marking_period_id)
+    old_marking_period_id = getattr(instance, '_school_days_old_marking_period_id', None)
+    if old_marking_period_id is not None and old_marking_period_id != instance.marking_period_id:
+        clear_school_days_cache(old_marking_period_id)
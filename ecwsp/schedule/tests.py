@@ -7,6 +7,17 @@ Replace these with more appropriate tests for your application.
 
 from django.test import TestCase
 
+from ecwsp.sis.models import SchoolYear, Student, ClassYear
+from ecwsp.schedule.models import MarkingPeriod, DaysOff, Period, Course, CourseMeet, CourseEnrollment, Location, Day
+from ecwsp.schedule.models import Department, DepartmentGraduationCredits
+from ecwsp.grades.models import Grade
+from ecwsp.schedule.school_days import get_school_day_number
+from ecwsp.schedule.schedule_grid import clear_schedule_grids
+from ecwsp.schedule.calendar import Calendar
+
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
 class SimpleTest(TestCase):
     def test_basic_addition(self):
         """
@@ -14,6 +25,162 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class SchoolDaysTest(TestCase):
+    def walk_days(self, mps, end):
+        """ Count the slow way, one date at a time """
+        count = 0
+        day = min([mp.start_date for mp in mps])
+        while day <= end:
+            for mp in mps:
+                weekdays = (mp.monday, mp.tuesday, mp.wednesday, mp.thursday, mp.friday, mp.saturday, mp.sunday)
+                if (mp.start_date <= day <= mp.end_date and weekdays[day.weekday()] and
+                    not mp.daysoff_set.filter(date=day).count()):
+                    count += 1
+                    break
+            day += timedelta(days=1)
+        return count
+    
+    def test_school_days(self):
+        year = SchoolYear.objects.create(name="2012", start_date=date(2012,8,27), end_date=date(2013,6,14), active_year=True)
+        mp1 = MarkingPeriod.objects.create(name="S1", shortname="S1", school_year=year,
+            start_date=date(2012,8,27), end_date=date(2013,1,18))
+        # Overlaps the first semester with Saturday school
+        mp2 = MarkingPeriod.objects.create(name="S2", shortname="S2", school_year=year,
+            start_date=date(2013,1,14), end_date=date(2013,6,14), saturday=True)
+        DaysOff.objects.create(marking_period=mp1, date=date(2012,11,22))
+        DaysOff.objects.create(marking_period=mp1, date=date(2013,1,15))
+        DaysOff.objects.create(marking_period=mp2, date=date(2013,1,15))
+        DaysOff.objects.create(marking_period=mp2, date=date(2013,1,16))
+        for end in (date(2012,8,26), date(2012,11,22), date(2013,1,16), date(2013,1,19), date(2013,6,14)):
+            self.assertEqual(get_school_day_number(end), self.walk_days([mp1, mp2], end))
+            self.assertEqual(mp1.get_number_days(end), self.walk_days([mp1], min(end, mp1.end_date)))
+        # Cache is dropped when days off change
+        before = mp2.get_number_days(date(2013,6,14))
+        day_off = DaysOff.objects.create(marking_period=mp2, date=date(2013,3,1))
+        self.assertEqual(mp2.get_number_days(date(2013,6,14)), before - 1)
+        # Both marking periods when one moves
+        mp1_days = mp1.get_number_days(date(2013,1,18))
+        day_off.marking_period = mp1
+        day_off.date = date(2012,12,3)
+        day_off.save()
+        self.assertEqual(mp2.get_number_days(date(2013,6,14)), before)
+        self.assertEqual(mp1.get_number_days(date(2013,1,18)), mp1_days - 1)
+
+class ScheduleGridTest(TestCase):
+    def test_build_schedule(self):
+        year = SchoolYear.objects.create(name="2012", start_date=date(2012,8,27), end_date=date(2013,6,14), active_year=True)
+        mp = MarkingPeriod.objects.create(name="S1", shortname="S1", school_year=year,
+            start_date=date(2012,8,27), end_date=date(2013,1,18))
+        first = Period.objects.create(name="1", start_time=time(8), end_time=time(9))
+        second = Period.objects.create(name="2", start_time=time(9), end_time=time(10))
+        math = Course.objects.create(fullname="Math", shortname="Math")
+        english = Course.objects.create(fullname="English", shortname="English")
+        for course in (math, english):
+            course.marking_period.add(mp)
+        CourseMeet.objects.create(course=math, period=first, day="1")
+        CourseMeet.objects.create(course=math, period=first, day="3")
+        english_meet = CourseMeet.objects.create(course=english, period=second, day="3")
+        student = Student.objects.create(fname="Joe", lname="Student", username="jstudent")
+        other = Student.objects.create(fname="Jane", lname="Student", username="jstudent2")
+        CourseEnrollment.objects.create(course=math, user=student)
+        CourseEnrollment.objects.create(course=english, user=student)
+        CourseEnrollment.objects.create(course=english, user=other)
+
+        days, periods = Calendar().build_schedule(student, mp)
+        self.assertEqual(days, ['Monday', 'Wednesday'])
+        self.assertEqual([period.name for period in periods], ['1', '2'])
+        self.assertEqual([meet and meet.course for meet in periods[0].days], [math, math])
+        self.assertEqual(periods[1].days, [None, english_meet])
+
+        schedules = Calendar().build_schedules([student, other], mp)
+        self.assertEqual(schedules[other.id][0], ['Wednesday'])
+        # Cached grids are dropped when the schedule changes
+        CourseMeet.objects.create(course=english, period=second, day="5")
+        days, periods = Calendar().build_schedule(other, mp)
+        self.assertEqual(days, ['Wednesday', 'Friday'])
+        # bulk_create sends no signals, the importer drops the grids itself
+        CourseEnrollment.objects.bulk_create([CourseEnrollment(course=math, user=other)])
+        clear_schedule_grids()
+        days, periods = Calendar().build_schedule(other, mp)
+        self.assertEqual(days, ['Monday', 'Wednesday', 'Friday'])
+
+class LocatorTest(TestCase):
+    def test_find_student(self):
+        today = date.today()
+        weekday = str(today.isoweekday())
+        year = SchoolYear.objects.create(name="Now", start_date=today - timedelta(days=30), end_date=today + timedelta(days=30), active_year=True)
+        mp = MarkingPeriod.objects.create(name="Now", shortname="Now", school_year=year,
+            start_date=year.start_date, end_date=year.end_date)
+        period = Period.objects.create(name="1", start_time=time(8), end_time=time(9))
+        room = Location.objects.create(name="Room 101")
+        course = Course.objects.create(fullname="Math", shortname="Math")
+        course.marking_period.add(mp)
+        CourseMeet.objects.create(course=course, period=period, day=weekday, location=room)
+        student = Student.objects.create(fname="Joe", lname="Student", username="jstudent")
+        enrollment = CourseEnrollment.objects.create(course=course, user=student)
+
+        calendar = Calendar()
+        self.assertEqual(calendar.find_student(student, datetime.combine(today, time(8, 30))), room)
+        self.assertEqual(calendar.find_student(student, datetime.combine(today, time(9, 30))), None)
+        self.assertEqual(calendar.find_students(datetime.combine(today, time(8)))[student.id].course, course)
+        # Excused from today's class
+        enrollment.exclude_days.add(Day.objects.create(day=weekday))
+        self.assertEqual(calendar.find_student(student, datetime.combine(today, time(8, 30))), None)
+        # Seen without signals, like the importer's bulk_create in another process
+        other = Student.objects.create(fname="Jane", lname="Student", username="jstudent2")
+        CourseEnrollment.objects.bulk_create([CourseEnrollment(course=course, user=other)])
+        self.assertEqual(calendar.find_student(other, datetime.combine(today, time(8, 30))), room)
+
+class FinalGradeTest(TestCase):
+    def setUp(self):
+        year = SchoolYear.objects.create(name="2012", start_date=date(2012,8,27), end_date=date(2013,6,14), active_year=True)
+        self.mps = []
+        for name, start, end in (("S1", date(2012,8,27), date(2013,1,18)), ("S2", date(2013,1,21), date(2013,6,14))):
+            self.mps.append(MarkingPeriod.objects.create(name=name, shortname=name, school_year=year,
+                start_date=start, end_date=end))
+        self.department = Department.objects.create(name="Math")
+        self.course = Course.objects.create(fullname="Math", shortname="Math", credits=1, department=self.department)
+        for mp in self.mps:
+            self.course.marking_period.add(mp)
+        self.students = []
+        for username, grades in (("numeric", (Decimal(80), Decimal(91))), ("letters", ("P", "F")),
+                                 ("incomplete", (Decimal(95), "I")), ("failing", (Decimal(50), Decimal(60)))):
+            student = Student.objects.create(fname=username, lname="Student", username=username)
+            CourseEnrollment.objects.create(course=self.course, user=student)
+            for mp, value in zip(self.mps, grades):
+                grade = Grade(student=student, course=self.course, marking_period=mp)
+                grade.set_grade(value)
+                grade.save()
+            self.students.append(student)
+
+    def test_same_as_single_student(self):
+        finals = self.course.get_final_grades()
+        for student in self.students:
+            self.assertEqual(finals[student.id].grade, self.course.get_final_grade(student))
+            self.assertEqual(finals[student.id].passing, self.course.is_passing(student))
+            self.assertEqual(finals[student.id].credits, self.course.get_credits_earned(student))
+        self.assertEqual(finals[self.students[0].id].grade, Decimal("85.50"))
+        self.assertEqual(finals[self.students[2].id].grade, "I")
+        self.assertEqual(finals[self.students[3].id].credits, 0)
+        # Only the first semester had ended
+        finals = self.course.get_final_grades(self.students[:1], date_report=date(2013,1,19))
+        self.assertEqual(finals[self.students[0].id].credits, 0.5)
+
+    def test_graduation_credits(self):
+        student = self.students[0]
+        student.class_of_year = ClassYear.objects.create(year=2015)
+        student.save()
+        self.assertEqual(self.department.get_graduation_credits(student), None)
+        DepartmentGraduationCredits.objects.create(department=self.department,
+            class_year=ClassYear.objects.create(year=2013), credits=3)
+        DepartmentGraduationCredits.objects.create(department=self.department,
+            class_year=ClassYear.objects.create(year=2016), credits=4)
+        self.assertEqual(self.department.get_graduation_credits(student), 3)
+        DepartmentGraduationCredits.objects.create(department=self.department,
+            class_year=student.class_of_year, credits=2)
+        self.assertEqual(Department.get_graduation_credits_for(self.students),
+                         {(self.department.id, student.id): 2})
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
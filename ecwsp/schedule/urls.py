@@ -4,4 +4,5 @@ from views import *
 urlpatterns = patterns('',
     (r'^enroll/(?P<id>\d+)$', schedule_enroll),
     (r'^grade_analytics/$', grade_analytics),
+    (r'^student_locations/$', student_locations),
 )
\ No newline at end of file
@@ -17,8 +17,10 @@ from ecwsp.sis.uno_report import *
 from ecwsp.sis.xlsReport import *
 from ecwsp.schedule.models import *
 from ecwsp.schedule.forms import *
+from ecwsp.schedule.calendar import Calendar
 from ecwsp.administration.models import *
 
+from datetime import datetime
 from decimal import Decimal, ROUND_HALF_UP
 import time
 import logging
@@ -184,6 +186,13 @@ def grade_analytics(request):
                             student.tardy_count = student_tardies.tardy_count
                             break
                 
+            # Pre load final grades
+            if data['final_grade'] and data['final_grade_filter'] and data['final_grade_times']:
+                from ecwsp.sis.gpa import GPAData
+                final_grades = GPAData(
+                    [student.id for student in students],
+                    course_ids=courses.values_list('id', flat=True),
+                )
             for student in students:
                 # if this is a report, only calculate for selected students.
                 if not 'xls' in request.POST or "selected" in request.POST:
@@ -203,7 +212,7 @@ def grade_analytics(request):
                     grades_text = ""
                     if add_to_list and data['final_grade'] and data['final_grade_filter'] and data['final_grade_times']:
                         for course in student.course_set.filter(id__in=courses):
-                            grade = course.get_final_grade(student)
+                            grade = final_grades.get_final_grade(student.id, course.id)
                             if grade:
                                 match = check_if_match(grade, data['final_grade_filter'], data['final_grade'])
                                 if match:
@@ -359,3 +368,28 @@ def grade_analytics(request):
                 
             return render_to_response('schedule/grade_analytics.html', {'form': form, 'course_selection': None, 'students': show_students,}, RequestContext(request, {}),)
     return render_to_response('schedule/grade_analytics.html', {'form': form,}, RequestContext(request, {}),)
+
+@user_passes_test(lambda u: u.has_perm('sis.reports'), login_url='/')
+def student_locations(request):
+    """ Spreadsheet of where every active student should be right now, for
+    emergencies and drills. Students not in a class are listed without one. """
+    now = datetime.now()
+    course_meets = Calendar().find_students(now)
+    data = []
+    for student in Student.objects.filter(inactive=False).select_related('year'):
+        course_meet = course_meets.get(student.id)
+        if course_meet:
+            data.append([
+                student,
+                student.year or "",
+                course_meet.period.name,
+                course_meet.course.fullname,
+                course_meet.location or "",
+                course_meet.course.teacher or "",
+            ])
+        else:
+            data.append([student, student.year or "", "", "", "", ""])
+    titles = ["Student", "Grade", "Period", "Course", "Location", "Teacher"]
+    # Sheet names can't hold the time
+    report = xlsReport(data, titles, now.strftime("student_locations_%Y-%m-%d_%H%M.xls"), heading="Student Locations")
+    return report.finish()
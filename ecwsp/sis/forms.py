@@ -193,6 +193,7 @@ class StudentGradeReportWriterForm(forms.Form):
     sort_by = forms.ChoiceField(choices=(('lname', 'Student last name'), ('year', 'School year'), ('cohort', 'Primary Cohort')), initial=1)
     filter_year = forms.ModelMultipleChoiceField(required=False, queryset=GradeLevel.objects.all())
     filter_cohort = forms.ModelMultipleChoiceField(required=False, queryset=Cohort.objects.all())
+    split_files = forms.BooleanField(required=False, help_text="Download a zip with one file per student. Much faster for large groups of students.")
     
     def clean(self):
         data = super(StudentGradeReportWriterForm, self).clean()
@@ -0,0 +1,385 @@
+""" Bulk GPA calculation.
+
+Loads grades, course credits, marking periods and GPA omissions for a whole
+set of students in a handful of queries and does the arithmetic in memory.
+Student.calculate_gpa, calculate_gpa_year and calculate_gpa_mp delegate here,
+so results must stay identical to the old per course calculation. The same
+data gives the final grade, pass/fail and credits earned of every student in
+a course (see Course.get_final_grades) or of a student in all their courses.
+
+Student.cache_gpa is maintained here too, see gpa_changed.
+"""
+from django.conf import settings
+
+from ecwsp.administration.models import Configuration
+from ecwsp.sis.helper_functions import Struct
+
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP
+import logging
+import threading
+
+
+def quantize_gpa(numerator, denominator):
+    """ Returns GPA rounded to two places or "N/A" when nothing counted """
+    if denominator > 0:
+        return Decimal(str(numerator / denominator)).quantize(Decimal("0.01"), ROUND_HALF_UP)
+    return "N/A"
+
+
+def grade_value(grade, letter_grade):
+    """ Same result as Grade.get_grade() but from raw column values """
+    if letter_grade:
+        return letter_grade
+    elif grade:
+        return grade
+    return ""
+
+
+def final_grade_from_values(values, letter_grade_required_for_pass):
+    """ Average a list of grade values the way Course.calculate_final_grade does.
+    values: grade values as returned by grade_value()
+    Returns Decimal, "I", "P", "F" or None """
+    final = Decimal(0)
+    number = 0
+    letter_grade = False
+    for value in values:
+        if isinstance(value, Decimal):
+            final += value
+            number += 1
+        # I (Incomplete) results in the final grade being I
+        elif value == "I":
+            return "I"
+        elif value in ["P","HP","LP"]:
+            final += 100
+            number += 1
+            letter_grade = True
+        elif value == 'F':
+            number += 1
+            letter_grade = True
+    if number != 0:
+        final = final / number
+        final = Decimal(final).quantize(Decimal("0.01"), ROUND_HALF_UP)
+        if letter_grade == True:
+            if final > letter_grade_required_for_pass:
+                return "P"
+            else:
+                return "F"
+        return final
+    return None
+
+
+def is_passing_grade(grade, pass_score, pass_letters):
+    """ Same test as Course.is_passing on a final grade
+    pass_score: "Passing Grade" setting
+    pass_letters: "Letter Passing Grade" setting, comma separated """
+    try:
+        if grade >= int(pass_score):
+            return True
+    except:
+        if grade in pass_letters.split(','):
+            return True
+    return False
+
+
+def credits_earned(course_credits, marking_periods, date_report, include_latest_mid=False):
+    """ Same as Course.get_credits_earned without a student.
+    marking_periods: list of dicts for every marking period of the course
+    date_report: None counts every marking period """
+    total_mps = len(marking_periods)
+    if date_report is None:
+        mps = total_mps
+    else:
+        mps = len([mp for mp in marking_periods if mp['end_date'] < date_report])
+    if include_latest_mid:
+        credits = ((float(mps) + 0.5) / float(total_mps)) * float(course_credits)
+    else:
+        credits = (float(mps) / float(total_mps)) * float(course_credits)
+    if course_credits < credits:
+        credits = course_credits
+    return float(credits)
+
+
+class GPAData(object):
+    """ Every row needed to calculate GPAs for a set of students.
+    Each attribute is filled with one query """
+    def __init__(self, student_ids, course_ids=None):
+        """ student_ids: students to load
+        course_ids: only load these courses, graded or not. Defaults to every
+        graded course of the students """
+        from ecwsp.schedule.models import Course, CourseEnrollment, OmitCourseGPA, OmitYearGPA
+        student_ids = list(student_ids)
+        self.student_ids = student_ids
+
+        # {student_id: [course_id, ...]}
+        self.enrollments = {}
+        # {course_id: credits}
+        self.credits = {}
+        enrollments = CourseEnrollment.objects.filter(user__in=student_ids)
+        if course_ids is None:
+            enrollments = enrollments.filter(course__graded=True)
+        else:
+            course_ids = list(course_ids)
+            enrollments = enrollments.filter(course__in=course_ids)
+            # Students with grades but no enrollment still get credits
+            self.credits.update(Course.objects.filter(id__in=course_ids).values_list('id', 'credits'))
+        enrollments = enrollments.values_list(
+            'user_id', 'course_id', 'course__credits').order_by('course__id').distinct()
+        for student_id, course_id, credits in enrollments:
+            courses = self.enrollments.setdefault(student_id, [])
+            if course_id not in courses:
+                courses.append(course_id)
+            self.credits[course_id] = credits
+
+        # {course_id: [{'id':, 'end_date':, 'show_reports':, 'school_year_id':}, ...]}
+        self.marking_periods = {}
+        course_mps = Course.marking_period.through.objects.filter(
+            course__in=self.credits.keys(),
+        ).values_list(
+            'course_id',
+            'markingperiod__id',
+            'markingperiod__end_date',
+            'markingperiod__show_reports',
+            'markingperiod__school_year_id',
+        )
+        for course_id, mp_id, end_date, show_reports, school_year_id in course_mps:
+            self.marking_periods.setdefault(course_id, []).append({
+                'id': mp_id,
+                'end_date': end_date,
+                'show_reports': show_reports,
+                'school_year_id': school_year_id,
+            })
+
+        self.omit_courses = set(OmitCourseGPA.objects.filter(
+            student__in=student_ids).values_list('student_id', 'course_id'))
+        self.omit_years = set(OmitYearGPA.objects.filter(
+            student__in=student_ids).values_list('student_id', 'year_id'))
+
+        # {(student_id, course_id): [{'marking_period_id':, 'end_date':, 'value':, 'override_final':}, ...]}
+        self.grades = {}
+        if 'ecwsp.grades' in settings.INSTALLED_APPS:
+            from ecwsp.grades.models import Grade
+            grades = Grade.objects.filter(student__in=student_ids)
+            if course_ids is not None:
+                grades = grades.filter(course__in=course_ids)
+            grades = grades.values_list(
+                'student_id',
+                'course_id',
+                'marking_period_id',
+                'marking_period__end_date',
+                'grade',
+                'letter_grade',
+                'override_final',
+            ).order_by('id')
+            for student_id, course_id, mp_id, end_date, grade, letter_grade, override_final in grades:
+                self.grades.setdefault((student_id, course_id), []).append({
+                    'marking_period_id': mp_id,
+                    'end_date': end_date,
+                    'value': grade_value(grade, letter_grade),
+                    'override_final': override_final,
+                })
+        self.letter_grade_required_for_pass = Configuration.get_int('letter_grade_required_for_pass', 60)
+        self.pass_score = Configuration.get_decimal("Passing Grade", '70')
+        self.pass_letters = Configuration.get_or_default("Letter Passing Grade", 'A,B,C,P').value
+
+    def courses_for_gpa(self, student_id, marking_period=None, year=None):
+        """ Course ids that count towards a student's GPA """
+        courses = []
+        for course_id in self.enrollments.get(student_id, []):
+            mps = self.marking_periods.get(course_id, [])
+            if (student_id, course_id) in self.omit_courses and year is None:
+                continue
+            if marking_period is not None:
+                if marking_period.id in [mp['id'] for mp in mps]:
+                    courses.append(course_id)
+            elif year is not None:
+                if year.id in [mp['school_year_id'] for mp in mps]:
+                    courses.append(course_id)
+            else:
+                if not [mp for mp in mps if mp['show_reports']]:
+                    continue
+                if [mp for mp in mps if (student_id, mp['school_year_id']) in self.omit_years]:
+                    continue
+                courses.append(course_id)
+        return courses
+
+    def get_final_grade(self, student_id, course_id, date_report=None):
+        """ Same as Course.get_final_grade from preloaded grades
+        date_report: optional gets grade for time period """
+        grades = self.grades.get((student_id, course_id), [])
+        overrides = [grade for grade in grades if grade['override_final']]
+        if overrides:
+            mps = self.marking_periods.get(course_id, [])
+            if not date_report or [mp for mp in mps if mp['end_date'] <= date_report]:
+                return overrides[0]['value']
+            return None
+        if date_report:
+            grades = [grade for grade in grades
+                      if grade['end_date'] is not None and grade['end_date'] <= date_report]
+        values = [grade['value'] for grade in grades]
+        return final_grade_from_values(values, self.letter_grade_required_for_pass)
+    
+    def is_passing(self, student_id, course_id, date_report=None):
+        """ Same as Course.is_passing from preloaded grades """
+        grade = self.get_final_grade(student_id, course_id, date_report)
+        return is_passing_grade(grade, self.pass_score, self.pass_letters)
+
+    def get_credits_earned(self, student_id, course_id, date_report=None, include_latest_mid=False):
+        """ Same as Course.get_credits_earned for a student from preloaded grades """
+        return self.get_course_result(student_id, course_id, date_report, include_latest_mid).credits
+
+    def get_course_result(self, student_id, course_id, date_report=None, include_latest_mid=False):
+        """ Final grade, pass/fail and credits earned of a student in a course
+        Returns Struct with grade, passing and credits """
+        result = Struct()
+        result.grade = self.get_final_grade(student_id, course_id, date_report)
+        result.passing = is_passing_grade(result.grade, self.pass_score, self.pass_letters)
+        result.credits = 0
+        mps = self.marking_periods.get(course_id, [])
+        if result.passing and self.credits.get(course_id) is not None and mps:
+            result.credits = credits_earned(self.credits[course_id], mps, date_report, include_latest_mid)
+        return result
+
+    def get_course_results(self, date_report=None):
+        """ get_course_result of every loaded enrollment
+        Returns {(student_id, course_id): Struct with grade, passing and credits} """
+        results = {}
+        for student_id, course_ids in self.enrollments.items():
+            for course_id in course_ids:
+                results[(student_id, course_id)] = self.get_course_result(student_id, course_id, date_report)
+        return results
+
+    def get_mp_grade(self, student_id, course_id, marking_period_id):
+        for grade in self.grades.get((student_id, course_id), []):
+            if not grade['override_final'] and grade['marking_period_id'] == marking_period_id:
+                return grade['value']
+        return None
+
+    def grade_for_single_course(self, student_id, course_id, marking_period=None, date_report=None):
+        """ Returns (grade, credit) or None if the course does not count """
+        credits = self.credits.get(course_id)
+        mps = self.marking_periods.get(course_id, [])
+        if credits is None or not mps:
+            return None
+        if marking_period:
+            grade = self.get_mp_grade(student_id, course_id, marking_period.id)
+            credit = float(credits) / float(len(mps))
+        else:
+            grade = self.get_final_grade(student_id, course_id, date_report)
+            credit = credits_earned(credits, mps, date_report)
+        # Only numeric grades count, letter grades such as P are skipped
+        if not isinstance(grade, Decimal):
+            return None
+        return float(grade), credit
+
+    def calculate_gpa(self, student_id, marking_period=None, date_report=None, year=None):
+        gpa = float(0)
+        credits = float(0)
+        for course_id in self.courses_for_gpa(student_id, marking_period, year):
+            result = self.grade_for_single_course(student_id, course_id, marking_period, date_report)
+            if result is not None:
+                grade, credit = result
+                credits += credit
+                gpa += grade * credit
+        return quantize_gpa(gpa, credits)
+
+
+def compute_gpas(students, date_report=None, marking_period=None, year=None, gpa_data=None):
+    """ Calculate GPAs for many students at once.
+    students: Student queryset or list
+    date_report: Date for calculation (which effects credit value) defaults to today
+    marking_period: Only this marking period (per marking period GPA)
+    year: Only this school year
+    gpa_data: GPAData already loaded for these students, to reuse between calls
+    With neither marking_period nor year the cumulative GPA is returned.
+    Returns {student.id: Decimal or "N/A"} """
+    if date_report is None and marking_period is None:
+        date_report = date.today()
+
+    if "ecwsp.benchmark_grade" in settings.INSTALLED_APPS:
+        from ecwsp.benchmark_grade.gpa import benchmark_compute_gpas
+        return benchmark_compute_gpas(students, marking_period, date_report, year)
+
+    student_ids = [student.id for student in students]
+    if gpa_data is None:
+        gpa_data = GPAData(student_ids)
+    gpas = {}
+    for student_id in student_ids:
+        gpas[student_id] = gpa_data.calculate_gpa(student_id, marking_period, date_report, year)
+    return gpas
+
+
+# Students whose cache_gpa is out of date, per thread. While a request (see
+# ecwsp.sis.middleware.DeferredGPAMiddleware) or a defer_gpa_updates block is
+# running, grade changes only mark students here and the cached GPAs are
+# recalculated together when it ends.
+_deferred = threading.local()
+
+def _dirty_students():
+    if not hasattr(_deferred, 'students'):
+        _deferred.depth = 0
+        _deferred.students = set()
+    return _deferred.students
+
+
+def update_cached_gpas(student_ids):
+    """ Recalculate and store cache_gpa for students, writing only that column """
+    from ecwsp.sis.models import Student
+    students = Student.objects.filter(id__in=list(student_ids)).only('id')
+    for student_id, gpa in compute_gpas(students).items():
+        # Same as before, an N/A GPA leaves the cached value alone
+        if gpa != "N/A":
+            Student.objects.filter(id=student_id).update(cache_gpa=gpa)
+
+
+def gpa_changed(student_id):
+    """ A grade of this student changed. Update cache_gpa now, or when the
+    current deferred block ends. """
+    dirty = _dirty_students()
+    if _deferred.depth:
+        dirty.add(student_id)
+    else:
+        update_cached_gpas([student_id])
+
+
+def begin_deferred_gpa_updates(outermost=False):
+    """ Enter a deferred block
+    outermost: no block can be running on this thread (a request is starting).
+    A block left open by an earlier request is closed first, so one lost
+    end_deferred_gpa_updates doesn't defer updates of the thread forever """
+    dirty = _dirty_students()
+    if outermost and _deferred.depth:
+        logging.error('Deferred GPA updates were never ended, updating {} students now'.format(len(dirty)))
+        _deferred.depth = 1
+        end_deferred_gpa_updates()
+    _deferred.depth += 1
+
+
+def end_deferred_gpa_updates():
+    """ Leave a deferred block, the outermost one updates every dirty student.
+    The block is left even when updating fails """
+    dirty = _dirty_students()
+    _deferred.depth = max(_deferred.depth - 1, 0)
+    if _deferred.depth == 0 and dirty:
+        student_ids = list(dirty)
+        dirty.clear()
+        update_cached_gpas(student_ids)
+
+
+class defer_gpa_updates(object):
+    """ with defer_gpa_updates():
+            ...save many grades...
+    recalculates each affected student's GPA once when the block ends """
+    def __enter__(self):
+        begin_deferred_gpa_updates()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            end_deferred_gpa_updates()
+        except Exception:
+            if exc_type is None:
+                raise
+            # Don't hide the exception that ended the block
+            logging.error('Could not update deferred GPAs', exc_info=True)
+        return False
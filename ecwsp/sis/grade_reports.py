@@ -3,7 +3,9 @@ from django.db.models import Q
 from ecwsp.sis.forms import *
 from ecwsp.sis.xlsReport import *
 from ecwsp.sis.report import *
+from ecwsp.sis.stream_report import StreamingReport
 import xlwt
+from datetime import timedelta
 
 
 def fail_report(request):
@@ -21,16 +23,25 @@ def fail_report(request):
         
         passing_grade = float(Configuration.get_or_default('Passing Grade','70').value)
         
+        # {student_id: [grade, ...]} from a single query
+        failed_grades = {}
+        for grade in Grade.objects.filter(
+            override_final=False,
+            student__in=students,
+            course__department__in=departments,
+            grade__lte=passing_grade,
+            marking_period__in=marking_periods,
+        ).select_related('course', 'marking_period').order_by('id'):
+            failed_grades.setdefault(grade.student_id, []).append(grade)
+        
         data = []
         iy=3
         for student in students:
             row = [student]
             ix = 1 # letter A
-            student.failed_grades = Grade.objects.none()
+            student.failed_grades = failed_grades.get(student.id, [])
             for department in departments:
-                failed_grades = Grade.objects.filter(override_final=False,course__department=department,course__courseenrollment__user=student,grade__lte=passing_grade,marking_period__in=marking_periods)
-                row += [failed_grades.count()]
-                student.failed_grades = student.failed_grades | failed_grades
+                row += [len([grade for grade in student.failed_grades if grade.course.department_id == department.id])]
                 ix += 1
             row += [
                 xlwt.Formula(
@@ -73,7 +84,7 @@ def student_grade(request, form):
         transcript = True
     file_format = UserPreference.objects.get_or_create(user=request.user)[0].get_format(type="document")
     return pod_report_grade(request, template_path, options=data, students=form.get_students(data), format=file_format,
-                            report_card=report_card, transcript=transcript)
+                            report_card=report_card, transcript=transcript, split_files=data.get('split_files'))
 
 def aggregate_grade_report(request):
     from ecwsp.grades.models import Grade
@@ -195,69 +206,69 @@ def date_based_gpa_report(request):
             students = Student.objects.filter(inactive = False).order_by('-year__id')
         
         titles = ["Student", "9th", "10th", "11th","12th", "Current"]
-        data = []
         current_year = SchoolYear.objects.get(active_year = True)
         two_years_ago = (current_year.end_date + timedelta(weeks=-(2*52))).year
         three_years_ago = (current_year.end_date + timedelta(weeks=-(3*52))).year
         four_years_ago = (current_year.end_date + timedelta(weeks=-(4*52))).year
-        for student in students:
-            row = []
-            gpa = [None,None,None,None,None]
-            count = 0
-            #years is years that student has courses/grades
-            years = SchoolYear.objects.filter(markingperiod__show_reports=True,start_date__lt=date.today(),markingperiod__course__courseenrollment__user=student
-            ).exclude(omityeargpa__student=student).distinct().order_by('start_date')
-            #if student has courses from any year and is given a grade level (freshman,sophomore, etc.),
-            #it checks to see if the student's been at cristorey every year or if they transferred in and when
-            current = 0
-            try:
-                if student.year.id == 12:
-                    current = 3
-                    if years[0].start_date.year > two_years_ago:
-                        gpa[0] = "N/A"
-                        gpa[1] = "N/A"
-                        gpa[2] = "N/A"
-                        count = 3
-                    elif years[0].start_date.year > three_years_ago:
-                        gpa[0] = "N/A"
-                        gpa[1] = "N/A"
-                        count = 2
-                    elif years[0].start_date.year > four_years_ago:
-                        gpa[0] = "N/A"
-                        count = 1
-                elif student.year.id == 11:
-                    current = 2
-                    if years[0].start_date.year > two_years_ago:
-                        gpa[1] = "N/A"
-                        gpa[0] = "N/A"
-                        count = 2
-                    elif years[0].start_date.year > three_years_ago:
-                        gpa[0] = "N/A"
-                        count = 1
-                elif student.year.id == 10:
-                    current = 1
-                    if two_years_ago:
-                        gpa[0] = "N/A"
-                        count = 1
-                elif student.year.id == 9:
-                    current = 0
-            except:pass
+        def gpa_rows():
+            for student in students:
+                gpa = [None,None,None,None,None]
+                count = 0
+                #years is years that student has courses/grades
+                years = SchoolYear.objects.filter(markingperiod__show_reports=True,start_date__lt=date.today(),markingperiod__course__courseenrollment__user=student
+                ).exclude(omityeargpa__student=student).distinct().order_by('start_date')
+                #if student has courses from any year and is given a grade level (freshman,sophomore, etc.),
+                #it checks to see if the student's been at cristorey every year or if they transferred in and when
+                current = 0
+                try:
+                    if student.year.id == 12:
+                        current = 3
+                        if years[0].start_date.year > two_years_ago:
+                            gpa[0] = "N/A"
+                            gpa[1] = "N/A"
+                            gpa[2] = "N/A"
+                            count = 3
+                        elif years[0].start_date.year > three_years_ago:
+                            gpa[0] = "N/A"
+                            gpa[1] = "N/A"
+                            count = 2
+                        elif years[0].start_date.year > four_years_ago:
+                            gpa[0] = "N/A"
+                            count = 1
+                    elif student.year.id == 11:
+                        current = 2
+                        if years[0].start_date.year > two_years_ago:
+                            gpa[1] = "N/A"
+                            gpa[0] = "N/A"
+                            count = 2
+                        elif years[0].start_date.year > three_years_ago:
+                            gpa[0] = "N/A"
+                            count = 1
+                    elif student.year.id == 10:
+                        current = 1
+                        if two_years_ago:
+                            gpa[0] = "N/A"
+                            count = 1
+                    elif student.year.id == 9:
+                        current = 0
+                except:pass
             
-            for year in years:
-                #cumulative gpa per year. Adds one day because it was acting weird and not giving me GPA for first year
-                gpa[count] = student.calculate_gpa(year.end_date + timedelta(days=1))
-                count +=1
-            #if calculate_gpa does not return a value, it is set to "N/A"
-            if not gpa[0]:
-                gpa[0] = "N/A"
-            if not gpa[1]:
-                gpa[1] = "N/A"
-            if not gpa[2]:
-                gpa[2] = "N/A"
-            if not gpa[3]:
-                gpa[3] = "N/A"
-            gpa[4] = gpa[current]
-            row = [student, gpa[0],gpa[1],gpa[2],gpa[3],gpa[4]]
-            data.append(row)
-        report = xlsReport(data, titles, "gpas_by_year.xls", heading="GPAs")
+                for year in years:
+                    #cumulative gpa per year. Adds one day because it was acting weird and not giving me GPA for first year
+                    gpa[count] = student.calculate_gpa(year.end_date + timedelta(days=1))
+                    count +=1
+                #if calculate_gpa does not return a value, it is set to "N/A"
+                if not gpa[0]:
+                    gpa[0] = "N/A"
+                if not gpa[1]:
+                    gpa[1] = "N/A"
+                if not gpa[2]:
+                    gpa[2] = "N/A"
+                if not gpa[3]:
+                    gpa[3] = "N/A"
+                gpa[4] = gpa[current]
+                yield [student, gpa[0],gpa[1],gpa[2],gpa[3],gpa[4]]
+        format = UserPreference.objects.get_or_create(user=request.user)[0].get_format(type="spreadsheet")
+        report = StreamingReport("gpas_by_year", format)
+        report.add_sheet(gpa_rows(), titles, heading="GPAs")
         return report.finish()
@@ -21,12 +21,17 @@ from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.contrib.contenttypes.models import ContentType
 from django.core.files.base import ContentFile
 from django.db import transaction
+from django.utils.encoding import smart_unicode
 
 from ecwsp.admissions.models import *
 from ecwsp.sis.models import *
 from ecwsp.schedule.models import *
+from ecwsp.schedule.schedule_grid import clear_schedule_grids
+from ecwsp.schedule.locator import clear_location_index
+from ecwsp.benchmark_grade.portal import students_grades_changed
 from ecwsp.sis.xlsReport import *
 from ecwsp.sis.uno_report import *
+from ecwsp.sis.office_pool import convert_file
 from ecwsp.attendance.models import *
 from ecwsp.standard_test.models import StandardCategory, StandardCategoryGrade, StandardTest, StandardTestResult
 
@@ -39,10 +44,20 @@ import sys
 from decimal import *
 import subprocess
 import os.path
+from StringIO import StringIO
+import json
+
+class ImportCancelled(Exception): pass
+
 
 class Importer:
+    # Rows saved with one bulk insert and admin log entries saved at once
+    batch_size = 500
+    # Rows between progress updates (and cancel checks) of a logged import
+    progress_interval = 25
+    
     def __init__(self, file=None, user=None):
-        """Opens file. If not xls, convert to xls using uno
+        """Opens file. If not xls, convert to xls using the OpenOffice pool
         supports any file Openoffice.org supports"""
         if file:
             self.file = file
@@ -53,13 +68,19 @@ class Importer:
                 destination = open('/tmp/' + filename, 'wb+')
                 destination.write(file.read())
                 destination.close()
-                document = uno_open('/tmp/' + str(filename))
-                tmp, filename, content = uno_save(document, filename, "xls")
-                self.book = xlrd.open_workbook(tmp.name)
+                xls_name = convert_file('/tmp/' + str(filename), "xls")
+                self.book = xlrd.open_workbook(xls_name)
+                os.remove(xls_name)
             self.error_data = {}
             self.error_titles = {}
             self.errors = 0
             self.user = user
+        self.lookup_indexes = {}
+        self.log_entries = []
+        # {sheet name: {'rows':, 'done':, 'errors':}} saved to ImportLog.progress
+        self.progress = {}
+        self.current_sheet = None
+        self.progress_saved = 0
     
     def do_mysql_backup(self, database='default'):
         args = []
@@ -82,20 +103,74 @@ class Importer:
             mysql_as_string = subprocess.Popen('mysqldump %s' % (' '.join(args),),shell=True).communicate()[0]
         return ContentFile(mysql_as_string)
         
-    def make_log_entry(self, user_note=""):
-        self.log = ImportLog(user=self.user, user_note=user_note, import_file=self.file)
+    def make_log_entry(self, user_note="", log=None):
+        """ Start an ImportLog and back up the database
+        log: an ImportLog already created for a background import """
+        if log is None:
+            log = ImportLog(user=self.user, user_note=user_note, import_file=self.file, status='running')
+        elif ImportLog.objects.filter(id=log.id, status='queued').update(status='running'):
+            log.status = 'running'
+        else:
+            raise ImportCancelled('Import cancelled before it started')
+        self.log = log
         file_name = datetime.datetime.now().strftime("%Y%m%d%H%M") + ".sql"
         if (hasattr(settings, 'BASE_URL') and settings.BASE_URL != 'http://localhost:8000') or not hasattr(settings, 'BASE_URL'):
-            self.log.sql_backup.save(file_name, self.do_mysql_backup())
-        self.log.save()
+            self.log.sql_backup.save(file_name, self.do_mysql_backup(), save=False)
+        if self.log.id:
+            # The import may have been cancelled during the backup, keep its status
+            self.log.save(update_fields=['sql_backup'])
+        else:
+            self.log.save()
         # Clean up old log files
         for import_log in ImportLog.objects.filter(date__lt=datetime.datetime.now() - datetime.timedelta(60)):
             import_log.delete()
+    
+    def start_sheet(self, sheet):
+        self.current_sheet = sheet.name
+        self.progress[sheet.name] = {'rows': sheet.nrows - 1, 'done': 0, 'errors': 0}
+        self.save_progress()
+    
+    def rows_finished(self, count=1, errors=0):
+        """ Count rows of the current sheet. Every progress_interval rows the
+        progress is saved to the ImportLog and ImportCancelled is raised if the
+        import was cancelled in the meantime. """
+        if self.current_sheet is None:
+            return
+        progress = self.progress[self.current_sheet]
+        progress['done'] += count
+        progress['errors'] += errors
+        if progress['done'] - self.progress_saved >= self.progress_interval:
+            self.save_progress()
+    
+    def save_progress(self):
+        """ Store progress on the ImportLog, raise ImportCancelled if asked to stop """
+        log = getattr(self, 'log', None)
+        if log is None or not log.id:
+            return
+        if self.current_sheet:
+            self.progress_saved = self.progress[self.current_sheet]['done']
+        ImportLog.objects.filter(id=log.id).update(
+            current_sheet=self.current_sheet or "",
+            progress=json.dumps(self.progress),
+        )
+        status = ImportLog.objects.filter(id=log.id).values_list('status', flat=True)[0]
+        if transaction.is_managed():
+            transaction.commit()
+        if status == 'cancelling':
+            raise ImportCancelled('Import cancelled during sheet %s' % (self.current_sheet,))
         
     def handle_error(self, row, colname, exc, name):
         """ Add error infomation to exception list and error_date which will be
         transfered to html and a xls file. Also print to stderr. """
         transaction.rollback()
+        if exc[0] is ImportCancelled:
+            raise exc[1]
+        # Objects cached during the failed row may have been rolled back
+        self.lookup_indexes = {}
+        self.record_error(row, colname, exc, name)
+    
+    def record_error(self, row, colname, exc, name):
+        """ Add the row and error to error_data without touching the transaction """
         if not hasattr(colname, "value") or colname.value:
             value_row = []
             for cell in row:
@@ -104,6 +179,7 @@ class Importer:
             value_row += [error]
             self.error_data[name] += [value_row]
             self.errors += 1
+        self.rows_finished(errors=1)
     
     def sanitize_item(self, name, value):
         """ Checks to make sure column and cell have data, if not ignore them
@@ -182,6 +258,7 @@ class Importer:
     
     def get_student(self, items, allow_none=False, try_secondary=False):
         """ Lookup a student based on id, unique id, username, or ssn
+        Students are indexed by each of these once per import
         items: name and value from the imported data
         allow_none: Allow not finding a student. If False an exceptions
         try_secondary: 
@@ -190,23 +267,23 @@ class Importer:
             is_ok, name, value = self.sanitize_item(name, value)
             if is_ok:
                 if name == "student id":
-                    return Student.objects.get(id=value)
+                    return self.lookup(Student, 'id', value)
                 elif name == "student unique id":
-                    return Student.objects.get(unique_id=value)
+                    return self.lookup(Student, 'unique_id', value)
                 elif name == "hs_student_id": # Naviance
                     try:
-                        return Student.objects.get(unique_id=value)
+                        return self.lookup(Student, 'unique_id', value)
                     except:
                         try:
-                            return Student.objects.get(id=value)
+                            return self.lookup(Student, 'id', value)
                         except:
-                            return Student.objects.get(username=value)
+                            return self.lookup(Student, 'username', value)
                 elif name == "student username":
-                    return Student.objects.get(username=value)
+                    return self.lookup(Student, 'username', value)
                 elif name == "ssn" or name == "social security number" or name == "student ssn":
                     ssn = str(value).translate(None, '- _') # Because student clearing house likes stray _
                     ssn = ssn[:3] + '-' + ssn[3:5] + '-' + ssn[-4:] # xxx-xx-xxxx
-                    return Student.objects.get(ssn=ssn)
+                    return self.lookup(Student, 'ssn', ssn)
         
         # No ID....try secondary keys.
         if try_secondary:
@@ -271,28 +348,91 @@ class Importer:
     
     def log_and_commit(self, object, inserted=None, updated=None, addition=True):
         if addition:
-            LogEntry.objects.log_action(
-                user_id         = self.user.pk, 
-                content_type_id = ContentType.objects.get_for_model(object).pk,
-                object_id       = object.pk,
-                object_repr     = unicode(object), 
-                action_flag     = ADDITION
-            )
+            self.queue_log_entry(object, ADDITION)
             if inserted != None:
                 inserted += 1
         else:
-            LogEntry.objects.log_action(
-                user_id         = self.user.pk, 
-                content_type_id = ContentType.objects.get_for_model(object).pk,
-                object_id       = object.pk,
-                object_repr     = unicode(object), 
-                action_flag     = CHANGE
-            )
+            self.queue_log_entry(object, CHANGE)
             if updated != None:
                 updated += 1
         transaction.commit()
+        self.rows_finished()
         return inserted, updated
     
+    def queue_log_entry(self, object, action_flag):
+        """ Admin log entries are saved in batches, see flush_log_entries """
+        self.log_entries.append(LogEntry(
+            user_id         = self.user.pk,
+            content_type_id = ContentType.objects.get_for_model(object).pk,
+            object_id       = smart_unicode(object.pk),
+            object_repr     = unicode(object)[:200],
+            action_flag     = action_flag,
+        ))
+        if len(self.log_entries) >= self.batch_size:
+            self.flush_log_entries()
+    
+    def flush_log_entries(self):
+        if self.log_entries:
+            LogEntry.objects.bulk_create(self.log_entries)
+            self.log_entries = []
+    
+    def normalize_lookup(self, value):
+        """ Values the database may consider equal depending on its collation """
+        return unicode(value).strip().lower()
+    
+    def get_lookup_index(self, model, field):
+        """ ({field value: object}, {normalized field value: object}) for a
+        whole table, loaded once. Normalized values shared by several objects
+        map to None so they are looked up (and fail, or not) the same way a
+        query would. """
+        key = (model, field)
+        if key not in self.lookup_indexes:
+            self.lookup_indexes[key] = ({}, {})
+            for object in model.objects.all():
+                self.add_to_index(self.lookup_indexes[key], object, field)
+        return self.lookup_indexes[key]
+    
+    def add_to_index(self, index, object, field):
+        exact, normalized = index
+        value = getattr(object, field)
+        if value is None or value == "":
+            return
+        exact[unicode(value)] = object
+        value = self.normalize_lookup(value)
+        if value in normalized and normalized[value] is not object:
+            normalized[value] = None
+        else:
+            normalized[value] = object
+    
+    def add_to_lookup_indexes(self, object):
+        """ Make an object saved during the import visible to lookup() """
+        for (model, field), index in self.lookup_indexes.items():
+            if isinstance(object, model):
+                self.add_to_index(index, object, field)
+    
+    def lookup(self, model, field, value):
+        """ Same as model.objects.get(field=value) without a query per row.
+        Only values exactly equal to a single object's are taken from the
+        preloaded table. Anything else is queried, so matching and errors stay
+        the database's. """
+        exact, normalized = self.get_lookup_index(model, field)
+        object = None
+        if normalized.get(self.normalize_lookup(value)) is not None:
+            object = exact.get(unicode(value))
+        if object is None:
+            object = model.objects.get(**{field: value})
+            self.add_to_lookup_indexes(object)
+        return object
+    
+    def lookup_or_create(self, model, field, value):
+        """ Same as model.objects.get_or_create(field=value)[0] """
+        try:
+            return self.lookup(model, field, value)
+        except model.DoesNotExist:
+            object = model.objects.create(**{field: value})
+            self.add_to_lookup_indexes(object)
+            return object
+    
     def import_prep(self, sheet):
         x = 0
         header = sheet.row(x)
@@ -305,6 +445,7 @@ class Importer:
         header_values += ['Error']
         self.error_titles[sheet.name] = [header_values]
         self.error_data[sheet.name] = []
+        self.start_sheet(sheet)
         return (x, header, inserted, updated)
     
     def get_sheet_by_case_insensitive_name(self, name):
@@ -315,9 +456,10 @@ class Importer:
                 return self.book.sheet_by_index(i)
             i += 1
     
-    def magic_import_everything(self):
-        """Import a workbook using sheet names to determine what to import"""
-        self.make_log_entry()
+    def magic_import_everything(self, log=None):
+        """Import a workbook using sheet names to determine what to import
+        log: ImportLog of a background import, see run_import_job """
+        self.make_log_entry(log=log)
         inserted = 0
         updated = 0
         msg = ""
@@ -455,15 +597,20 @@ class Importer:
             inserted, updated = self.import_family_access(sheet)
             msg += "%s family access records inserted, %s family access records updated <br/>" % (inserted, updated)
         
+        self.flush_log_entries()
         if msg == "":
             msg = "No files found. Check if sheets are named correctly. "
         
         msg += unicode(self.errors) + " error(s). "
         
         filename = 'import_error.xls'
+        self.log.status = 'done'
+        self.log.message = msg
+        self.log.current_sheet = ""
+        self.log.progress = json.dumps(self.progress)
+        self.log.finished = datetime.datetime.now()
         if len(self.error_data):
             self.log.errors = True
-            self.log.save()
             report = customXls("")
             save = False
             for key, error_page in self.error_data.items():
@@ -472,8 +619,12 @@ class Importer:
                     report.addSheet(error_page, self.error_titles[key][0], heading=key, heading_top=False)
             if save:
                 report.save(filename)
+                error_file = StringIO()
+                report.wb.save(error_file)
+                self.log.error_file.save('import_error_%s.xls' % (self.log.id,), ContentFile(error_file.getvalue()), save=False)
             else:
                 filename = None
+        self.log.save()
         return msg, filename
     
     def import_just_standard_test(self, test=None):
@@ -485,6 +636,7 @@ class Importer:
             msg += "%s standard tests inserted <br/>" % (inserted)
         except: pass
         
+        self.flush_log_entries()
         if msg == "":
             msg = "No files found. Check if sheets are named correctly. "
         
@@ -875,15 +1027,14 @@ class Importer:
                     items = zip(header, row)
                     created = False
                     model = None
-                    student = model.student = self.get_student(items)
+                    student = self.get_student(items)
                     student_cohort = None
                     
                     for (name, value) in items:
                         is_ok, name, value = self.sanitize_item(name, value)
                         if is_ok:
                             if name == "cohort name":
-                                model, created = Cohort.objects.get_or_create(name=value)
-                                if created: model.save()
+                                model = self.lookup_or_create(Cohort, 'name', value)
                             elif name == "primary":
                                 if self.determine_truth(value):
                                     try:
@@ -903,45 +1054,92 @@ class Importer:
     
     #@transaction.commit_manually
     def import_course_enrollment(self, sheet):
-        """Import course enrollments. Does not allow updates. """
+        """Import course enrollments. Does not allow updates.
+        Rows are checked one at a time and inserted batch_size at a time. """
         x, header, inserted, updated = self.import_prep(sheet)
+        existing = set(CourseEnrollment.objects.values_list('course_id', 'user_id', 'role'))
+        batch = []
         while x < sheet.nrows:
-            with transaction.commit_manually():
-                try:
-                    name = None
-                    row = sheet.row(x)
-                    items = zip(header, row)
-                    created = False
-                    model = CourseEnrollment()
-                    for (name, value) in items:
-                        is_ok, name, value = self.sanitize_item(name, value)
-                        if is_ok:
-                            if name == "course":
-                                model.course = Course.objects.get(fullname=value)
-                            elif name == "user":
+            try:
+                name = None
+                row = sheet.row(x)
+                items = zip(header, row)
+                model = CourseEnrollment()
+                for (name, value) in items:
+                    is_ok, name, value = self.sanitize_item(name, value)
+                    if is_ok:
+                        if name == "course":
+                            model.course = self.lookup(Course, 'fullname', value)
+                        elif name == "user":
+                            try:
+                                model.user = self.lookup(MdlUser, 'username', value)
+                            except:
                                 try:
-                                    model.user = MdlUser.objects.get(username=value)
+                                    model.user = self.lookup(MdlUser, 'id', value)
                                 except:
-                                    try:
-                                        model.user = MdlUser.objects.get(id=value)
-                                    except:
-                                        model.user = MdlUser.objects.get(unique_id=value)
-                            elif name == "role":
-                                model.role = unicode(value)
-                            elif name == "year":
-                                try:
-                                    model.year = GradeLevel.objects.get(name=value)
-                                except: pass
-                                model.year = GradeLevel.objects.get(id=value)
-                    model.full_clean()
-                    model.save()
-                    self.log_and_commit(model, addition=True)
-                    inserted += 1
-                except:
-                    self.handle_error(row, name, sys.exc_info(), sheet.name)
+                                    model.user = self.lookup(Student, 'unique_id', value)
+                        elif name == "role":
+                            model.role = unicode(value)
+                        elif name == "year":
+                            try:
+                                model.year = self.lookup(GradeLevel, 'name', value)
+                            except:
+                                model.year = self.lookup(GradeLevel, 'id', value)
+                # full_clean without a uniqueness query per row
+                model.clean_fields()
+                model.clean()
+                key = (model.course_id, model.user_id, model.role)
+                if key in existing:
+                    raise ValidationError(u'Course enrollment with this Course, User and Role already exists.')
+                existing.add(key)
+                batch.append((row, model))
+            except:
+                # Nothing was written for this row, so nothing to roll back
+                self.record_error(row, name, sys.exc_info(), sheet.name)
+            if len(batch) >= self.batch_size:
+                inserted += self.save_course_enrollments(batch, sheet.name)
+                batch = []
             x += 1
+        inserted += self.save_course_enrollments(batch, sheet.name)
         return inserted
     
+    def save_course_enrollments(self, batch, sheet_name):
+        """ Insert [(row, CourseEnrollment), ...] with one query. If that fails
+        rows are saved one at a time so each bad row gets its error.
+        Returns the number inserted. """
+        if not batch:
+            return 0
+        with transaction.commit_manually():
+            try:
+                CourseEnrollment.objects.bulk_create([model for row, model in batch])
+                transaction.commit()
+            except:
+                transaction.rollback()
+                inserted = 0
+                for row, model in batch:
+                    try:
+                        model.save()
+                        self.log_and_commit(model, addition=True)
+                        inserted += 1
+                    except:
+                        self.handle_error(row, None, sys.exc_info(), sheet_name)
+                return inserted
+        # bulk_create doesn't send the signals that drop cached schedules and grades
+        clear_schedule_grids()
+        clear_location_index()
+        students_grades_changed([model.user_id for row, model in batch])
+        # bulk_create doesn't set primary keys, which the admin log needs
+        ids = {}
+        for id, course_id, user_id, role in CourseEnrollment.objects.filter(
+                course__in=set([model.course_id for row, model in batch]),
+                user__in=set([model.user_id for row, model in batch])).values_list('id', 'course_id', 'user_id', 'role'):
+            ids[(course_id, user_id, role)] = id
+        for row, model in batch:
+            model.id = ids.get((model.course_id, model.user_id, model.role))
+            self.queue_log_entry(model, ADDITION)
+        self.rows_finished(len(batch))
+        return len(batch)
+    
     #@transaction.commit_manually
     def import_faculty(self, sheet):
         x, header, inserted, updated = self.import_prep(sheet)
@@ -1039,9 +1237,9 @@ class Importer:
                             elif name == "comment":
                                 comment = unicode(value) + " "
                             elif name == "course":
-                                course = Course.objects.get(fullname=value)
+                                course = self.lookup(Course, 'fullname', value)
                             elif name == "marking period":
-                                marking_period = MarkingPeriod.objects.get(name=value)
+                                marking_period = self.lookup(MarkingPeriod, 'name', value)
                             elif name == "override final":
                                 override_final = self.determine_truth(value)
                     if student and course and grade:
@@ -1094,9 +1292,9 @@ class Importer:
                                 if c: location.save()
                             elif name == "level":
                                 try:
-                                    model.level = GradeLevel.objects.get(name=value)
+                                    model.level = self.lookup(GradeLevel, 'name', value)
                                 except:
-                                    model.level = GradeLevel.objects.get(id=value)
+                                    model.level = self.lookup(GradeLevel, 'id', value)
                             elif name == "homeroom":
                                 model.homeroom = value
                             elif name == "graded":
@@ -1105,10 +1303,10 @@ class Importer:
                                 model.department, created = Department.objects.get_or_create(name=value)
                             elif name[:14] == "marking period":
                                 model.save()
-                                model.marking_period.add(MarkingPeriod.objects.get(name=value))
+                                model.marking_period.add(self.lookup(MarkingPeriod, 'name', value))
                             elif name == "enroll cohort":
                                 model.save()
-                                cohort, created = Cohort.objects.get_or_create(name=value)
+                                cohort = self.lookup_or_create(Cohort, 'name', value)
                                 model.add_cohort(cohort)
                     model.full_clean()
                     model.save()
@@ -1141,9 +1339,9 @@ class Importer:
                         is_ok, name, value = self.sanitize_item(name, value)
                         if is_ok:
                             if name == "course" or name == "course fullname":
-                                course = Course.objects.get(fullname=value)
+                                course = self.lookup(Course, 'fullname', value)
                             elif name == "period":
-                                period = Period.objects.get(name=value)
+                                period = self.lookup(Period, 'name', value)
                             elif name == "day":
                                 day = self.convert_day(value)
                             elif name == "location":
@@ -1157,6 +1355,7 @@ class Importer:
                             inserted += 1
                         else:
                             updated += 1
+                        transaction.commit()
                     else:
                         raise Exception('Requires course, period, and day')
                 except:
@@ -1216,7 +1415,7 @@ class Importer:
                             if name == "date":
                                model.date = self.convert_date(value)
                             elif name == "marking period":
-                                model.marking_period = MarkingPeriod.objects.get(name=value)
+                                model.marking_period = self.lookup(MarkingPeriod, 'name', value)
                     model.full_clean()
                     model.save()
                     self.log_and_commit(model, addition=True)
@@ -1553,7 +1752,7 @@ class Importer:
                         if is_ok:
                             if name == "id":
                                 try:
-                                    model = Student.objects.get(id=value)
+                                    model = self.lookup(Student, 'id', value)
                                     created = False
                                 except:
                                     raise Exception("Student ID not found. ID should not be set when creating new student, use unique ID for this.")
@@ -1561,22 +1760,23 @@ class Importer:
                                 if model:
                                     model.unique_id = value
                                 else:
-                                    students = Student.objects.filter(unique_id=value)
-                                    if students:
-                                        model = students[0]
+                                    try:
+                                        model = self.lookup(Student, 'unique_id', value)
                                         created = False
-                                    else:
+                                    except Student.MultipleObjectsReturned:
+                                        model = Student.objects.filter(unique_id=value)[0]
+                                        created = False
+                                    except Student.DoesNotExist:
                                         model = Student(unique_id=value)
                                         created = True
                             elif name in ["student username", "username"]:
                                 if model:
                                     model.username = value
                                 else:
-                                    students = Student.objects.filter(username=value)
-                                    if students:
-                                        model = students[0]
+                                    try:
+                                        model = self.lookup(Student, 'username', value)
                                         created = False
-                                    else:
+                                    except Student.DoesNotExist:
                                         model = Student(username=value)
                                         created = True
                     for (name, value) in items:
@@ -1598,18 +1798,18 @@ class Importer:
                                 model.bday = self.convert_date(value)
                             elif name == "year" or name == "grade level":
                                 try:
-                                    model.year = GradeLevel.objects.get(name=value)
+                                    model.year = self.lookup(GradeLevel, 'name', value)
                                 except:
-                                    model.year = GradeLevel.objects.get(id=value)
+                                    model.year = self.lookup(GradeLevel, 'id', value)
                             elif name == "picture":
                                 model.pic = value
                             elif name in ["class of year", "class of", "class_of_year", "graduation year", "grad year"]:
                                 try:
                                     year = int(value)
-                                    year = ClassYear.objects.get_or_create(year=year)[0]
+                                    year = self.lookup_or_create(ClassYear, 'year', year)
                                     model.class_of_year = year
                                 except:
-                                    year = ClassYear.objects.get(full_name=value)
+                                    year = self.lookup(ClassYear, 'full_name', value)
                                     model.class_of_year = year
                             elif name == "parent e-mail" or name == "parent email" or name == "parentemail" or name == "parent__email":
                                 model.parent_email = value
@@ -1620,7 +1820,7 @@ class Importer:
                             elif name == "ssn" or name == "social security":
                                 model.ssn = value
                             elif name in ['preferred language', 'language', 'family preferred language']:
-                                language = LanguageChoice.objects.get_or_create(name=value)[0]
+                                language = self.lookup_or_create(LanguageChoice, 'name', value)
                                 model.name = language
                             elif name == "deleted":
                                 model.deleted = self.determine_truth(value)
@@ -1662,6 +1862,8 @@ class Importer:
                     if not model.username and model.fname and model.lname:
                         model.username = self.gen_username(model.fname, model.lname)
                     model.save()
+                    if created:
+                        self.add_to_lookup_indexes(model)
                     if password:
                         user = User.objects.get(username = model.username)
                         user.set_password(password)
@@ -1690,7 +1892,7 @@ class Importer:
                                 contactModel, contactCreated = StudentNumber.objects.get_or_create(number=number, ext=extension, type="W" , student=model)
                                 contactModel.save()
                             elif name == "primary cohort":
-                                cohort = Cohort.objects.get_or_create(name=value)[0]
+                                cohort = self.lookup_or_create(Cohort, 'name', value)
                                 student_cohort = StudentCohort.objects.get_or_create(student=model, cohort=cohort)[0]
                                 student_cohort.primary = True
                                 student_cohort.save()
@@ -2108,7 +2310,7 @@ class Importer:
                     is_ok, name, value = self.sanitize_item(name, value)
                     if is_ok:
                         if name == "username":
-                            student = Student.objects.get(username=value)
+                            student = self.lookup(Student, 'username', value)
                             model, created = Grade.objects.get_or_create(student=student, course=course, marking_period=marking_period)
                         elif name in ["final grade %",'marking period grade (%)','grade']:
                             grade = value
@@ -2139,6 +2341,7 @@ class Importer:
             except:
                 print >> sys.stderr, str(sys.exc_info())
             x += 1  
+        self.flush_log_entries()
 
     #@transaction\.commit_manually
     def import_workteams(self, sheet):
@@ -2705,3 +2908,33 @@ class Importer:
                 self.handle_error(row, name, sys.exc_info(), sheet.name)
             x += 1
         return inserted, updated
+
+
+def run_import_job(import_log_id):
+    """ Run magic_import_everything for an ImportLog created by the import view,
+    in a celery worker. Status, progress and errors are kept on the ImportLog. """
+    log = ImportLog.objects.get(id=import_log_id)
+    if log.status != 'queued':
+        # Cancelled before a worker got to it
+        if log.status == 'cancelling':
+            ImportLog.objects.filter(id=log.id).update(status='cancelled', finished=datetime.datetime.now())
+        return
+    from ecwsp.sis.gpa import defer_gpa_updates
+    try:
+        importer = Importer(log.import_file, log.user)
+        # There is no request to wait for, recalculate imported grades' GPAs once at the end
+        with defer_gpa_updates():
+            importer.magic_import_everything(log=log)
+    except ImportCancelled, e:
+        importer.flush_log_entries()
+        ImportLog.objects.filter(id=log.id).update(
+            status='cancelled',
+            message=unicode(e),
+            progress=json.dumps(importer.progress),
+            finished=datetime.datetime.now())
+    except:
+        ImportLog.objects.filter(id=log.id).update(
+            status='failed',
+            message="Import failed: %s %s" % (unicode(sys.exc_info()[0]), unicode(sys.exc_info()[1])),
+            finished=datetime.datetime.now())
+        raise
@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand
+from appy.pod.renderer import Renderer
+from optparse import make_option
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+NAMESPACES = ' '.join([
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"',
+    'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0"',
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0"',
+    'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"',
+    'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0"',
+    'xmlns:svg="urn:oasis:names:tc:opendocument:xmlns:svg-compatible:1.0"',
+    'xmlns:dc="http://purl.org/dc/elements/1.1/"',
+    'xmlns:ooow="http://openoffice.org/2004/writer"',
+    'office:version="1.2"',
+])
+
+def expression(expr):
+    return '<text:conditional-text text:condition="ooow:True" text:string-value-if-true="" text:string-value-if-false="">%s</text:conditional-text>' % (expr,)
+
+def statement(statement):
+    return '<office:annotation><dc:creator>benchmark</dc:creator><text:p>%s</text:p></office:annotation>' % (statement,)
+
+def row(*cells):
+    return '<table:table-row>%s</table:table-row>' % (''.join(
+        '<table:table-cell office:value-type="string"><text:p>%s</text:p></table:table-cell>' % (cell,) for cell in cells),)
+
+def write_template(path, rows):
+    """ An odt with one 2 column table. rows=None makes a single row repeated
+    with "do row for", otherwise the template itself has that many rows """
+    if rows is None:
+        body = row(statement('do row for student in students') + expression('student[0]'), expression('student[1]'))
+    else:
+        body = ''.join(row(expression('students[%d][0]' % (i,)), expression('students[%d][1]' % (i,))) for i in range(rows))
+    template = zipfile.ZipFile(path, 'w')
+    template.writestr('mimetype', 'application/vnd.oasis.opendocument.text')
+    template.writestr('content.xml',
+        '<?xml version="1.0" encoding="UTF-8"?><office:document-content %s>'
+        '<office:font-face-decls/><office:automatic-styles/><office:body><office:text>'
+        '<table:table table:name="Students"><table:table-column table:number-columns-repeated="2"/>%s</table:table>'
+        '</office:text></office:body></office:document-content>' % (NAMESPACES, body))
+    template.writestr('styles.xml',
+        '<?xml version="1.0" encoding="UTF-8"?><office:document-styles %s>'
+        '<office:font-face-decls/><office:styles/></office:document-styles>' % (NAMESPACES,))
+    template.close()
+
+
+class Command(BaseCommand):
+    help = """
+    Measure the time appy.pod takes to render a table to odt (OpenOffice is not used).
+    Renders both a template with a repeated "do row for" row and a template
+    that itself contains all the rows, which is where buffer handling shows.
+    options
+    -n number of rows (default 2000)
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--number', '-n', dest='number', type='int', default=2000),
+    )
+
+    def handle(self, *args, **options):
+        rows = options['number']
+        students = [(u'Student %d' % (i,), u'%d' % (i % 100,)) for i in range(rows)]
+        folder = tempfile.mkdtemp()
+        try:
+            for name, template_rows in (('do row for', None), ('static rows', rows)):
+                template = os.path.join(folder, 'template.odt')
+                result = os.path.join(folder, 'result.odt')
+                write_template(template, template_rows)
+                start = time.time()
+                Renderer(template, {'students': students}, result, overwriteExisting=True).run()
+                elapsed = time.time() - start
+                print '%s: %s rows in %.2f seconds' % (name, rows, elapsed)
+                os.remove(template)
+                os.remove(result)
+        finally:
+            shutil.rmtree(folder)
@@ -0,0 +1,52 @@
+from ecwsp.sis.models import *
+from ecwsp.schedule.models import MarkingPeriod
+from ecwsp.sis.report_data import GradeReportData
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from optparse import make_option
+from datetime import date, datetime
+import time
+
+class Command(BaseCommand):
+    help = """
+    Measure database queries and time used to gather report card and transcript data.
+    Nothing is rendered, only the data pod_report_grade hands to the template is built.
+    options
+    -n number of active students to use (default all)
+    -d report date as YYYY-MM-DD (default today)
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--number', '-n', dest='number', type='int'),
+        make_option('--date', '-d', dest='date',),
+    )
+
+    def handle(self, *args, **options):
+        if options['date']:
+            for_date = datetime.strptime(options['date'], '%Y-%m-%d').date()
+        else:
+            for_date = date.today()
+        students = Student.objects.filter(inactive=False)
+        if options['number']:
+            students = students[:options['number']]
+        students = list(students)
+        if not students:
+            raise CommandError('No active students to report on')
+        marking_periods = MarkingPeriod.objects.filter(
+            school_year=SchoolYear.objects.filter(start_date__lt=for_date).order_by('-start_date')[0],
+            show_reports=True)
+
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        reset_queries()
+        start = time.time()
+        try:
+            report_data = GradeReportData(students, for_date, marking_periods)
+            report_data.prepare()
+            queries = len(connection.queries)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        elapsed = time.time() - start
+
+        print 'Students: %s' % (len(students),)
+        print 'Queries: %s (%.2f per student)' % (queries, float(queries) / len(students))
+        print 'Seconds: %.2f (%.3f per student)' % (elapsed, elapsed / len(students))
@@ -0,0 +1,12 @@
+from ecwsp.sis.gpa import begin_deferred_gpa_updates, end_deferred_gpa_updates
+
+
+class DeferredGPAMiddleware(object):
+    """ Recalculate cached GPAs once at the end of each request instead of
+    on every grade saved during it """
+    def process_request(self, request):
+        begin_deferred_gpa_updates(outermost=True)
+
+    def process_response(self, request, response):
+        end_deferred_gpa_updates()
+        return response
@@ -29,10 +29,10 @@ from django.conf import settings
 import logging
 from thumbs import ImageWithThumbsField
 from datetime import date
-from decimal import Decimal, ROUND_HALF_UP
 from ecwsp.administration.models import Configuration
 from custom_field.custom_field import CustomFieldModel
 import os
+import json
 from ckeditor.fields import RichTextField
 
 logger = logging.getLogger(__name__)
@@ -83,6 +83,7 @@ class UserPreference(models.Model):
     omr_default_number_answers = models.IntegerField(default=2, blank=True, )
     user = models.ForeignKey(User, unique=True, editable=False)
     names = None    # extra field names. (Attempt to speed up reports so these don't get called up over and over)
+    resolver = None # ReportFieldResolver of get_additional_student_fields
     first = True
     
     def get_format(self, type="document"):
@@ -103,63 +104,26 @@ class UserPreference(models.Model):
             elif self.prefered_file_format == "x":
                 return "xlsx"
             
+    def get_additional_student_fields_resolver(self, students):
+        """ ReportFieldResolver of the additional report fields for students.
+        resolver.titles are the extra titles, resolver.cells(student) the extra
+        cells of a row """
+        from ecwsp.sis.report_fields import ReportFieldResolver
+        if self.names is None:
+            self.set_names()
+        return ReportFieldResolver(self.names, students)
+
     def get_additional_student_fields(self, row, student, students, titles, buffer=1):
         """ row: table row
         Get additional fields based on user preferences
+        The fields of all students are resolved on the first call, which also adds the titles
         """
-        import copy
-        students_workaround = copy.copy(students) # THIS IS UGLY! But Django will otherwise stop iterating after 100 students
-        if not self.names:
-            self.set_names()
-        for name in self.names:
-            # If there is a m2m field we need to pad the titles.
-            # In case the m2m has a max of 5 fields we need five title cells
-            buffer = self.get_additional_student_fields_buffer(students_workaround, name)
-            if self.first:
-                i = 0
-                while i < buffer:
-                    titles.append(name)
-                    i += 1
-            space = 0
-            try:
-                many = False
-                object = student
-                for name_split in name.split('.'):
-                    object = object.__getattribute__(name_split)
-                    if str(object)[:51] == "<django.db.models.fields.related.ManyRelatedManager":
-                        for one_of_many in object.all():
-                            row.append(unicode(one_of_many))
-                            space += 1
-                            many = True
-                if not many:
-                    row.append(unicode(object))
-                    space += 1
-            except:
-                row.append("")
-                space += 1
-            while space < buffer:
-                row.append("")
-                space += 1
+        if self.resolver is None:
+            self.resolver = self.get_additional_student_fields_resolver(students)
+            titles += self.resolver.titles
+        row += self.resolver.cells(student)
         self.first = False
-    
-    def get_additional_student_fields_buffer(self, students, name):
-        """ buffer is the number of columns to use for a "field"
-        Example: A M2M field can return up to 5 fields so buffer is 5
-        """
-        buffer = 1
-        for student in students:
-            try:
-                object = student
-                for name_split in name.split('.'):
-                    object = object.__getattribute__(name_split)
-                    if str(object)[:51] == "<django.db.models.fields.related.ManyRelatedManager":
-                        number = object.all().count()
-                        if number > buffer: buffer = number
-            except:
-                pass
-        return buffer
-                
-    
+
     def set_names(self):
         fields = self.additional_report_fields.all()
         self.names = []
@@ -541,8 +505,8 @@ class Student(MdlUser, CustomFieldModel):
     # two underscores make it too private!
     def _calculate_grade_for_single_course(self, course, marking_period, date_report):
         #print '_c_g_f_s_c(',course, marking_period, date_report, ')'
-        """ Separate from __calculate_grade_for_courses() to avoid code duplication in
-        ecwsp.benchmark_grade.utility """
+        """ Per course grade and credit used by ecwsp.benchmark_grade.utility for
+        non benchmark years. ecwsp.sis.gpa does the same for many students at once """
         if marking_period:
             grade = float(self.grade_set.get(course=course, override_final=False, marking_period=marking_period).get_grade())
             credit = float(course.credits) / float(course.marking_period.count())
@@ -552,53 +516,28 @@ class Student(MdlUser, CustomFieldModel):
             credit = float(course.get_credits_earned(date_report=date_report))
         return grade, credit
 
-    def __calculate_grade_for_courses(self, courses, marking_period=None, date_report=None):
-        #print '__c_g_f_c(', courses, marking_period, date_report, ')'
-        if "ecwsp.benchmark_grade" in settings.INSTALLED_APPS:
-            from ecwsp.benchmark_grade.utility import benchmark_calculate_grade_for_courses
-            return benchmark_calculate_grade_for_courses(self, courses, marking_period, date_report)
-
-        gpa = float(0)
-        credits = float(0)
-        for course in courses.distinct():
-            try:
-                grade, credit = self._calculate_grade_for_single_course(course, marking_period, date_report)
-                credits += credit
-                gpa += float(grade) * credit
-            except:
-                pass
-        #print 'credits: ', credits
-        if credits > 0:
-            gpa = Decimal(str(gpa/credits)).quantize(Decimal("0.01"), ROUND_HALF_UP)
-        else:
-            gpa = "N/A"
-        return gpa
-        
     def calculate_gpa(self, date_report=None):
         """ Calculate students gpa
         date_report: Date for calculation (which effects credit value) defaults to today
-        Note: self is student object"""
-        if date_report == None:
-            date_report = date.today()
-        courses = self.course_set.filter(graded=True, marking_period__show_reports=True).exclude(omitcoursegpa__student=self).exclude(marking_period__school_year__omityeargpa__student=self).distinct()
-        return self.__calculate_grade_for_courses(courses, date_report=date_report)
+        Note: self is student object. Use ecwsp.sis.gpa.compute_gpas for many students"""
+        from ecwsp.sis.gpa import compute_gpas
+        return compute_gpas((self,), date_report=date_report)[self.id]
         
     
     def calculate_gpa_year(self, year=None, date_report=None):
         """ Calculate students gpa for one year
         year: Defaults to active year.
         date_report: Date for calculation (which effects credit value) defaults to today """
-        if not date_report:
-            date_report = date.today()
-        courses = self.course_set.filter(graded=True, marking_period__school_year=year)
-        x = self.__calculate_grade_for_courses(courses, date_report=date_report)
-        return x
+        from ecwsp.sis.gpa import compute_gpas
+        if not year:
+            year = SchoolYear.objects.get(active_year=True)
+        return compute_gpas((self,), date_report=date_report, year=year)[self.id]
     
     def calculate_gpa_mp(self, marking_period):
         """ Calculate students gpa for one marking periods
         mp: Marking Periods to calculate for."""
-        courses = self.course_set.filter(graded=True, omitcoursegpa=None, marking_period=marking_period)
-        return self.__calculate_grade_for_courses(courses, marking_period=marking_period)
+        from ecwsp.sis.gpa import compute_gpas
+        return compute_gpas((self,), marking_period=marking_period)[self.id]
         
     @property
     def gpa(self):
@@ -609,7 +548,7 @@ class Student(MdlUser, CustomFieldModel):
                 return gpa
             else:
                 self.cache_gpa = gpa
-                self.save()
+                Student.objects.filter(id=self.id).update(cache_gpa=gpa)
         return self.cache_gpa
         
     def gender_to_word(self, male_word, female_word):
@@ -658,9 +597,7 @@ class Student(MdlUser, CustomFieldModel):
         if Faculty.objects.filter(id=self.id).count():
             raise ValidationError('Cannot have someone be a student AND faculty!')
         self.cache_cohorts()
-        if self.inactive == True and (Configuration.get_or_default("Clear Placement for Inactive Students","False").value == "True" \
-        or Configuration.get_or_default("Clear Placement for Inactive Students","False").value == "true" \
-        or Configuration.get_or_default("Clear Placement for Inactive Students","False").value == "T"):
+        if self.inactive == True and Configuration.get_bool("Clear Placement for Inactive Students"):
             try:
                 self.studentworker.placement = None
             except: pass
@@ -800,7 +737,7 @@ class SchoolYear(models.Model):
     active_year = models.BooleanField(
         help_text="DANGER!! This is the current school year. There can only be one and setting this will remove it from other years. " \
                   "If you want to change the active year you almost certainly want to click Admin, Change School Year.")
-    benchmark_grade = models.BooleanField(default=lambda: str(Configuration.get_or_default("Benchmark-based grading", "False").value).lower() == "true",
+    benchmark_grade = models.BooleanField(default=lambda: Configuration.get_bool("Benchmark-based grading"),
                                           help_text="The configuration option \"Benchmark-based grading\" sets the default for this field")
     
     class Meta:
@@ -809,7 +746,7 @@ class SchoolYear(models.Model):
     def __unicode__(self):
         return self.name
     
-    def get_number_days(self, date=date.today()):
+    def get_number_days(self, date=None):
         """ Returns number of active school days in this year, based on
         each marking period of the year.
         date: Defaults to today, date to count towards. Used to get days up to a certain date"""
@@ -835,6 +772,20 @@ class ImportLog(models.Model):
     sql_backup = models.FileField(blank=True,null=True,upload_to="sql_dumps")
     user_note = models.CharField(max_length=1024,blank=True)
     errors = models.BooleanField()
+    status_choices = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('cancelling', 'Cancelling'),
+        ('cancelled', 'Cancelled'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    status = models.CharField(max_length=16, choices=status_choices, default='done', editable=False)
+    current_sheet = models.CharField(max_length=255, blank=True, editable=False)
+    progress = models.TextField(blank=True, editable=False, help_text="JSON of rows, done and errors per sheet")
+    message = models.TextField(blank=True, editable=False)
+    error_file = models.FileField(blank=True, null=True, upload_to="import_errors", editable=False)
+    finished = models.DateTimeField(blank=True, null=True, editable=False)
     
     def delete(self, *args, **kwargs):
         """ These logs files would get huge if not deleted often """
@@ -842,7 +793,18 @@ class ImportLog(models.Model):
             os.remove(self.sql_backup.path)
         if self.import_file and os.path.exists(self.import_file.path):
             os.remove(self.import_file.path)
+        if self.error_file and os.path.exists(self.error_file.path):
+            os.remove(self.error_file.path)
         super(ImportLog, self).delete(*args, **kwargs)
+    
+    def get_progress(self):
+        """ {sheet name: {'rows':, 'done':, 'errors':}} """
+        if self.progress:
+            return json.loads(self.progress)
+        return {}
+    
+    def is_finished(self):
+        return self.status in ('cancelled', 'done', 'failed')
         
         
 class MessageToStudent(models.Model):
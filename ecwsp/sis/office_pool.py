@@ -0,0 +1,298 @@
+""" Pool of persistent OpenOffice instances used for document conversion.
+
+Every conversion used to resolve a new UNO connection to a single soffice on
+port 2002. The pool keeps one cached connection per port in
+settings.OPENOFFICE_PORTS, hands instances out to one job at a time and
+restarts instances that stop answering. Every web and celery process has its
+own pool over the same ports, so a job also holds a lock file of its port
+(fcntl.flock) for as long as it runs and each soffice serves one job across
+all processes. When settings.OPENOFFICE_START_INSTANCES is set, whichever
+process holds the lock starts (and restarts) the headless soffice of the port
+and records its pid next to the lock, otherwise the pool expects them to be
+started outside of Django as before.
+"""
+from django.conf import settings
+
+from appy.pod.converter import Converter, ConverterError
+
+import errno
+import fcntl
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+
+class OfficePoolError(Exception): pass
+
+
+class OfficeInstance(object):
+    """ One soffice listening on a port and our cached UNO desktop for it """
+    def __init__(self, port, start=False):
+        self.port = port
+        self.start = start
+        self.desktop = None
+        # Open lock file while this process runs a job on the port
+        self.lock_file = None
+
+    def __unicode__(self):
+        return u'OpenOffice on port %s' % (self.port,)
+
+    def _path(self, extension):
+        return os.path.join(tempfile.gettempdir(), 'ooo_pool_%d.%s' % (self.port, extension))
+
+    def lock(self):
+        """ Take the port for a job unless another process has it, True on success """
+        lock_file = open(self._path('lock'), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lock_file.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self.lock_file = lock_file
+        return True
+
+    def unlock(self):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+    def get_pid(self):
+        """ Pid of the soffice some process of the pool started for this port
+        and that is still running, or None """
+        try:
+            pid = int(open(self._path('pid')).read())
+            os.kill(pid, 0)
+        except (IOError, ValueError, OSError):
+            return None
+        return pid
+
+    def launch(self):
+        """ Start a headless soffice for this port with its own profile,
+        separate profiles are needed to run several instances at once.
+        Only called while holding the port's lock. """
+        command = getattr(settings, 'OPENOFFICE_COMMAND', 'soffice')
+        process = subprocess.Popen([
+            command,
+            '--headless',
+            '--invisible',
+            '--nologo',
+            '--norestore',
+            '--nofirststartwizard',
+            '--accept=socket,host=localhost,port=%d;urp;StarOffice.ComponentContext' % (self.port,),
+            '-env:UserInstallation=file://%s/ooo_profile_%d' % (tempfile.gettempdir(), self.port),
+        ])
+        pid_file = open(self._path('pid'), 'w')
+        pid_file.write(str(process.pid))
+        pid_file.close()
+
+    def terminate(self):
+        """ Kill the soffice started for this port, whichever process started it """
+        self.desktop = None
+        pid = self.get_pid()
+        if pid is not None:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                # Reap it when it is our own child
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        try:
+            os.remove(self._path('pid'))
+        except OSError:
+            pass
+
+    def connect(self, wait=None):
+        """ Resolve a new UNO desktop, waiting up to wait seconds for a
+        freshly started soffice """
+        import uno
+        from com.sun.star.connection import NoConnectException
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+        if wait is None:
+            wait = getattr(settings, 'OPENOFFICE_START_TIMEOUT', 30)
+        started = time.time()
+        while True:
+            try:
+                context = resolver.resolve("uno:socket,host=localhost,port=%d;urp;StarOffice.ComponentContext" % (self.port,))
+                break
+            except NoConnectException, e:
+                if time.time() - started >= wait:
+                    raise OfficePoolError('Could not connect to %s: %s' % (unicode(self), e))
+                time.sleep(0.5)
+        self.desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+
+    def is_healthy(self):
+        if self.desktop is None:
+            return False
+        if self.start and self.get_pid() is None:
+            return False
+        try:
+            # Any round trip will do, this raises once the bridge is gone
+            self.desktop.getComponents()
+        except Exception:
+            return False
+        return True
+
+    def get_desktop(self):
+        """ Cached desktop, reconnecting or restarting soffice when it's dead.
+        Only called while holding the port's lock. """
+        if self.is_healthy():
+            return self.desktop
+        self.desktop = None
+        if not self.start:
+            self.connect()
+        elif self.get_pid() is None:
+            # Nobody runs soffice on this port, it's ours to start
+            self.terminate()
+            self.launch()
+            self.connect()
+        else:
+            # Started by us or another process of the pool
+            try:
+                self.connect()
+            except OfficePoolError:
+                self.terminate()
+                self.launch()
+                self.connect()
+        return self.desktop
+
+    def restart(self):
+        """ Throw away a stuck or broken instance """
+        if self.start:
+            self.terminate()
+        else:
+            self.desktop = None
+
+
+class OfficePool(object):
+    """ OfficeInstances, each used by one job at a time in any process """
+    def __init__(self, ports=None, start=None, job_timeout=None):
+        if ports is None:
+            ports = getattr(settings, 'OPENOFFICE_PORTS', [2002])
+        if start is None:
+            start = getattr(settings, 'OPENOFFICE_START_INSTANCES', False)
+        if job_timeout is None:
+            job_timeout = getattr(settings, 'OPENOFFICE_JOB_TIMEOUT', 120)
+        self.job_timeout = job_timeout
+        self.instances = [OfficeInstance(port, start) for port in ports]
+        # Instances no thread of this process is using
+        self.idle = list(self.instances)
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """ The next instance free in this process and locked for us in all of them """
+        deadline = time.time() + self.job_timeout
+        with self.condition:
+            while True:
+                for instance in self.idle:
+                    if instance.lock():
+                        self.idle.remove(instance)
+                        return instance
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise OfficePoolError('No OpenOffice instance became free within %s seconds' % (self.job_timeout,))
+                # Other processes don't notify us, look again every half second
+                self.condition.wait(min(remaining, 0.5))
+
+    def release(self, instance):
+        instance.unlock()
+        with self.condition:
+            self.idle.append(instance)
+            self.condition.notify()
+
+    def run(self, job):
+        """ Run job(desktop) on the next free instance.
+        Waits at most job_timeout for an instance and again for the job itself.
+        A job that times out or loses its connection gets its instance restarted.
+        The instance is only handed out again once the job's thread is done with it. """
+        instance = self.acquire()
+        result = {}
+        def work():
+            try:
+                result['value'] = job(instance.get_desktop())
+            except Exception, e:
+                result['error'] = e
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        worker.join(self.job_timeout)
+        if worker.isAlive():
+            # Killing soffice makes the stuck UNO call fail. Keep the port
+            # locked until the thread gives up on the dead desktop, or for
+            # another job_timeout when a restart can't unblock it.
+            instance.restart()
+            def release_after_worker():
+                worker.join(self.job_timeout)
+                if worker.isAlive():
+                    logging.error('{} is still stuck after its restart, releasing it anyway'.format(unicode(instance)))
+                instance.restart()
+                self.release(instance)
+            releaser = threading.Thread(target=release_after_worker)
+            releaser.daemon = True
+            releaser.start()
+            raise OfficePoolError('%s did not finish within %s seconds' % (unicode(instance), self.job_timeout))
+        try:
+            if 'error' in result:
+                if not instance.is_healthy():
+                    instance.restart()
+                raise result['error']
+            return result['value']
+        finally:
+            self.release(instance)
+
+    def desktop(self):
+        """ Desktop of a healthy instance for code that keeps documents open
+        across several calls (uno_report). Not exclusive once returned, just
+        like the single shared soffice used to be, but connecting and
+        starting soffice still go through the port's lock. """
+        return self.run(lambda desktop: desktop)
+
+    def convert(self, path, result_type):
+        """ Convert the file at path to result_type (pdf, doc, xls...)
+        Returns the path of the result, next to the original file. """
+        def job(desktop):
+            converter = Converter(path, result_type, oo=desktop)
+            converter.run()
+            return converter.resultUrl
+        import unohelper
+        try:
+            return unohelper.fileUrlToSystemPath(self.run(job))
+        except ConverterError, e:
+            raise OfficePoolError(str(e))
+
+    def shutdown(self):
+        """ Stop the soffice processes of ports no other process is using """
+        for instance in self.instances:
+            with self.condition:
+                if instance not in self.idle or not instance.lock():
+                    continue
+            try:
+                instance.terminate()
+            finally:
+                instance.unlock()
+
+
+# One pool per process, UNO bridges must not be shared with forked children.
+# The ports' lock files keep the pools of different processes apart.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool():
+    pid = os.getpid()
+    with _pools_lock:
+        if pid not in _pools:
+            _pools.clear()
+            _pools[pid] = OfficePool()
+        return _pools[pid]
+
+
+def convert_file(path, result_type):
+    """ Convert a file with the shared pool, returns the result path """
+    return get_pool().convert(path, result_type)
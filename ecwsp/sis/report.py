@@ -4,12 +4,16 @@ from django.core.servers.basehttp import FileWrapper
 
 from ecwsp.sis.models import *
 from ecwsp.sis.uno_report import uno_save
+from ecwsp.sis.office_pool import convert_file
+from ecwsp.sis.report_data import GradeReportData, strip_trailing_zeros
 from ecwsp.administration.models import *
 from ecwsp.schedule.models import *
 from ecwsp.schedule.calendar import *
+from ecwsp.schedule import school_days
 
 from appy.pod.renderer import Renderer
 from django.contrib.auth.decorators import user_passes_test
+from cStringIO import StringIO
 import tempfile
 import os
 from decimal import *
@@ -18,40 +22,28 @@ class struct(object):
     def __unicode__(self):
         return ""
 
-def strip_trailing_zeros(x):
-    x = str(x).strip()
-    # So sayeth Alex Martelli
-    # http://stackoverflow.com/a/2440786
-    return x.rstrip('0').rstrip('.')
-
 def get_school_day_number(date):
-    mps = MarkingPeriod.objects.filter(school_year__active_year=True).order_by('start_date')
-    current_day = mps[0].start_date
-    day = 0
-    while current_day <= date:
-        is_day = False
-        for mp in mps:
-            if current_day >= mp.start_date and current_day <= mp.end_date:
-                days_off = []
-                for d in mp.daysoff_set.all().values_list('date'): days_off.append(d[0])
-                if not current_day in days_off:
-                    if mp.monday and current_day.isoweekday() == 1:
-                        is_day = True
-                    elif mp.tuesday and current_day.isoweekday() == 2:
-                        is_day = True
-                    elif mp.wednesday and current_day.isoweekday() == 3:
-                        is_day = True
-                    elif mp.thursday and current_day.isoweekday() == 4:
-                        is_day = True
-                    elif mp.friday and current_day.isoweekday() == 5:
-                        is_day = True
-                    elif mp.saturday and current_day.isoweekday() == 6:
-                        is_day = True
-                    elif mp.sunday and current_day.isoweekday() == 7:
-                        is_day = True
-        if is_day: day += 1
-        current_day += timedelta(days=1)
-    return day
+    return school_days.get_school_day_number(date)
+
+
+def render_with_pool(template, data, file_name):
+    """ Render an appy template to file_name. Anything other than odt is
+    rendered as odt first and converted by the OpenOffice pool, which reuses
+    its connections instead of having appy connect on every call. """
+    base, ext = os.path.splitext(file_name)
+    if ext == '.odt':
+        Renderer(template, data, file_name).run()
+        return file_name
+    odt_name = base + '.odt'
+    Renderer(template, data, odt_name).run()
+    try:
+        converted = convert_file(odt_name, ext[1:])
+        if converted != file_name:
+            os.rename(converted, file_name)
+    finally:
+        try: os.remove(odt_name)
+        except OSError: pass
+    return file_name
 
 
 def pod_save(filename, ext, data, template, get_tmp_file=False):
@@ -60,9 +52,17 @@ def pod_save(filename, ext, data, template, get_tmp_file=False):
     # strip comma's from filename
     filename = filename.replace(",", "")
     
+    if ext == ".odt" and not get_tmp_file:
+        # Needs no conversion, so render in memory without any temp file
+        output = StringIO()
+        Renderer(template, data, output).run()
+        response = HttpResponse(output.getvalue(), content_type="application/vnd.oasis.opendocument.text")
+        response['Content-Length'] = len(response.content)
+        response['Content-Disposition'] = 'attachment; filename=' + filename + ext
+        return response
+    
     file_name = tempfile.gettempdir() + '/appy' + str(time.time()) + ext
-    renderer = Renderer(template, data, file_name)
-    renderer.run()
+    render_with_pool(template, data, file_name)
     
     if ext == ".doc":
         content = "application/msword"
@@ -88,6 +88,103 @@ def pod_save(filename, ext, data, template, get_tmp_file=False):
     return response
 
 
+def _render_shard(job, index):
+    """ Render one shard of students from a pod_save_batch job """
+    shard = job['shards'][index]
+    data = dict(job['data'])
+    data['students'] = shard
+    if len(shard) == 1:
+        data['student'] = shard[0]
+        name = unicode(shard[0])
+    else:
+        name = '%s %s' % (job['filename'], index + 1)
+    name = name.replace(",", "").replace("/", "")
+    file_name = os.path.join(job['folder'], '%s %s%s' % (str(index + 1).zfill(4), name, job['ext']))
+    render_with_pool(job['template'], data, file_name.encode('utf-8'))
+    return file_name
+
+
+# The job of a forked worker process, set by its pool initializer so workers
+# inherit the report data instead of having it pickled to them for each shard.
+_worker_job = None
+
+def _init_render_worker(job):
+    global _worker_job
+    _worker_job = job
+
+def _render_worker_shard(index):
+    """ Render one shard in a worker process """
+    from django.db import connection
+    try:
+        return _render_shard(_worker_job, index)
+    finally:
+        # Never reuse a database connection across processes
+        connection.close()
+
+
+def pod_save_batch(filename, ext, data, template, students_per_file=1, workers=None):
+    """ Render data['students'] as several documents in parallel and return them as a zip.
+    Students are split into shards of students_per_file, each shard is rendered
+    with the same template and data into its own file by a pool of worker processes.
+    workers: number of processes, defaults to settings.REPORT_RENDER_WORKERS """
+    import multiprocessing
+    import shutil
+    import zipfile
+    from django.db import connection
+    
+    # strip comma's from filename
+    filename = filename.replace(",", "")
+    if workers is None:
+        workers = getattr(settings, 'REPORT_RENDER_WORKERS', 1)
+    students = list(data['students'])
+    shards = [students[i:i + students_per_file] for i in range(0, len(students), students_per_file)]
+    
+    folder = tempfile.mkdtemp(prefix='appy')
+    if hasattr(template, 'path'):
+        template = template.path
+    elif hasattr(template, 'read'):
+        # Workers can't share one open file, give them a path instead
+        template_file = os.path.join(folder, 'template.odt')
+        f = open(template_file, 'wb')
+        f.write(template.read())
+        f.close()
+        template = template_file
+    
+    job = {
+        'shards': shards,
+        'data': data,
+        'template': template,
+        'folder': folder,
+        'filename': filename,
+        'ext': ext,
+    }
+    if workers > 1 and len(shards) > 1:
+        # Forked workers must open their own database connections
+        connection.close()
+        pool = multiprocessing.Pool(min(workers, len(shards)), _init_render_worker, (job,))
+        try:
+            file_names = pool.map(_render_worker_shard, range(len(shards)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        file_names = [_render_shard(job, i) for i in range(len(shards))]
+    
+    zip_name = os.path.join(folder, 'result.zip')
+    result = zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED)
+    for file_name in file_names:
+        result.write(file_name.encode('utf-8'), os.path.basename(file_name).encode('utf-8'))
+    result.close()
+    
+    wrapper = FileWrapper(file(zip_name))
+    response = HttpResponse(wrapper, content_type="application/zip")
+    response['Content-Length'] = os.path.getsize(zip_name)
+    response['Content-Disposition'] = 'attachment; filename=' + filename + '.zip'
+    try: shutil.rmtree(folder)
+    except: pass
+    return response
+
+
 def get_default_data():
     data={}
     school_name, created = Configuration.objects.get_or_create(name="School Name")
@@ -119,8 +216,9 @@ def pod_report_all(template, options=None, students=None, format="odt"):
     cal = Calendar()
     current_mp = MarkingPeriod.objects.filter(end_date__gte=date.today()).order_by('-start_date')
     if current_mp:
+        schedules = cal.build_schedules(students, current_mp[0])
         for student in students:
-            student.schedule_days, student.periods = cal.build_schedule(student, current_mp[0])
+            student.schedule_days, student.periods = schedules[student.id]
     
     data['students'] = students
     filename = 'output'
@@ -149,7 +247,7 @@ def pod_report_work_study(template, students, format="odt"):
     filename = 'Work Study Report'
     return pod_save(filename, "." + str(format), data, template)  
     
-def pod_report_grade(request, template, options, students, format="odt", transcript=True, report_card=True):
+def pod_report_grade(request, template, options, students, format="odt", transcript=True, report_card=True, split_files=False):
     """ Generate report card and transcript grades via appy
     variables for apply:
     students                - contails all each student
@@ -169,9 +267,6 @@ def pod_report_grade(request, template, options, students, format="odt", transcr
      
     data = get_default_data()
     
-    blank_grade = struct()
-    blank_grade.comment = ""
-    
     for_date = options['date'] # In case we want a transcript from a future date
     data['date_of_report'] = for_date # In case we want to include a python date on our template, which is a bit gross
     
@@ -183,12 +278,6 @@ def pod_report_grade(request, template, options, students, format="odt", transcr
         from ecwsp.benchmark_grade.report import benchmark_report_card
         return benchmark_report_card(template, options, students, format)
     
-    # benchmark_grade transcripts aren't radically different,
-    # but they have some additional data
-    if (transcript and "ecwsp.benchmark_grade" in settings.INSTALLED_APPS):
-        from ecwsp.benchmark_grade.models import Aggregate, Category
-        from ecwsp.benchmark_grade.utility import gradebook_get_average, benchmark_find_calculation_rule, gradebook_get_category_average
-    
     marking_periods = MarkingPeriod.objects.filter(
         school_year=SchoolYear.objects.filter(
             start_date__lt=for_date
@@ -198,175 +287,10 @@ def pod_report_grade(request, template, options, students, format="odt", transcr
     ).filter(show_reports=True)
     data['marking_periods'] = marking_periods.order_by('start_date')
     
-    for student in students:
-        # Cannot just rely on student.gpa for the cumulative GPA; it does not reflect report's date
-        student.current_report_cumulative_gpa = student.calculate_gpa(for_date)
-
-        # for report_card
-        if report_card:
-            courses = Course.objects.filter(
-                courseenrollment__user=student,
-                graded=True,
-            )
-            courses = courses.filter(marking_period__in=marking_periods).distinct().order_by('department')
-            for course in courses:
-                grades = course.grade_set.filter(student=student).filter(
-                    marking_period__isnull=False,
-                    marking_period__show_reports=True)
-                i = 1
-                for grade in grades:
-                    # course.grade1, course.grade2, etc
-                    setattr(course, "grade" + str(i), grade)
-                    i += 1
-                while i <= 4:
-                    setattr(course, "grade" + str(i), blank_grade)
-                    i += 1
-                course.final = course.get_final_grade(student)
-            student.courses = courses
-            
-            #Attendance for marking period
-            i = 1
-            student.absent_total = 0
-            student.absent_unexcused_total = 0
-            student.tardy_total = 0
-            student.tardy_unexcused_total = 0
-            student.dismissed_total = 0
-            for mp in marking_periods.order_by('start_date'):
-                absent = student.student_attn.filter(status__absent=True, date__range=(mp.start_date, mp.end_date))
-                tardy = student.student_attn.filter(status__tardy=True, date__range=(mp.start_date, mp.end_date))
-                dismissed = student.student_attn.filter(status__code="D", date__range=(mp.start_date, mp.end_date)).count()
-                absent_unexcused = absent.exclude(status__excused=True)
-                tardy_unexcused = tardy.exclude(status__excused=True)
-                
-                student.absent_total += absent.count()
-                student.tardy_total += tardy.count()
-                student.absent_unexcused_total += absent_unexcused.count()
-                student.tardy_unexcused_total += tardy_unexcused.count()
-                student.dismissed_total += dismissed
-                setattr(student, "absent" + str(i), absent.count())
-                setattr(student, "tardy" + str(i), tardy.count())
-                setattr(student, "tardy_unexcused" + str(i), tardy_unexcused.count())
-                setattr(student, "absent_unexcused" + str(i), absent_unexcused.count())
-                setattr(student, "dismissed" + str(i), dismissed)
-                i += 1
-            while i <= 6:
-                setattr(student, "absent" + str(i), "")
-                setattr(student, "tardy" + str(i), "")
-                setattr(student, "tardy_unexcused" + str(i), "")
-                setattr(student, "absent_unexcused" + str(i), "")
-                setattr(student, "dismissed" + str(i), "")
-                i += 1
-        
-        ## for transcripts
-        if transcript:
-            student.years = SchoolYear.objects.filter(markingperiod__show_reports=True,start_date__lt=for_date,markingperiod__course__courseenrollment__user=student
-                ).exclude(omityeargpa__student=student).distinct().order_by('start_date')
-            for year in student.years:
-                year.credits = 0
-                year.possible_credits = 0
-                year.mps = MarkingPeriod.objects.filter(course__courseenrollment__user=student, school_year=year, show_reports=True).distinct().order_by("start_date")
-                i = 1
-                for mp in year.mps:
-                    setattr(year, "mp" + str(i), mp.shortname)
-                    i += 1
-                while i <= 6:
-                    setattr(year, "mp" + str(i), "")
-                    i += 1
-                year.courses = Course.objects.filter(courseenrollment__user=student, graded=True, marking_period__school_year=year, marking_period__show_reports=True).distinct()
-                year.courses = UserPreference.objects.get_or_create(user=request.user)[0].sort_courses(year.courses)
-                year_grades = student.grade_set.filter(marking_period__show_reports=True, marking_period__end_date__lte=for_date)
-                # course grades
-                for course in year.courses:
-                    # Grades
-                    course_grades = year_grades.filter(course=course).distinct()
-                    course_aggregates = None
-                    if year.benchmark_grade:
-                        course_aggregates = Aggregate.objects.filter(course=course, student=student)
-                    i = 1
-                    for mp in year.mps:
-                        if mp not in course.marking_period.all():
-                            # Obey the registrar! Don't include grades from marking periods when the course didn't meet.
-                            setattr(course, "grade" + str(i), "")
-                            i += 1
-                            continue
-                        if year.benchmark_grade:
-                            setattr(course, "grade" + str(i), gradebook_get_average(student, course, None, mp))
-                        else:
-                            # We can't overwrite cells, so we have to get seperate variables for each mp grade.
-                            try:
-                                grade = course_grades.get(marking_period=mp).get_grade()
-                                grade = "   " + str(grade) + "   "
-                            except:
-                                grade = ""
-                            setattr(course, "grade" + str(i), grade)
-                        i += 1
-                    while i <= 6:
-                        setattr(course, "grade" + str(i), "")
-                        i += 1
-                    course.final = course.get_final_grade(student, date_report=for_date)
-                    
-                    if mp.end_date < for_date and course.is_passing(student) and course.credits:
-                        year.credits += course.credits
-                    if course.credits:
-                        year.possible_credits += course.credits
-
-                year.categories_as_courses = []
-                if year.benchmark_grade:
-                    calculation_rule = benchmark_find_calculation_rule(year)
-                    for category_as_course in calculation_rule.category_as_course_set.filter(include_departments=course.department):
-                        i = 1
-                        for mp in year.mps:
-                            setattr(category_as_course.category, 'grade{}'.format(i), gradebook_get_category_average(student, category_as_course.category, mp))
-                            i += 1
-                        year.categories_as_courses.append(category_as_course.category)
-                
-                # Averages per marking period
-                i = 1
-                for mp in year.mps:
-                    if mp.end_date < for_date:
-                        setattr(year, 'mp' + str(i) + 'ave', student.calculate_gpa_mp(mp))
-                        i += 1
-                while i <= 6:
-                    setattr(year, 'mp' + str(i) + 'ave', "")
-                    i += 1
-                
-                year.ave = student.calculate_gpa_year(year, for_date)
-                
-                
-                # Attendance for year
-                year.total_days = year.get_number_days()
-                year.nonmemb = student.student_attn.filter(status__code="nonmemb", date__range=(year.start_date, year.end_date)).count()
-                year.absent = student.student_attn.filter(status__absent=True, date__range=(year.start_date, year.end_date)).count()
-                year.tardy = student.student_attn.filter(status__tardy=True, date__range=(year.start_date, year.end_date)).count()
-                year.dismissed = student.student_attn.filter(status__code="D", date__range=(year.start_date, year.end_date)).count()
-            
-            # credits per dept    
-            student.departments = Department.objects.filter(course__courseenrollment__user=student).distinct()
-            student.departments_text = ""
-            for dept in student.departments:
-                c = 0
-                for course in student.course_set.filter(department=dept, marking_period__school_year__end_date__lt=for_date, graded=True).distinct():
-                    if course.credits and course.is_passing(student):
-                        c += course.credits
-                dept.credits = c
-                student.departments_text += "| %s: %s " % (dept, dept.credits)
-            student.departments_text += "|"
-            
-            # Standardized tests
-            if 'ecwsp.standard_test' in settings.INSTALLED_APPS:
-                from ecwsp.standard_test.models import StandardTest
-                student.tests = []
-                student.highest_tests = []
-                for test_result in student.standardtestresult_set.filter(test__show_on_reports=True,show_on_reports=True).order_by('test'):
-                    test_result.categories = ""
-                    for cat in test_result.standardcategorygrade_set.filter(category__is_total=False):
-                        test_result.categories += '%s: %s  |  ' % (cat.category.name, strip_trailing_zeros(cat.grade))
-                    test_result.categories = test_result.categories [:-3]
-                    student.tests.append(test_result)
-                    
-                for test in StandardTest.objects.filter(standardtestresult__student=student, show_on_reports=True, standardtestresult__show_on_reports=True).distinct():
-                    test.total = strip_trailing_zeros(test.get_cherry_pick_total(student))
-                    student.highest_tests.append(test)
+    # All grades, attendance, etc are loaded for every student at once
+    course_sort = UserPreference.objects.get_or_create(user=request.user)[0].course_sort
+    report_data = GradeReportData(students, for_date, marking_periods, course_sort)
+    students = report_data.prepare(report_card=report_card, transcript=transcript)
 
     try:
         if options['student'].count == 1:
@@ -376,4 +300,6 @@ def pod_report_grade(request, template, options, students, format="odt", transcr
     data['students'] = students
     data['strip_trailing_zeros'] = strip_trailing_zeros
     filename = 'output'
+    if split_files:
+        return pod_save_batch(filename, "." + str(format), data, template)
     return pod_save(filename, "." + str(format), data, template)
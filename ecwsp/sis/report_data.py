@@ -0,0 +1,367 @@
+""" Data assembly for report cards and transcripts.
+
+pod_report_grade used to run nested queries for every course, marking period
+and attendance status of every student. GradeReportData loads all rows for the
+selected students up front and then sets the same attributes the appy
+templates have always used (course.grade1..4, student.absent1..6, year.mps, etc).
+"""
+from django.conf import settings
+
+from ecwsp.schedule.models import Course, CourseEnrollment, MarkingPeriod
+from ecwsp.sis.gpa import GPAData, compute_gpas
+from ecwsp.sis.helper_functions import Struct
+
+import copy
+
+
+def strip_trailing_zeros(x):
+    x = str(x).strip()
+    # So sayeth Alex Martelli
+    # http://stackoverflow.com/a/2440786
+    return x.rstrip('0').rstrip('.')
+
+
+def department_sort_key(department):
+    """ Same order as Department Meta ordering, empty values first like the database """
+    if department is None:
+        return (False, False, None, None)
+    return (True, department.order_rank is not None, department.order_rank, department.name)
+
+
+def sort_courses(courses, course_sort, course_mps):
+    """ In memory version of UserPreference.sort_courses
+    courses: list of Course
+    course_sort: UserPreference.course_sort value
+    course_mps: {course.id: [MarkingPeriod, ...]} marking periods the courses were selected by """
+    def by_department(course):
+        return department_sort_key(course.department)
+    def by_marking_period(course):
+        mps = course_mps.get(course.id, [])
+        return (-len(mps), max([mp.end_date for mp in mps] or [None]))
+    if course_sort == 'department':
+        return sorted(courses, key=lambda course: (by_department(course), course.id))
+    if course_sort == 'marking_period,department':
+        return sorted(courses, key=lambda course: (by_marking_period(course), by_department(course), course.id))
+    if course_sort == 'marking_period,fullname':
+        return sorted(courses, key=lambda course: (by_marking_period(course), course.fullname, course.id))
+    return courses
+
+
+class GradeReportData(object):
+    """ Everything pod_report_grade needs for a set of students.
+    Each kind of row is loaded with a single query in __init__, prepare()
+    then only works in memory except for benchmark grade years. """
+    def __init__(self, students, for_date, marking_periods, course_sort='department'):
+        """ students: Students on the report
+        for_date: Date of the report
+        marking_periods: Marking periods shown on report cards
+        course_sort: UserPreference.course_sort used on transcripts """
+        self.students = list(students)
+        self.for_date = for_date
+        self.marking_periods = list(marking_periods.order_by('start_date'))
+        self.course_sort = course_sort
+        student_ids = [student.id for student in self.students]
+
+        self.gpa_data = GPAData(student_ids)
+
+        # {student_id: [course_id, ...]} for every enrollment, graded or not
+        self.student_courses = {}
+        enrollments = CourseEnrollment.objects.filter(user__in=student_ids).values_list('user_id', 'course_id').distinct()
+        for student_id, course_id in enrollments:
+            courses = self.student_courses.setdefault(student_id, [])
+            if course_id not in courses:
+                courses.append(course_id)
+        course_ids = set([course_id for student_course_ids in self.student_courses.values() for course_id in student_course_ids])
+        self.courses = dict([(course.id, course) for course in Course.objects.filter(id__in=course_ids).select_related('department')])
+
+        # {course_id: [MarkingPeriod, ...]}
+        self.course_mps = {}
+        course_mps = Course.marking_period.through.objects.filter(course__in=course_ids).values_list('course_id', 'markingperiod_id')
+        mps = MarkingPeriod.objects.filter(id__in=set([mp_id for course_id, mp_id in course_mps])).select_related('school_year')
+        mps = dict([(mp.id, mp) for mp in mps])
+        for course_id, mp_id in course_mps:
+            self.course_mps.setdefault(course_id, []).append(mps[mp_id])
+
+        # {(student_id, course_id): [Grade, ...]}
+        self.grades = {}
+        if 'ecwsp.grades' in settings.INSTALLED_APPS:
+            from ecwsp.grades.models import Grade
+            for grade in Grade.objects.filter(student__in=student_ids).select_related('marking_period').order_by('id'):
+                self.grades.setdefault((grade.student_id, grade.course_id), []).append(grade)
+
+        # Attendance of every report card marking period and transcript year
+        from ecwsp.attendance.aggregation import AttendanceMatrix
+        periods = set([(mp.start_date, mp.end_date) for mp in self.marking_periods])
+        for mp in mps.values():
+            periods.add((mp.school_year.start_date, mp.school_year.end_date))
+        self.attendance = AttendanceMatrix(periods, students=student_ids)
+
+        # {student_id: [StandardTestResult, ...]}
+        self.test_results = {}
+        # {result_id: [StandardCategoryGrade, ...]}
+        self.test_category_grades = {}
+        if 'ecwsp.standard_test' in settings.INSTALLED_APPS:
+            from ecwsp.standard_test.models import StandardTestResult, StandardCategoryGrade
+            results = StandardTestResult.objects.filter(student__in=student_ids, show_on_reports=True).select_related('test').order_by('test', 'id')
+            for result in results:
+                self.test_results.setdefault(result.student_id, []).append(result)
+            category_grades = StandardCategoryGrade.objects.filter(
+                result__student__in=student_ids, result__show_on_reports=True).select_related('category').order_by('id')
+            for category_grade in category_grades:
+                self.test_category_grades.setdefault(category_grade.result_id, []).append(category_grade)
+
+        self.year_days = {}
+
+    def get_attendance(self, student, start_date, end_date):
+        """ AttendanceCounts of a student from start_date to end_date, the dates
+        of a report card marking period or a school year of the student's courses """
+        return self.attendance.get(student, (start_date, end_date))
+
+    def get_year_days(self, year):
+        if year.id not in self.year_days:
+            self.year_days[year.id] = year.get_number_days()
+        return self.year_days[year.id]
+
+    def get_graded_courses(self, student):
+        return [self.courses[course_id] for course_id in self.student_courses.get(student.id, [])
+                if self.courses[course_id].graded]
+
+    def prepare(self, report_card=True, transcript=True):
+        """ Set report attributes on every student """
+        cumulative_gpas = compute_gpas(self.students, date_report=self.for_date, gpa_data=self.gpa_data)
+        for student in self.students:
+            # Cannot just rely on student.gpa for the cumulative GPA; it does not reflect report's date
+            student.current_report_cumulative_gpa = cumulative_gpas[student.id]
+            if report_card:
+                self.prepare_report_card(student)
+            if transcript:
+                self.prepare_transcript(student)
+        return self.students
+
+    def prepare_report_card(self, student):
+        blank_grade = Struct()
+        blank_grade.comment = ""
+        report_mp_ids = [mp.id for mp in self.marking_periods]
+        courses = []
+        for course in self.get_graded_courses(student):
+            if not [mp for mp in self.course_mps.get(course.id, []) if mp.id in report_mp_ids]:
+                continue
+            course = copy.copy(course)
+            grades = [grade for grade in self.grades.get((student.id, course.id), [])
+                      if grade.marking_period_id and grade.marking_period.show_reports]
+            i = 1
+            for grade in grades:
+                # course.grade1, course.grade2, etc
+                setattr(course, "grade" + str(i), grade)
+                i += 1
+            while i <= 4:
+                setattr(course, "grade" + str(i), blank_grade)
+                i += 1
+            course.final = self.gpa_data.get_final_grade(student.id, course.id)
+            courses.append(course)
+        student.courses = sorted(courses, key=lambda course: (department_sort_key(course.department), course.id))
+
+        #Attendance for marking period
+        i = 1
+        student.absent_total = 0
+        student.absent_unexcused_total = 0
+        student.tardy_total = 0
+        student.tardy_unexcused_total = 0
+        student.dismissed_total = 0
+        for mp in self.marking_periods:
+            counts = self.get_attendance(student, mp.start_date, mp.end_date)
+            student.absent_total += counts.absent
+            student.tardy_total += counts.tardy
+            student.absent_unexcused_total += counts.absent_unexcused
+            student.tardy_unexcused_total += counts.tardy_unexcused
+            student.dismissed_total += counts.dismissed
+            setattr(student, "absent" + str(i), counts.absent)
+            setattr(student, "tardy" + str(i), counts.tardy)
+            setattr(student, "tardy_unexcused" + str(i), counts.tardy_unexcused)
+            setattr(student, "absent_unexcused" + str(i), counts.absent_unexcused)
+            setattr(student, "dismissed" + str(i), counts.dismissed)
+            i += 1
+        while i <= 6:
+            setattr(student, "absent" + str(i), "")
+            setattr(student, "tardy" + str(i), "")
+            setattr(student, "tardy_unexcused" + str(i), "")
+            setattr(student, "absent_unexcused" + str(i), "")
+            setattr(student, "dismissed" + str(i), "")
+            i += 1
+
+    def get_years(self, student):
+        """ School years with reportable marking periods the student is enrolled in """
+        years = {}
+        for course_id in self.student_courses.get(student.id, []):
+            for mp in self.course_mps.get(course_id, []):
+                year = mp.school_year
+                if (mp.show_reports and year.start_date < self.for_date and
+                    (student.id, year.id) not in self.gpa_data.omit_years):
+                    years[year.id] = year
+        return [copy.copy(school_year) for school_year in sorted(years.values(), key=lambda school_year: school_year.start_date)]
+
+    def prepare_transcript(self, student):
+        if "ecwsp.benchmark_grade" in settings.INSTALLED_APPS:
+            from ecwsp.benchmark_grade.utility import gradebook_get_average, benchmark_find_calculation_rule, gradebook_get_category_average
+
+        student.years = self.get_years(student)
+        for year in student.years:
+            year.credits = 0
+            year.possible_credits = 0
+            year_mps = {}
+            for course_id in self.student_courses.get(student.id, []):
+                for mp in self.course_mps.get(course_id, []):
+                    if mp.school_year_id == year.id and mp.show_reports:
+                        year_mps[mp.id] = mp
+            year.mps = sorted(year_mps.values(), key=lambda mp: mp.start_date)
+            i = 1
+            for mp in year.mps:
+                setattr(year, "mp" + str(i), mp.shortname)
+                i += 1
+            while i <= 6:
+                setattr(year, "mp" + str(i), "")
+                i += 1
+
+            courses = []
+            courses_year_mps = {}
+            for course in self.get_graded_courses(student):
+                course_year_mps = [mp for mp in self.course_mps.get(course.id, [])
+                                   if mp.school_year_id == year.id and mp.show_reports]
+                if course_year_mps:
+                    courses.append(copy.copy(course))
+                    courses_year_mps[course.id] = course_year_mps
+            year.courses = sort_courses(courses, self.course_sort, courses_year_mps)
+
+            # course grades
+            last_mp = year.mps[-1]
+            for course in year.courses:
+                course_mp_ids = [mp.id for mp in self.course_mps.get(course.id, [])]
+                # Grades
+                course_grades = {}
+                for grade in self.grades.get((student.id, course.id), []):
+                    if (grade.marking_period_id and grade.marking_period.show_reports and
+                        grade.marking_period.end_date <= self.for_date):
+                        course_grades[grade.marking_period_id] = grade
+                i = 1
+                for mp in year.mps:
+                    if mp.id not in course_mp_ids:
+                        # Obey the registrar! Don't include grades from marking periods when the course didn't meet.
+                        setattr(course, "grade" + str(i), "")
+                        i += 1
+                        continue
+                    if year.benchmark_grade:
+                        setattr(course, "grade" + str(i), gradebook_get_average(student, course, None, mp))
+                    else:
+                        # We can't overwrite cells, so we have to get seperate variables for each mp grade.
+                        if mp.id in course_grades:
+                            grade = "   " + str(course_grades[mp.id].get_grade()) + "   "
+                        else:
+                            grade = ""
+                        setattr(course, "grade" + str(i), grade)
+                    i += 1
+                while i <= 6:
+                    setattr(course, "grade" + str(i), "")
+                    i += 1
+                course.final = self.gpa_data.get_final_grade(student.id, course.id, self.for_date)
+
+                if last_mp.end_date < self.for_date and self.gpa_data.is_passing(student.id, course.id) and course.credits:
+                    year.credits += course.credits
+                if course.credits:
+                    year.possible_credits += course.credits
+
+            year.categories_as_courses = []
+            if year.benchmark_grade and year.courses:
+                calculation_rule = benchmark_find_calculation_rule(year)
+                for category_as_course in calculation_rule.category_as_course_set.filter(include_departments=year.courses[-1].department):
+                    i = 1
+                    for mp in year.mps:
+                        setattr(category_as_course.category, 'grade{}'.format(i), gradebook_get_category_average(student, category_as_course.category, mp))
+                        i += 1
+                    year.categories_as_courses.append(category_as_course.category)
+
+            # Averages per marking period
+            i = 1
+            for mp in year.mps:
+                if mp.end_date < self.for_date:
+                    setattr(year, 'mp' + str(i) + 'ave', compute_gpas((student,), marking_period=mp, gpa_data=self.gpa_data)[student.id])
+                    i += 1
+            while i <= 6:
+                setattr(year, 'mp' + str(i) + 'ave', "")
+                i += 1
+
+            year.ave = compute_gpas((student,), date_report=self.for_date, year=year, gpa_data=self.gpa_data)[student.id]
+
+            # Attendance for year
+            year.total_days = self.get_year_days(year)
+            counts = self.get_attendance(student, year.start_date, year.end_date)
+            year.nonmemb = counts.nonmemb
+            year.absent = counts.absent
+            year.tardy = counts.tardy
+            year.dismissed = counts.dismissed
+
+        # credits per dept
+        departments = {}
+        for course_id in self.student_courses.get(student.id, []):
+            department = self.courses[course_id].department
+            if department is not None:
+                departments[department.id] = department
+        student.departments = [copy.copy(dept) for dept in sorted(departments.values(), key=department_sort_key)]
+        student.departments_text = ""
+        for dept in student.departments:
+            c = 0
+            for course in self.get_graded_courses(student):
+                if course.department_id != dept.id:
+                    continue
+                if not [mp for mp in self.course_mps.get(course.id, []) if mp.school_year.end_date < self.for_date]:
+                    continue
+                if course.credits and self.gpa_data.is_passing(student.id, course.id):
+                    c += course.credits
+            dept.credits = c
+            student.departments_text += "| %s: %s " % (dept, dept.credits)
+        student.departments_text += "|"
+
+        # Standardized tests
+        if 'ecwsp.standard_test' in settings.INSTALLED_APPS:
+            self.prepare_standard_tests(student)
+
+    def prepare_standard_tests(self, student):
+        student.tests = []
+        student.highest_tests = []
+        results = self.test_results.get(student.id, [])
+        for test_result in results:
+            if not test_result.test.show_on_reports:
+                continue
+            test_result.categories = ""
+            for cat in self.test_category_grades.get(test_result.id, []):
+                if not cat.category.is_total:
+                    test_result.categories += '%s: %s  |  ' % (cat.category.name, strip_trailing_zeros(cat.grade))
+            test_result.categories = test_result.categories [:-3]
+            student.tests.append(test_result)
+
+        tests = {}
+        for test_result in results:
+            if test_result.test.show_on_reports:
+                tests.setdefault(test_result.test_id, (test_result.test, []))[1].append(test_result)
+        for test_id in sorted(tests.keys()):
+            test, test_results = tests[test_id]
+            test = copy.copy(test)
+            test.total = strip_trailing_zeros(self.get_cherry_pick_total(test, test_results))
+            student.highest_tests.append(test)
+
+    def get_cherry_pick_total(self, test, test_results):
+        """ Same as StandardTest.get_cherry_pick_total from preloaded results """
+        cherry = 0
+        if test.cherry_pick_final:
+            for result in test_results:
+                for cat_total in self.test_category_grades.get(result.id, []):
+                    if cat_total.category.is_total and cat_total.grade > cherry:
+                        cherry = cat_total.grade
+        elif test.cherry_pick_categories:
+            highest = {}
+            for result in test_results:
+                for cat in self.test_category_grades.get(result.id, []):
+                    if cat.category_id not in highest or cat.grade > highest[cat.category_id]:
+                        highest[cat.category_id] = cat.grade
+            for grade in highest.values():
+                cherry += grade
+        return cherry
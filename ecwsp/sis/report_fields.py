@@ -0,0 +1,107 @@
+""" Additional student columns of spreadsheet reports.
+
+Users pick ReportFields in their UserPreference: dotted attribute paths from
+a Student, such as "year" or "cohorts", added as columns to reports. A path
+ending in a many to many (or reverse foreign key) relation takes as many
+columns as the most related objects any student of the report has.
+
+ReportFieldResolver compiles the paths once per report by looking at the
+model descriptors: foreign key steps are loaded with select_related and a
+relation at the end with prefetch_related. The students are loaded with
+those in chunks and their cells kept by id, so adding the columns to a row
+is a dictionary lookup.
+"""
+from django.db.models import Manager
+from django.db.models.query import QuerySet
+from django.db.models.fields.related import ReverseSingleRelatedObjectDescriptor, SingleRelatedObjectDescriptor
+from django.db.models.fields.related import ForeignRelatedObjectsDescriptor, ManyRelatedObjectsDescriptor, ReverseManyRelatedObjectsDescriptor
+
+from ecwsp.sis.models import Student
+
+# Students per query
+RESOLVER_CHUNK = 500
+
+
+class FieldPath(object):
+    """ A ReportField name compiled against the Student model """
+    def __init__(self, name):
+        self.name = name
+        self.segments = name.split('.')
+        # Related objects to load with the student, 'year__...' or None
+        self.select_related = None
+        # Relation ending the path to prefetch, or None
+        self.prefetch_related = None
+        model = Student
+        related = []
+        for i, segment in enumerate(self.segments):
+            descriptor = getattr(model, segment, None)
+            if isinstance(descriptor, ReverseSingleRelatedObjectDescriptor):
+                model = descriptor.field.rel.to
+            elif isinstance(descriptor, SingleRelatedObjectDescriptor):
+                model = descriptor.related.model
+            elif isinstance(descriptor, (ForeignRelatedObjectsDescriptor, ManyRelatedObjectsDescriptor,
+                                         ReverseManyRelatedObjectsDescriptor)):
+                if i == len(self.segments) - 1:
+                    self.prefetch_related = '__'.join(self.segments)
+                break
+            else:
+                # A field or property, read from the object
+                break
+            related.append(segment)
+        if related:
+            self.select_related = '__'.join(related)
+
+    def cells(self, student):
+        """ [unicode, ...] one per related object when the path ends in a
+        relation, one otherwise. Paths that can't be followed give an empty cell """
+        try:
+            object = student
+            for segment in self.segments:
+                object = getattr(object, segment)
+            if isinstance(object, Manager):
+                return [unicode(one_of_many) for one_of_many in object.all()]
+            return [unicode(object)]
+        except Exception:
+            return [u""]
+
+
+class ReportFieldResolver(object):
+    def __init__(self, names, students):
+        """ names: ReportField names
+        students: every student the report may show """
+        self.paths = [FieldPath(name) for name in names]
+        # {student_id: [[cell, ...] of each path]}
+        self.values = {}
+        if self.paths:
+            if isinstance(students, QuerySet):
+                student_ids = list(students.values_list('id', flat=True))
+            else:
+                student_ids = [student.id for student in students]
+            queryset = Student.objects.all()
+            select_related = [path.select_related for path in self.paths if path.select_related]
+            if select_related:
+                queryset = queryset.select_related(*select_related)
+            prefetch_related = [path.prefetch_related for path in self.paths if path.prefetch_related]
+            if prefetch_related:
+                queryset = queryset.prefetch_related(*prefetch_related)
+            for start in range(0, len(student_ids), RESOLVER_CHUNK):
+                for student in queryset.filter(id__in=student_ids[start:start + RESOLVER_CHUNK]):
+                    self.values[student.id] = [path.cells(student) for path in self.paths]
+        # Columns of each path
+        self.widths = []
+        for i in range(len(self.paths)):
+            self.widths.append(max([1] + [len(values[i]) for values in self.values.values()]))
+        self.titles = []
+        for path, width in zip(self.paths, self.widths):
+            self.titles += [path.name] * width
+
+    def cells(self, student):
+        """ The additional columns of a student, as many as titles """
+        values = self.values.get(student.id)
+        if values is None:
+            # Not one of the students of the report
+            values = [path.cells(student) for path in self.paths]
+        row = []
+        for cells, width in zip(values, self.widths):
+            row += cells[:width] + [u""] * (width - len(cells))
+        return row
@@ -0,0 +1,296 @@
+""" Spreadsheet reports written a row at a time.
+
+xlsReport needs every row in memory and xlwt keeps the whole workbook there
+too. StreamingReport takes any iterable of rows, generators included, and
+writes them as they come: csv straight into the HTTP response, xlsx and ods
+into temporary files that are zipped and then streamed. Only xls, written
+through xlsReport for old clients, is built in memory.
+
+Cells are converted like xlsReport does, numbers and strings that look like
+numbers become number cells and anything else text, but each column
+remembers once it holds text and stops trying to parse its strings.
+xlwt formulas are only understood in xls.
+"""
+from django.http import StreamingHttpResponse
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
+from django.utils.encoding import smart_str
+
+from ecwsp.sis.xlsReport import customXls, i_to_column_letter
+
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+import csv
+import re
+import tempfile
+import zipfile
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xls': 'application/vnd.ms-excel',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'ods': 'application/vnd.oasis.opendocument.spreadsheet',
+}
+
+_NUMBER_TYPES = (int, long, float, Decimal)
+# Characters XML 1.0 does not allow
+_INVALID_XML = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_INVALID_SHEET_NAME = re.compile(r'[\[\]:*?/\\]')
+
+# Cell styles
+DATA = 0
+HEADING = 1
+
+
+def _xml_text(text):
+    return escape(_INVALID_XML.sub(u'', text)).encode('utf-8')
+
+def _number_text(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class CellConverter(object):
+    """ Converts the cells of a sheet, remembering which columns hold text """
+    def __init__(self):
+        self.text_columns = set()
+
+    def convert(self, column, value):
+        """ Returns (is_number, value) with value a number or unicode """
+        if type(value) in _NUMBER_TYPES:
+            return True, value
+        if isinstance(value, basestring):
+            text = value
+        else:
+            text = unicode(value)
+        if column not in self.text_columns:
+            try:
+                number = float(text)
+                # nan and inf aren't numbers spreadsheets can hold
+                if number - number == 0:
+                    return True, number
+            except ValueError:
+                pass
+            self.text_columns.add(column)
+        return False, text
+
+
+class Sheet(object):
+    def __init__(self, rows, titles=None, heading="", heading_top=True):
+        self.rows = rows
+        self.titles = titles
+        self.heading = heading
+        self.heading_top = heading_top
+
+    def styled_rows(self):
+        """ (style, row) of the heading, titles and data """
+        if self.heading != "" and self.heading_top:
+            yield HEADING, [self.heading]
+        if self.titles:
+            yield HEADING, self.titles
+        for row in self.rows:
+            yield DATA, row
+
+    def cells(self):
+        """ (style, [(is_number, value), ...]) of every row """
+        converter = CellConverter()
+        for style, row in self.styled_rows():
+            if style == HEADING:
+                yield style, [(False, unicode(cell)) for cell in row]
+            else:
+                yield style, [converter.convert(x, cell) for x, cell in enumerate(row)]
+
+
+class StreamingReport(object):
+    def __init__(self, file_name="report", format="xlsx"):
+        """ file_name: without extension
+        format: csv, xls, xlsx or ods. UserPreference.get_format(type="spreadsheet")
+        gives the one a user prefers """
+        if format not in CONTENT_TYPES:
+            raise ValueError('Unknown spreadsheet format {}'.format(format))
+        self.file_name = file_name
+        self.format = format
+        self.sheets = []
+
+    def add_sheet(self, rows, titles=None, heading="", heading_top=True):
+        """ rows: iterable of rows, each an iterable of cells. It is only
+        consumed when the report is written
+        titles: header array
+        heading: sheet name, and a row above the titles when heading_top.
+        csv files have no sheet names, sheets are written one after the other """
+        self.sheets.append(Sheet(rows, titles, heading, heading_top))
+
+    def sheet_names(self):
+        """ Names spreadsheets accept: short, unique and without []:*?/\\ """
+        names = []
+        for i, sheet in enumerate(self.sheets):
+            name = _INVALID_SHEET_NAME.sub(u'', unicode(sheet.heading))[:31] or u'Sheet{}'.format(i + 1)
+            while name in names:
+                name = u'{}{}'.format(name[:28], i + 1)
+            names.append(name)
+        return names
+
+    def csv_lines(self):
+        """ Encoded csv lines of every sheet, cells as they are since csv has no types """
+        class Line(object):
+            def write(self, value):
+                return value
+        writer = csv.writer(Line())
+        for sheet in self.sheets:
+            for style, row in sheet.styled_rows():
+                yield writer.writerow([smart_str(cell) for cell in row])
+
+    def write(self, output):
+        """ Write the whole report to a file object, seekable unless csv """
+        if self.format == 'csv':
+            for line in self.csv_lines():
+                output.write(line)
+        elif self.format == 'xls':
+            report = customXls(self.file_name)
+            for sheet in self.sheets:
+                report.addSheet(sheet.rows, sheet.titles, sheet.heading, heading_top=sheet.heading_top)
+            report.wb.save(output)
+        elif self.format == 'xlsx':
+            self._write_xlsx(output)
+        else:
+            self._write_ods(output)
+
+    def finish(self):
+        """ Response streaming the report """
+        if self.format == 'csv':
+            response = StreamingHttpResponse(self.csv_lines(), content_type=CONTENT_TYPES['csv'])
+        else:
+            output = tempfile.TemporaryFile()
+            self.write(output)
+            response = StreamingHttpResponse(FileWrapper(output), content_type=CONTENT_TYPES[self.format])
+            response['Content-Length'] = output.tell()
+            output.seek(0)
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (self.file_name, self.format)
+        return response
+
+    def save(self, filename):
+        """ Write the report to MEDIA_ROOT + filename """
+        output = open(settings.MEDIA_ROOT + filename, 'wb')
+        try:
+            self.write(output)
+        finally:
+            output.close()
+
+    def _write_zip_entry(self, archive, arcname, write):
+        """ Stream what write(file) writes into archive without holding it """
+        entry = tempfile.NamedTemporaryFile()
+        try:
+            write(entry)
+            entry.flush()
+            archive.write(entry.name, arcname)
+        finally:
+            entry.close()
+
+    def _write_xlsx(self, output):
+        names = self.sheet_names()
+        archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('[Content_Types].xml',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>' +
+            ''.join(['<Override PartName="/xl/worksheets/sheet%s.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' % (i + 1,)
+                     for i in range(len(names))]) +
+            '</Types>')
+        archive.writestr('_rels/.rels',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>')
+        archive.writestr('xl/workbook.xml',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>' +
+            ''.join(['<sheet name=%s sheetId="%s" r:id="rId%s"/>' % (quoteattr(name).encode('utf-8'), i + 1, i + 1)
+                     for i, name in enumerate(names)]) +
+            '</sheets></workbook>')
+        archive.writestr('xl/_rels/workbook.xml.rels',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' +
+            ''.join(['<Relationship Id="rId%s" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet%s.xml"/>' % (i + 1, i + 1)
+                     for i in range(len(names))]) +
+            '<Relationship Id="rId%s" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>' % (len(names) + 1,) +
+            '</Relationships>')
+        archive.writestr('xl/styles.xml',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<fonts count="2"><font><sz val="10"/><name val="Arial"/></font><font><b/><sz val="10"/><name val="Arial"/></font></fonts>'
+            '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+            '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+            '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+            '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+            '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+            '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+            '</styleSheet>')
+        for i, sheet in enumerate(self.sheets):
+            self._write_zip_entry(archive, 'xl/worksheets/sheet%s.xml' % (i + 1,),
+                lambda entry: self._write_xlsx_sheet(entry, sheet))
+        archive.close()
+
+    def _write_xlsx_sheet(self, output, sheet):
+        output.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+        letters = []
+        for y, (style, cells) in enumerate(sheet.cells()):
+            output.write('<row r="%s">' % (y + 1,))
+            while len(letters) < len(cells):
+                letters.append(i_to_column_letter(len(letters) + 1))
+            for x, (is_number, value) in enumerate(cells):
+                reference = '%s%s' % (letters[x], y + 1)
+                style_attribute = ' s="1"' if style == HEADING else ''
+                if is_number:
+                    output.write('<c r="%s"%s><v>%s</v></c>' % (reference, style_attribute, _number_text(value)))
+                else:
+                    output.write('<c r="%s"%s t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+                        reference, style_attribute, _xml_text(value)))
+            output.write('</row>')
+        output.write('</sheetData></worksheet>')
+
+    def _write_ods(self, output):
+        archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+        # Must come first and uncompressed
+        archive.writestr(zipfile.ZipInfo('mimetype'), CONTENT_TYPES['ods'])
+        archive.writestr('META-INF/manifest.xml',
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">'
+            '<manifest:file-entry manifest:full-path="/" manifest:version="1.2" manifest:media-type="%s"/>'
+            '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+            '</manifest:manifest>' % (CONTENT_TYPES['ods'],))
+        self._write_zip_entry(archive, 'content.xml', self._write_ods_content)
+        archive.close()
+
+    def _write_ods_content(self, output):
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+            'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+            'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+            'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+            'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" office:version="1.2">'
+            '<office:automatic-styles><style:style style:name="heading" style:family="table-cell">'
+            '<style:text-properties fo:font-weight="bold"/></style:style></office:automatic-styles>'
+            '<office:body><office:spreadsheet>')
+        for name, sheet in zip(self.sheet_names(), self.sheets):
+            output.write('<table:table table:name=%s>' % (quoteattr(name).encode('utf-8'),))
+            for style, cells in sheet.cells():
+                output.write('<table:table-row>')
+                style_attribute = ' table:style-name="heading"' if style == HEADING else ''
+                for is_number, value in cells:
+                    if is_number:
+                        output.write('<table:table-cell%s office:value-type="float" office:value="%s"><text:p>%s</text:p></table:table-cell>' % (
+                            style_attribute, _number_text(value), _number_text(value)))
+                    else:
+                        output.write('<table:table-cell%s office:value-type="string"><text:p>%s</text:p></table:table-cell>' % (
+                            style_attribute, _xml_text(value)))
+                if not cells:
+                    output.write('<table:table-cell/>')
+                output.write('</table:table-row>')
+            output.write('</table:table>')
+        output.write('</office:spreadsheet></office:body></office:document-content>')
@@ -0,0 +1,8 @@
+from celery import task
+
+
+@task()
+def import_everything(import_log_id):
+    """ Run a spreadsheet import uploaded through sis.views.import_everything """
+    from ecwsp.sis.importer import run_import_job
+    run_import_job(import_log_id)
@@ -6,6 +6,7 @@ from ecwsp.sis.models import *
 from ecwsp.schedule.models import *
 
 from datetime import date, datetime
+from decimal import Decimal
 
 class AttendanceTest(TestCase):
     def setup(self):
@@ -139,3 +140,162 @@ class AttendanceTest(TestCase):
         
         self.failUnlessEqual(self.student.gpa, Decimal('69.55'))
 
+    
+    def test_compute_gpas(self):
+        """
+        Tests bulk GPA calculation matches single student calculation
+        """
+        from ecwsp.grades.models import Grade
+        from ecwsp.sis.gpa import compute_gpas
+        self.setup()
+        
+        student2 = Student(fname="Jane", lname="Student", username="jastudent")
+        student2.save()
+        for student, grades in ((self.student, ('50', '89.09')), (student2, ('100', 'P'))):
+            CourseEnrollment(user=student, course=self.course2, role="student").save()
+            for mp, value in zip((self.mp, self.mp2), grades):
+                grade = Grade(student=student, course=self.course2, marking_period=mp)
+                grade.set_grade(value)
+                grade.save()
+        
+        students = Student.objects.filter(id__in=(self.student.id, student2.id))
+        gpas = compute_gpas(students)
+        self.failUnlessEqual(gpas[self.student.id], Decimal('69.55'))
+        self.failUnlessEqual(gpas[self.student.id], self.student.calculate_gpa())
+        self.failUnlessEqual(gpas[student2.id], student2.calculate_gpa())
+        
+        mp_gpas = compute_gpas(students, marking_period=self.mp)
+        self.failUnlessEqual(mp_gpas[self.student.id], Decimal('50.00'))
+        self.failUnlessEqual(mp_gpas[student2.id], Decimal('100.00'))
+    
+    def test_deferred_gpa(self):
+        """
+        Tests cache_gpa is only written once a deferred block ends
+        """
+        from ecwsp.grades.models import Grade
+        from ecwsp.sis.gpa import defer_gpa_updates
+        self.setup()
+        CourseEnrollment(user=self.student, course=self.course2, role="student").save()
+        
+        with defer_gpa_updates():
+            for mp, value in ((self.mp, '50'), (self.mp2, '89.09')):
+                grade = Grade(student=self.student, course=self.course2, marking_period=mp)
+                grade.set_grade(value)
+                grade.save()
+            self.failUnlessEqual(Student.objects.get(id=self.student.id).cache_gpa, None)
+        self.failUnlessEqual(Student.objects.get(id=self.student.id).cache_gpa, Decimal('69.55'))
+
+    def test_deferred_gpa_exception(self):
+        """
+        Tests a block ended by an exception, or never ended, doesn't keep deferring
+        """
+        from ecwsp.grades.models import Grade
+        from ecwsp.sis.gpa import defer_gpa_updates, begin_deferred_gpa_updates, end_deferred_gpa_updates
+        self.setup()
+        CourseEnrollment(user=self.student, course=self.course2, role="student").save()
+        def save_grade(value):
+            grade, created = Grade.objects.get_or_create(student=self.student, course=self.course2, marking_period=self.mp)
+            grade.set_grade(value)
+            grade.save()
+        try:
+            with defer_gpa_updates():
+                save_grade('50')
+                raise ValueError
+        except ValueError:
+            pass
+        self.failUnlessEqual(Student.objects.get(id=self.student.id).cache_gpa, Decimal('50.00'))
+        # A request whose end was lost, the next one starts over
+        begin_deferred_gpa_updates(outermost=True)
+        save_grade('60')
+        begin_deferred_gpa_updates(outermost=True)
+        self.failUnlessEqual(Student.objects.get(id=self.student.id).cache_gpa, Decimal('60.00'))
+        end_deferred_gpa_updates()
+        save_grade('70')
+        self.failUnlessEqual(Student.objects.get(id=self.student.id).cache_gpa, Decimal('70.00'))
+
+
+class StreamingReportTest(TestCase):
+    def write(self, format):
+        from ecwsp.sis.stream_report import StreamingReport
+        import tempfile
+        report = StreamingReport("test", format)
+        rows = ([u'Student {}'.format(i), i, '3.5', 'N/A'] for i in range(3))
+        report.add_sheet(rows, ['Student', 'Number', 'GPA', 'Note'], heading="Report")
+        output = tempfile.TemporaryFile()
+        report.write(output)
+        output.seek(0)
+        return output
+
+    def test_formats(self):
+        import zipfile
+        self.failUnlessEqual(self.write('csv').read().splitlines()[2], 'Student 0,0,3.5,N/A')
+        sheet = zipfile.ZipFile(self.write('xlsx')).read('xl/worksheets/sheet1.xml')
+        self.failUnless('<c r="C3"><v>3.5</v></c>' in sheet)
+        self.failUnless('<t xml:space="preserve">N/A</t>' in sheet)
+        content = zipfile.ZipFile(self.write('ods')).read('content.xml')
+        self.failUnless('table:name="Report"' in content)
+        self.failUnless('office:value="2"' in content)
+
+
+class ReportFieldTest(TestCase):
+    def test_resolver(self):
+        from ecwsp.sis.report_fields import ReportFieldResolver
+        students = [Student.objects.create(fname="Joe", lname="Student%s" % (i,), username="jstudent%s" % (i,))
+                    for i in range(3)]
+        students[0].siblings.add(students[1], students[2])
+        resolver = ReportFieldResolver(['siblings', 'fname', 'year.name'], Student.objects.all())
+        self.failUnlessEqual(resolver.titles, ['siblings', 'siblings', 'fname', 'year.name'])
+        self.failUnlessEqual(resolver.cells(students[0]),
+            [unicode(students[1]), unicode(students[2]), 'Joe', ''])
+        self.failUnlessEqual(len(resolver.cells(students[2])), 4)
+
+
+class OfficePoolTest(TestCase):
+    def test_port_lock(self):
+        from ecwsp.sis.office_pool import OfficeInstance, OfficePool, OfficePoolError
+        # Another process's pool holding the only port
+        other = OfficeInstance(2999)
+        self.failUnless(other.lock())
+        pool = OfficePool(ports=[2999], start=False, job_timeout=1)
+        self.assertRaises(OfficePoolError, pool.acquire)
+        other.unlock()
+        instance = pool.acquire()
+        self.failIf(other.lock())
+        pool.release(instance)
+        self.failUnless(other.lock())
+        other.unlock()
+
+    def test_stuck_job(self):
+        from ecwsp.sis.office_pool import OfficePool, OfficePoolError
+        import threading
+        import time
+        class Desktop(object):
+            def getComponents(self):
+                pass
+        pool = OfficePool(ports=[2998], start=False, job_timeout=1)
+        pool.idle[0].desktop = Desktop()
+        never = threading.Event()
+        self.assertRaises(OfficePoolError, pool.run, lambda desktop: never.wait())
+        # Restarting didn't unblock the job, the instance is released anyway
+        time.sleep(1.5)
+        pool.release(pool.acquire())
+        never.set()
+
+
+class ImporterLookupTest(TestCase):
+    def test_same_as_query(self):
+        """ Lookups match exactly what objects.get does on this database """
+        from ecwsp.sis.importer import Importer
+        def get(lookup, value):
+            try:
+                return lookup(name=value)
+            except (Cohort.DoesNotExist, Cohort.MultipleObjectsReturned), e:
+                return type(e)
+        math = Cohort.objects.create(name="Math")
+        Cohort.objects.create(name="Art")
+        Cohort.objects.create(name="art")
+        importer = Importer()
+        for value in ("Math", "math", " Math", "Art", "art", "ART", "Music"):
+            self.failUnlessEqual(get(lambda name: importer.lookup(Cohort, 'name', name), value),
+                                 get(Cohort.objects.get, value))
+        self.failUnlessEqual(importer.lookup_or_create(Cohort, 'name', "Math"), math)
@@ -1,6 +1,8 @@
 from django.http import HttpResponse
 from django.core.servers.basehttp import FileWrapper
 
+from ecwsp.sis.office_pool import get_pool
+
 import os
 import string
 import tempfile
@@ -23,12 +25,7 @@ def uno_open(file):
     file -- Location of the file to open
     returns an uno document
     """
-    import uno
-    from com.sun.star.beans import PropertyValue
-    local = uno.getComponentContext()
-    resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
-    context = resolver.resolve("uno:socket,host=localhost,port=2002;urp;StarOffice.ComponentContext")
-    desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+    desktop = get_pool().desktop()
     return desktop.loadComponentFromURL("file://" + str(file) ,"_blank", 0, ())
 
 
@@ -117,11 +114,7 @@ def replace_once_report(infile, outfile, data, type="doc"):
     It replaces the first instance of $TEST with first, second with second, etc
     returns a django HttpResponse of the file
     """
-    import uno
-    local = uno.getComponentContext()
-    resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
-    context = resolver.resolve("uno:socket,host=localhost,port=2002;urp;StarOffice.ComponentContext")
-    desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+    desktop = get_pool().desktop()
     
     document = desktop.loadComponentFromURL( "private:factory/swriter", "_blank", 0, () )
     doc_cursor = document.Text.createTextCursor()
@@ -250,11 +243,7 @@ def mail_merge(infile, outfile, data, type="doc"):
         data.append(page1)
         data.append(page2)
     """
-    import uno
-    local = uno.getComponentContext()
-    resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
-    context = resolver.resolve("uno:socket,host=localhost,port=2002;urp;StarOffice.ComponentContext")
-    desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+    desktop = get_pool().desktop()
     
     document = desktop.loadComponentFromURL( "private:factory/swriter", "_blank", 0, () )
     doc_cursor = document.Text.createTextCursor()
@@ -1,6 +1,6 @@
 from django.conf.urls import patterns
 from views import student_page_redirect, school_report_builder_view, transcript_nonofficial, photo_flash_card, grade_report
-from views import import_everything, user_preferences, view_student, ajax_include_deleted, import_naviance, increment_year, increment_year_confirm
+from views import import_everything, import_status, import_cancel, user_preferences, view_student, ajax_include_deleted, import_naviance, increment_year, increment_year_confirm
 
 urlpatterns = patterns('',
     (r'^get_student/(?P<student_id>\d+)/$', student_page_redirect),
@@ -10,6 +10,8 @@ urlpatterns = patterns('',
     (r'^flashcard/(?P<year>\d+)/$', photo_flash_card),
     (r'^grade_report/$', grade_report),
     (r'^import/$', import_everything),
+    (r'^import/(?P<import_log_id>\d+)/status/$', import_status),
+    (r'^import/(?P<import_log_id>\d+)/cancel/$', import_cancel),
     (r'^preferences/$', user_preferences),
     (r'^view_student/$', view_student),
     (r'^view_student/(?P<id>\d+)/$', view_student),
@@ -29,8 +29,9 @@ from django.template import RequestContext
 from django.http import HttpResponse, HttpResponseRedirect
 from django.utils.safestring import mark_safe
 from datetime import date
+import json
 
-from ecwsp.sis.models import Student, UserPreference, GradeLevel, SchoolYear
+from ecwsp.sis.models import Student, UserPreference, GradeLevel, SchoolYear, ImportLog
 from ecwsp.sis.forms import UserPreferenceForm, UploadFileForm, StudentLookupForm, StudentReportWriterForm
 from ecwsp.sis.forms import StudentGradeReportWriterForm, MarkingPeriodForm, YearSelectForm
 from ecwsp.administration.models import Template
@@ -40,7 +41,6 @@ from ecwsp.schedule.calendar import Calendar
 from ecwsp.schedule.models import MarkingPeriod, Course
 
 from tempfile import mkstemp
-import sys
 import httpagentparser
 
 @login_required
@@ -122,6 +122,14 @@ def import_everything(request):
     if request.POST:
         form = UploadFileForm(request.POST, request.FILES)
         if form.is_valid():
+            if 'djcelery' in settings.INSTALLED_APPS:
+                # Large workbooks take longer than a request may, import in the background
+                from ecwsp.sis.tasks import import_everything as import_everything_task
+                import_log = ImportLog(user=request.user, import_file=request.FILES['file'], status='queued')
+                import_log.save()
+                import_everything_task.delay(import_log.id)
+                form = UploadFileForm()
+                return render_to_response('upload.html', {'form': form, 'import_log': import_log, 'request': request,}, RequestContext(request, {}))
             from ecwsp.sis.importer import Importer
             importer = Importer(request.FILES['file'], request.user)
             msg = ""
@@ -133,6 +141,32 @@ def import_everything(request):
             return render_to_response('upload.html', {'form': form, 'request': request,})
     form = UploadFileForm()
     return render_to_response('upload.html', {'form': form, 'request': request,}, RequestContext(request, {}))
+
+@user_passes_test(lambda u: u.groups.filter(name='registrar').count() > 0 or u.is_superuser, login_url='/')
+def import_status(request, import_log_id):
+    """ JSON progress of a background import, polled by upload.html """
+    import_log = get_object_or_404(ImportLog, id=import_log_id)
+    data = {
+        'status': import_log.status,
+        'status_display': import_log.get_status_display(),
+        'finished': import_log.is_finished(),
+        'current_sheet': import_log.current_sheet,
+        'progress': import_log.get_progress(),
+        'message': import_log.message,
+        'error_file': None,
+    }
+    if import_log.error_file:
+        data['error_file'] = import_log.error_file.url
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+@user_passes_test(lambda u: u.groups.filter(name='registrar').count() > 0 or u.is_superuser, login_url='/')
+def import_cancel(request, import_log_id):
+    """ Ask a background import to stop. Rows already imported are kept. """
+    if request.method == 'POST':
+        # Update only if still in that state, the worker may have just moved on
+        ImportLog.objects.filter(id=import_log_id, status='queued').update(status='cancelled')
+        ImportLog.objects.filter(id=import_log_id, status='running').update(status='cancelling')
+    return import_status(request, import_log_id)
     
 
 @user_passes_test(lambda u: u.has_perm("sis.view_student"), login_url='/')    
@@ -368,11 +402,7 @@ def view_student(request, id=None):
     
     # Schedule
     cal = Calendar()
-    try:
-        location = cal.find_student(student)
-    except:
-        location = None
-        print >> sys.stderr, str(sys.exc_info()[0])
+    location = cal.find_student(student)
     # Guess the mp desired (current or next coming)
     schedule_days = None
     periods = None
@@ -423,6 +453,12 @@ def view_student(request, id=None):
     #Grades
     years = SchoolYear.objects.filter(markingperiod__course__courseenrollment__user=student).distinct()
     from ecwsp.grades.models import Grade
+    from ecwsp.sis.gpa import GPAData
+    # Every grade and final grade of the student, from one grade query each
+    grades = {}
+    for grade in Grade.objects.filter(student=student, marking_period__isnull=False):
+        grades[(grade.course_id, grade.marking_period_id)] = grade
+    gpa_data = GPAData([student.id])
     for year in years:
         year.mps = MarkingPeriod.objects.filter(course__courseenrollment__user=student, school_year=year).distinct().order_by("start_date")
         year.courses = Course.objects.filter(courseenrollment__user=student, graded=True, marking_period__school_year=year).distinct()
@@ -430,12 +466,12 @@ def view_student(request, id=None):
             # Too much logic for the template here, so just generate html.
             course.grade_html = ""
             for marking_period in year.mps:
-                try:
+                if (course.id, marking_period.id) in grades:
                     course.grade_html += '<td> %s </td>' % (
-                        Grade.objects.get(student=student, course=course, marking_period=marking_period).get_grade(),)
-                except:
+                        grades[(course.id, marking_period.id)].get_grade(),)
+                else:
                     course.grade_html += '<td> </td>'
-            course.grade_html += '<td> %s </td>' % (unicode(course.get_final_grade(student)),)
+            course.grade_html += '<td> %s </td>' % (unicode(gpa_data.get_final_grade(student.id, course.id)),)
         
         # Attendance
         if 'ecwsp.attendance' in settings.INSTALLED_APPS:
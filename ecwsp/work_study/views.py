@@ -110,7 +110,7 @@ def student_timesheet(request):
         if hasattr(this_student,"primary_contact"):
             if this_student.primary_contact:
                 initial_primary = this_student.primary_contact.id
-        if Configuration.get_or_default('work_study_timesheet_initial_time', 'True').value == 'True':
+        if Configuration.get_bool('work_study_timesheet_initial_time', True):
             form = TimeSheetForm(initial={'student':this_student.id, 'company':this_student.placement.id, 'my_supervisor':initial_primary,
                 'date': date.today, 'time_in': "9:30 AM", 'time_lunch': "12:00 PM", 'time_lunch_return': "1:00 PM", 'time_out': "5:00 PM"})
         else: